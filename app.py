@@ -1,16 +1,73 @@
 from flask import Flask
+from flask.helpers import get_debug_flag
+from werkzeug.serving import is_running_from_reloader
+import os
 from routes.single_device_routes import single_device_bp
 from routes.multi_device_routes import multi_device_bp
-from routes.continuous_routes import continuous_bp
+from routes.continuous_routes import continuous_bp, restore_tasks
+from routes.tag_routes import tag_bp
+from routes.metrics_routes import metrics_bp
+from tag_registry import tag_registry
+from connection_pool import connection_pool
+from webhook_delivery import webhook_dispatcher
+from task_store import task_store
+from tag_history import history_store
+from shard_pool import shard_pool
+from serial_gateway import serial_buses
 
-def create_app():
-    """Create and configure the Flask application"""
+def create_app(tag_config=None, task_db=None, shards=None, serving=True):
+    """
+    Create and configure the Flask application
+    
+    Args:
+        tag_config (str): Path to a JSON/YAML device and tag registry file
+                          (defaults to the MODBUS_TAG_CONFIG environment variable)
+        task_db (str): Path to the SQLite file continuous tasks are saved in and
+                       restored from (defaults to the MODBUS_TASK_DB environment variable)
+        shards (int): Number of worker processes continuous tasks are sharded across
+                      (defaults to the MODBUS_SHARDS environment variable; 0 runs them in this process)
+        serving (bool): False in a process that builds the app but never serves it (the
+                        reloader's file watcher); shard workers are then not started
+                        and saved tasks are not restored
+    """
     app = Flask(__name__)
     
+    # Load and compile the device/tag registry
+    tag_config = tag_config or os.environ.get('MODBUS_TAG_CONFIG')
+    if tag_config:
+        tag_registry.load_file(tag_config)
+    
+    # Devices to serve over pipelined connections, e.g. "10.0.0.5:502=16,10.0.0.6:502"
+    connection_pool.configure_pipelining(os.environ.get('MODBUS_PIPELINED_DEVICES'))
+    
+    # Gateways fronting one RS-485 bus and its baud rate, e.g. "10.0.0.7:502=9600,10.0.0.8:502=19200"
+    serial_buses.configure(os.environ.get('MODBUS_SERIAL_GATEWAYS'))
+    
+    # Memory all task histories together may reserve, in MB
+    if os.environ.get('MODBUS_HISTORY_MAX_MB'):
+        history_store.max_bytes = int(float(os.environ['MODBUS_HISTORY_MAX_MB']) * 1024 * 1024)
+    
+    # Directory of the on-disk spools of callback URLs with callback_spool enabled
+    webhook_dispatcher.spool_dir = os.environ.get('MODBUS_SPOOL_DIR', webhook_dispatcher.spool_dir)
+    
+    # Poll from worker processes, each owning the devices that hash to it
+    shards = shards if shards is not None else int(os.environ.get('MODBUS_SHARDS', 0))
+    if shards > 0 and serving:
+        shard_pool.start(shards, os.environ.get('MODBUS_PIPELINED_DEVICES'),
+                         os.environ.get('MODBUS_SERIAL_GATEWAYS'))
+    
+    # Bring back the continuous tasks of the previous run
+    task_db = task_db or os.environ.get('MODBUS_TASK_DB')
+    if task_db and serving:
+        task_store.open(task_db)
+        restore_tasks()
+    
     # Register blueprints
     app.register_blueprint(single_device_bp)
     app.register_blueprint(multi_device_bp)
     app.register_blueprint(continuous_bp)
+    app.register_blueprint(tag_bp)
+    app.register_blueprint(metrics_bp)
     
     @app.route('/')
     def index():
@@ -26,12 +83,27 @@ def create_app():
                     "/api/modbus/device/continuous",
                     "/api/modbus/devices/continuous",
                     "/api/modbus/tasks"
-                ]
+                ],
+                "tags": [
+                    "/api/modbus/registry",
+                    "/api/modbus/tags",
+                    "/api/modbus/tags/read"
+                ],
+                "metrics": "/metrics"
             }
         }
     
     return app
 
+def serving_process():
+    """
+    Whether this process will serve requests
+    
+    Debug mode (FLASK_DEBUG=1) runs the reloader: a file-watching process that
+    builds the app but never serves it, and a child that does.
+    """
+    return not get_debug_flag() or is_running_from_reloader()
+
 if __name__ == '__main__':
-    app = create_app()
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    app = create_app(serving=serving_process())
+    app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,337 @@
+import asyncio
+import json
+from contextlib import nullcontext
+from modbus_controller import BIT_TYPES, DeviceBusyError, ModbusError
+from async_modbus_controller import async_connection_pool
+from device_health import device_health
+from read_planner import build_read_plans
+from register_codec import BIT_FORMATS, CodecError, format_bits
+from priority_classes import BULK, CONTROL_WRITE, INTERACTIVE, PRIORITY_CLASSES, priority_class
+from response_encoding import (JSON, batch_sections, dumps_json, encode, negotiate, not_acceptable_message,
+                               retry_after_header, value_sections)
+from routes.continuous_routes import task_summaries
+
+# Async serving mode: the same JSON contracts as the Flask app for the
+# single-device, multi-device and task listing endpoints, with every
+# device call awaited on the event loop instead of blocking a thread.
+#
+# Run with any ASGI server, e.g.:
+#   uvicorn asgi_app:create_asgi_app --factory --host 0.0.0.0 --port 5000
+
+async def single_device_operation(data):
+    """Perform a single read or write operation on one device"""
+    try:
+        # Extract device connection parameters
+        host = data.get('host', '127.0.0.1')
+        port = data.get('port', 502)
+        timeout = data.get('timeout', 30)
+        slave_id = data.get('slave_id', 1)
+
+        # Extract operation parameters
+        operation = data.get('operation', 'read')
+        reg_type = data.get('reg_type', 'holding')
+        address = data.get('address', 0)
+        count = data.get('count', 1)
+        data_type = data.get('data_type', 'int16')
+        bit_format = data.get('bit_format', 'list')
+        value = data.get('value', None)
+        priority = data.get('priority', INTERACTIVE)  # class of a read when the device is busy
+
+        if operation == 'write' and value is None:
+            return {"status": "error", "message": "Value is required for write operations"}, 400
+        if operation not in ('read', 'write'):
+            return {"status": "error", "message": "Invalid operation. Use 'read' or 'write'"}, 400
+        if bit_format not in BIT_FORMATS:
+            return {"status": "error", "message": f"Invalid bit_format. Use one of {', '.join(BIT_FORMATS)}"}, 400
+        if priority not in PRIORITY_CLASSES:
+            return {"status": "error", "message": f"Invalid priority. Use one of {', '.join(PRIORITY_CLASSES)}"}, 400
+
+        # Writes are setpoints and go first, as through the Flask app's write queue
+        with priority_class(CONTROL_WRITE if operation == 'write' else priority):
+            async with async_connection_pool.connection(host, port, timeout) as controller:
+                if operation == 'read':
+                    result = await controller.read_data(reg_type, address, count, slave_id, data_type)
+                    if reg_type in BIT_TYPES:
+                        result = format_bits(result, bit_format)
+                    return {"status": "success", "data": result}, 200, lambda: value_sections(result, data_type)
+                else:
+                    await controller.write_data(address, value, slave_id, data_type, reg_type)
+                    return {"status": "success", "message": "Write operation completed"}, 200
+
+    except DeviceBusyError as e:
+        # The device's queue is saturated: tell the client when to come back
+        return {"status": "error", "message": str(e), "retry_after": e.retry_after}, 429
+    except ModbusError as e:
+        return {"status": "error", "message": str(e)}, 400
+    except Exception as e:
+        return {"status": "error", "message": f"Unexpected error: {str(e)}"}, 500
+
+
+def _result(op, status, **fields):
+    """Build a batch result entry for an operation"""
+    return dict({"status": status, "host": op.get('host', '127.0.0.1'), "port": op.get('port', 502)}, **fields)
+
+
+def _error_result(op, error):
+    """Build the result entry for a failed operation; a saturated device adds a retry hint"""
+    if isinstance(error, DeviceBusyError):
+        return _result(op, "error", message=str(error), retry_after=error.retry_after)
+    return _result(op, "error", message=str(error))
+
+
+def _read_result(op, value):
+    """Build the result entry for a read, encoding coil/discrete input states as requested"""
+    if isinstance(value, ModbusError):
+        return _error_result(op, value)
+    if op.get('reg_type', 'holding') in BIT_TYPES:
+        try:
+            value = format_bits(value, op.get('bit_format', 'list'))
+        except CodecError as e:
+            return _result(op, "error", message=str(e))
+    return _result(op, "success", data=value)
+
+
+async def execute_operation(op):
+    """Run one batch operation and return its result entry"""
+    operation = op.get('operation', 'read')
+    value = op.get('value', None)
+    if operation not in ('read', 'write'):
+        return _result(op, "error", message="Invalid operation. Use 'read' or 'write'")
+    if operation == 'write' and value is None:
+        return _result(op, "error", message="Value is required for write operations")
+
+    try:
+        # Writes go first, as through the Flask app's write queue; reads keep the batch's class
+        with priority_class(CONTROL_WRITE) if operation == 'write' else nullcontext():
+            async with async_connection_pool.connection(op.get('host', '127.0.0.1'), op.get('port', 502),
+                                                        op.get('timeout', 30)) as controller:
+                if operation == 'read':
+                    result = await controller.read_data(op.get('reg_type', 'holding'), op.get('address', 0),
+                                                        op.get('count', 1), op.get('slave_id', 1),
+                                                        op.get('data_type', 'int16'))
+                    return _read_result(op, result)
+                else:
+                    await controller.write_data(op.get('address', 0), value, op.get('slave_id', 1),
+                                                op.get('data_type', 'int16'), op.get('reg_type', 'holding'))
+                    return _result(op, "success", message="Write operation completed")
+    except ModbusError as e:
+        return _error_result(op, e)
+    except Exception as e:
+        return _result(op, "error", message=f"Unexpected error: {str(e)}")
+
+
+async def _run_reads(operations, indexes, results, max_gap):
+    """Run a run of read operations on one device using coalesced read plans"""
+    if len(indexes) <= 1:
+        for i in indexes:
+            results[i] = await execute_operation(operations[i])
+        return
+
+    plans, unplanned = build_read_plans(operations, indexes, max_gap)
+    for i in unplanned:
+        results[i] = await execute_operation(operations[i])
+
+    for plan, members in plans:
+        timeout = max(operations[i].get('timeout', 30) for i in members)
+        try:
+            async with async_connection_pool.connection(plan.host, plan.port, timeout) as controller:
+                values = await plan.execute_async(controller)
+        except ModbusError as e:
+            values = [e] * len(members)
+        except Exception as e:
+            values = [ModbusError(f"Unexpected error: {str(e)}")] * len(members)
+        for i, value in zip(members, values):
+            results[i] = _read_result(operations[i], value)
+
+
+async def _run_device_group(operations, indexes, results, coalesce, max_gap):
+    """Run the operations for one device in request order"""
+    reads = []
+    for i in indexes:
+        if coalesce and operations[i].get('operation', 'read') == 'read':
+            reads.append(i)
+            continue
+        await _run_reads(operations, reads, results, max_gap)
+        reads = []
+        results[i] = await execute_operation(operations[i])
+    await _run_reads(operations, reads, results, max_gap)
+
+
+async def multi_device_operation(data):
+    """Perform operations on multiple devices concurrently, within the batch deadline"""
+    try:
+        operations = data.get('operations', [])
+        deadline = data.get('deadline', 30)
+        coalesce = data.get('coalesce', True)
+        max_gap = data.get('max_gap')
+        priority = data.get('priority', BULK)  # class of the batch's reads when devices are busy
+        if priority not in PRIORITY_CLASSES:
+            return {"status": "error", "message": f"Invalid priority. Use one of {', '.join(PRIORITY_CLASSES)}"}, 400
+
+        groups = {}
+        for i, op in enumerate(operations):
+            groups.setdefault((op.get('host', '127.0.0.1'), op.get('port', 502)), []).append(i)
+
+        results = [None] * len(operations)
+        # The device tasks inherit the batch's class from this context
+        with priority_class(priority):
+            tasks = [asyncio.ensure_future(_run_device_group(operations, indexes, results, coalesce, max_gap))
+                     for indexes in groups.values()]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=deadline)
+            for task in pending:
+                task.cancel()
+
+        partial = False
+        for i, result in enumerate(results):
+            if result is None:
+                partial = True
+                results[i] = _result(operations[i], "error", message="Batch deadline exceeded")
+
+        health = {f"{host}:{port}": device_health.status(f"{host}:{port}") for host, port in groups}
+        payload = {"status": "success", "partial": partial, "results": results, "devices": health}
+        # If every operation was turned away by a saturated device, so is the request
+        retry_hints = [result for result in results if "retry_after" in result]
+        status = 429 if retry_hints and len(retry_hints) == len(results) else 200
+        return payload, status, lambda: batch_sections(operations, results)
+
+    except Exception as e:
+        return {"status": "error", "message": f"Unexpected error: {str(e)}"}, 500
+
+
+async def list_tasks(_data):
+    """List all continuous tasks"""
+    return {"status": "success", "tasks": task_summaries()}, 200
+
+
+async def index(_data):
+    """API root endpoint"""
+    return {
+        "status": "success",
+        "message": "Modbus API Server is running (ASGI)",
+        "api_version": "1.0.0",
+        "endpoints": {
+            "single_device": "/api/modbus/device",
+            "multiple_devices": "/api/modbus/devices",
+            "tasks": "/api/modbus/tasks"
+        }
+    }, 200
+
+
+ROUTES = {
+    '/': {'GET': index},
+    '/api/modbus/device': {'POST': single_device_operation},
+    '/api/modbus/devices': {'POST': multi_device_operation},
+    '/api/modbus/tasks': {'GET': list_tasks},
+}
+
+# Handlers whose successful responses are encoded as the Accept header asks;
+# they return (payload, status, typed array sections) on success
+NEGOTIATED = (single_device_operation, multi_device_operation)
+
+
+async def _read_body(receive):
+    """Collect the full request body"""
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+
+def _header(scope, name):
+    """Return a request header as a string, or None"""
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _retry_headers(payload):
+    """Retry-After header for a response with retry hints from saturated devices (the longest hint)"""
+    hints = [result["retry_after"] for result in [payload] + payload.get("results", []) if "retry_after" in result]
+    return [(b'retry-after', retry_after_header(max(hints)).encode())] if hints else []
+
+
+async def _send_json(send, payload, status=200, headers=()):
+    """Send a JSON response (keys sorted, like Flask's jsonify)"""
+    await _send(send, dumps_json(payload), JSON, status, headers)
+
+
+async def _send(send, body, content_type, status=200, headers=()):
+    """Send a complete response"""
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode()),
+                    (b'content-length', str(len(body)).encode())] + list(headers)
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _lifespan(receive, send):
+    """Handle ASGI lifespan events; idle connections are closed on shutdown"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            async_connection_pool.close_all()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def create_asgi_app():
+    """Create the ASGI application (async counterpart of app.create_app)"""
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await _lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        methods = ROUTES.get(scope['path'].rstrip('/') or '/')
+        if methods is None:
+            await _send_json(send, {"status": "error", "message": "Not found"}, 404)
+            return
+        handler = methods.get(scope['method'])
+        if handler is None:
+            await _send_json(send, {"status": "error", "message": "Method not allowed"}, 405,
+                             [(b'allow', ', '.join(methods).encode())])
+            return
+
+        media_type = JSON
+        if handler in NEGOTIATED:
+            media_type = negotiate(_header(scope, b'accept'))
+            if media_type is None:
+                await _send_json(send, {"status": "error", "message": not_acceptable_message()}, 406)
+                return
+
+        body = await _read_body(receive)
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError as e:
+            await _send_json(send, {"status": "error", "message": f"Unexpected error: {str(e)}"}, 500)
+            return
+
+        payload, status, *sections = await handler(data)
+        headers = _retry_headers(payload)
+        if sections:
+            await _send(send, encode(payload, media_type, sections[0]), media_type, status,
+                        [(b'vary', b'accept')] + headers)
+        else:
+            await _send_json(send, payload, status, headers)
+
+    return app
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        print("An ASGI server is required to run the async app:")
+        print("pip install uvicorn")
+    else:
+        uvicorn.run(create_asgi_app(), host='0.0.0.0', port=5000)
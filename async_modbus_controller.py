@@ -0,0 +1,329 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from pymodbus.client import AsyncModbusTcpClient
+from pymodbus.exceptions import ModbusException
+from device_health import device_health
+from metrics import (class_latency_seconds, connect_seconds, decode_seconds, errors_total, queue_wait_seconds,
+                     request_seconds)
+from modbus_controller import (BIT_TYPES, MAX_READ_BITS, MAX_WRITE_BITS, CircuitOpenError, ModbusError, error_code,
+                               register_count_for_type)
+from register_codec import CodecError, decode_bits, decode_registers, encode_values
+from serial_gateway import serial_buses
+from priority_classes import FairQueue, current_class, with_class
+from connection_pool import admit, smoothed_hold_time
+
+# Threads parked waiting for a serial gateway's bus, so the event loop never blocks on it
+BUS_WAIT_THREADS = 32
+_bus_executor = ThreadPoolExecutor(max_workers=BUS_WAIT_THREADS, thread_name_prefix='modbus-bus-wait')
+
+class AsyncModbusController:
+    """Asyncio counterpart of ModbusController built on AsyncModbusTcpClient"""
+
+    def __init__(self, host, port=502, timeout=30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.device = f"{host}:{port}"
+        # Reconnects are handled by the pool, not by pymodbus in the background
+        self.client = AsyncModbusTcpClient(host=host, port=port, timeout=timeout, reconnect_delay=0)
+
+    async def connect(self):
+        """Connect to the Modbus server"""
+        if not self.client.connected:
+            started = time.perf_counter()
+            connected = await self.client.connect()
+            connect_seconds.observe(time.perf_counter() - started, self.device)
+            if not connected:
+                message = f"Failed to connect to Modbus server at {self.host}:{self.port}"
+                errors_total.inc(self.device, 'connect')
+                device_health.record(self.device, code='connect', error=message)
+                raise ModbusError(message)
+        return True
+
+    def close(self):
+        """Close the connection to the Modbus server"""
+        self.client.close()
+
+    def is_healthy(self):
+        """Check that the connection is still up"""
+        return self.client.connected
+
+    def set_timeout(self, timeout):
+        """Change the request timeout used by the underlying client"""
+        self.timeout = timeout
+        self.client.comm_params.timeout_connect = timeout
+
+    async def read_data(self, reg_type, address, count, slave_id=1, data_type='int16'):
+        """Read and decode registers or bits (see ModbusController.read_data)"""
+        if reg_type in BIT_TYPES:
+            return self.decode_bits(await self.read_bits(reg_type, address, count, slave_id), count)
+        registers_to_read = register_count_for_type(data_type, count)
+        registers = await self.read_registers(reg_type, address, registers_to_read, slave_id)
+        return self.decode_registers(registers, data_type, count)
+
+    async def read_registers(self, reg_type, address, count, slave_id=1):
+        """Read raw 16-bit register values"""
+        if reg_type == 'holding':
+            request = self.client.read_holding_registers(address=address, count=count, slave=slave_id)
+        elif reg_type == 'input':
+            request = self.client.read_input_registers(address=address, count=count, slave=slave_id)
+        else:
+            raise ModbusError(f"Invalid register type: {reg_type}. Use 'holding', 'input', 'coil' or 'discrete'")
+
+        result = await self._timed('read_' + reg_type, request, slave_id)
+        if result.isError():
+            raise ModbusError(f"Error reading registers: {result}")
+        return result.registers
+
+    async def read_bits(self, reg_type, address, count, slave_id=1):
+        """Read coil or discrete input states (see ModbusController.read_bits)"""
+        if reg_type not in BIT_TYPES:
+            raise ModbusError(f"Invalid bit type: {reg_type}. Use 'coil' or 'discrete'")
+        if not 1 <= count <= MAX_READ_BITS:
+            raise ModbusError(f"Bit count must be between 1 and {MAX_READ_BITS}")
+        if reg_type == 'coil':
+            request = self.client.read_coils(address=address, count=count, slave=slave_id)
+        else:
+            request = self.client.read_discrete_inputs(address=address, count=count, slave=slave_id)
+
+        result = await self._timed('read_' + reg_type, request, slave_id)
+        if result.isError():
+            raise ModbusError(f"Error reading bits: {result}")
+        return result.bits[:count]
+
+    async def write_data(self, address, value, slave_id=1, data_type='int16', reg_type='holding'):
+        """Encode and write a value or list of values (see ModbusController.write_data)"""
+        if reg_type == 'coil':
+            return await self.write_bits(address, value, slave_id)
+        if reg_type != 'holding':
+            raise ModbusError(f"Cannot write to {reg_type}: only 'holding' and 'coil' are writable")
+        try:
+            registers = encode_values(value, data_type)
+        except CodecError as e:
+            raise ModbusError(str(e))
+
+        if len(registers) == 1:
+            request = self.client.write_register(address=address, value=registers[0], slave=slave_id)
+        else:
+            request = self.client.write_registers(address=address, values=registers, slave=slave_id)
+
+        result = await self._timed('write', request, slave_id)
+        if result.isError():
+            raise ModbusError(f"Error writing registers: {result}")
+        return True
+
+    async def write_bits(self, address, value, slave_id=1):
+        """Write one coil, or a list of consecutive coils in one request"""
+        values = value if isinstance(value, (list, tuple)) else [value]
+        if not 1 <= len(values) <= MAX_WRITE_BITS:
+            raise ModbusError(f"Coil count must be between 1 and {MAX_WRITE_BITS}")
+        if len(values) == 1:
+            request = self.client.write_coil(address=address, value=bool(values[0]), slave=slave_id)
+        else:
+            request = self.client.write_coils(address=address, values=[bool(v) for v in values], slave=slave_id)
+
+        result = await self._timed('write_coil', request, slave_id)
+        if result.isError():
+            raise ModbusError(f"Error writing coils: {result}")
+        return True
+
+    def decode_bits(self, bits, count=1):
+        """Decode coil or discrete input states"""
+        try:
+            return decode_bits(bits, count)
+        except CodecError as e:
+            raise ModbusError(str(e))
+
+    def decode_registers(self, registers, data_type, count=1):
+        """Decode register values based on data type"""
+        started = time.perf_counter()
+        try:
+            return decode_registers(registers, data_type, count)
+        except CodecError as e:
+            raise ModbusError(str(e))
+        finally:
+            decode_seconds.observe(time.perf_counter() - started, data_type.split('[')[0])
+
+    async def _timed(self, function, request, slave_id):
+        """Await a client request, recording its round-trip time under the given function label"""
+        bus = serial_buses.get(self.device)
+        if bus is not None:
+            # Gateway to a serial bus: wait for our turn on it (shared with the
+            # threaded controllers of this process), then time only the request
+            try:
+                granted = await self._acquire_bus(bus, slave_id)
+            except BaseException:
+                request.close()
+                raise
+            if not granted:
+                request.close()
+                raise ModbusError(f"Timed out waiting for the serial bus of {self.device}")
+            try:
+                return await self._timed_request(function, request)
+            finally:
+                bus.release()
+        return await self._timed_request(function, request)
+
+    async def _acquire_bus(self, bus, slave_id):
+        """Wait for a serial bus on a parked thread; returns False if it wasn't granted in time"""
+        acquire = asyncio.get_running_loop().run_in_executor(
+            _bus_executor, with_class(current_class(), bus.acquire), slave_id, self.timeout)
+        try:
+            return await asyncio.shield(acquire)
+        except asyncio.CancelledError:
+            # The thread may still be granted the bus: hand it straight back
+            acquire.add_done_callback(lambda done: _release_granted(bus, done))
+            raise
+
+    async def _timed_request(self, function, request):
+        started = time.perf_counter()
+        try:
+            result = await request
+        except ModbusException as e:
+            self._record(function, time.perf_counter() - started, 'connection', str(e))
+            raise
+        if result.isError():
+            self._record(function, time.perf_counter() - started, error_code(result), str(result))
+        else:
+            self._record(function, time.perf_counter() - started)
+        return result
+
+    def _record(self, function, elapsed, code=None, error=None):
+        """Record a request's round-trip time and outcome in the metrics and the device's health"""
+        request_seconds.observe(elapsed, self.device, function)
+        if code is not None:
+            errors_total.inc(self.device, code)
+        device_health.record(self.device, elapsed, code, error)
+
+
+def _release_granted(bus, acquire):
+    """Release a bus granted to a request that was cancelled while it waited"""
+    if not acquire.cancelled() and acquire.exception() is None and acquire.result():
+        bus.release()
+
+
+class AsyncConnectionPool:
+    """
+    Pool of persistent async Modbus TCP connections keyed by (host, port), for one event loop
+
+    Busy devices queue requests fairly by priority class and turn them away
+    with DeviceBusyError, like ConnectionPool (see its acquire method).
+    """
+
+    def __init__(self, max_per_device=4, idle_timeout=60.0, acquire_timeout=10.0, max_queue=32):
+        self.max_per_device = max_per_device
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.max_queue = max_queue
+        self._idle = {}        # (host, port) -> list of (controller, released_at)
+        self._in_use = {}      # (host, port) -> number of borrowed connection slots
+        self._queues = {}      # (host, port) -> FairQueue of requests waiting for a slot
+        self._grants = {}      # queue entry -> future resolved when the slot is handed over
+        self._hold_times = {}  # (host, port) -> smoothed seconds a connection is held
+
+    @asynccontextmanager
+    async def connection(self, host, port=502, timeout=30):
+        """Borrow a connected controller and return it to the pool afterwards"""
+        key = (host, port)
+        device = f"{host}:{port}"
+        error = device_health.check(device, timeout)
+        if error is not None:
+            raise CircuitOpenError(error)
+        timeout = device_health.timeout(device, timeout)
+        started = time.monotonic()
+        await self._acquire_slot(key)
+        acquired = time.monotonic()
+
+        controller = None
+        broken = False
+        try:
+            controller = self._take_idle(key)
+            if controller is None:
+                controller = AsyncModbusController(host, port, timeout)
+            else:
+                controller.set_timeout(timeout)
+            await controller.connect()
+            yield controller
+        except ModbusError:
+            raise
+        except BaseException:
+            broken = True
+            raise
+        finally:
+            if controller is not None:
+                if broken or not controller.is_healthy():
+                    controller.close()
+                else:
+                    self._idle.setdefault(key, []).append((controller, time.monotonic()))
+            self._release_slot(key)
+            finished = time.monotonic()
+            class_latency_seconds.observe(finished - started, current_class())
+            self._hold_times[key] = smoothed_hold_time(self._hold_times.get(key), finished - acquired)
+
+    async def _acquire_slot(self, key):
+        """Take one of a device's connection slots, waiting in its fair queue while they are all taken"""
+        queue = self._queues.get(key)
+        if not queue and self._in_use.get(key, 0) < self.max_per_device:
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+            return
+
+        device = f"{key[0]}:{key[1]}"
+        name = current_class()
+        admit(device, name, len(queue) if queue else 0, self.max_queue, self.max_per_device,
+              self._hold_times.get(key))
+        queue = self._queues.setdefault(key, FairQueue())
+        entry = queue.push(name)
+        granted = self._grants[entry] = asyncio.get_running_loop().create_future()
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), self.acquire_timeout)
+        except BaseException as e:
+            if granted.done():
+                # The slot was handed over just as we gave up: pass it on
+                self._release_slot(key)
+            else:
+                queue.pop(entry, served=False)
+                if not queue:
+                    del self._queues[key]
+            if isinstance(e, asyncio.TimeoutError):
+                raise ModbusError(f"Timed out waiting for a free connection to {device}")
+            raise
+        finally:
+            del self._grants[entry]
+        queue_wait_seconds.observe(time.monotonic() - started, name)
+
+    def _release_slot(self, key):
+        """Hand a connection slot to the next request in the device's fair queue, or free it"""
+        queue = self._queues.get(key)
+        if not queue:
+            self._in_use[key] -= 1
+            return
+        entry = queue.head()
+        queue.pop(entry)
+        if not queue:
+            del self._queues[key]
+        self._grants[entry].set_result(None)
+
+    def close_all(self):
+        """Close every idle connection"""
+        idle, self._idle = self._idle, {}
+        for entries in idle.values():
+            for controller, _ in entries:
+                controller.close()
+
+    def _take_idle(self, key):
+        """Pop the most recently used idle connection, closing expired ones"""
+        entries = self._idle.get(key)
+        cutoff = time.monotonic() - self.idle_timeout
+        while entries:
+            controller, released_at = entries.pop()
+            if released_at >= cutoff and controller.is_healthy():
+                return controller
+            controller.close()
+        return None
+
+
+# Shared pool used by the ASGI app (one event loop per process)
+async_connection_pool = AsyncConnectionPool()
@@ -0,0 +1,466 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import requests
+from modbus_server import setup_server
+import device_simulator
+
+# Load generator and latency benchmark for the API.
+#
+# Starts one or more local Modbus test servers, serves the Flask app
+# in-process (or targets --url) and drives the single-device, batch and
+# continuous endpoints. Results are written as JSON so runs can be diffed
+# between versions, e.g.:
+#
+#   python3 benchmark.py --scenarios single,batch --concurrency 32 --duration 10 --output before.json
+
+SCENARIOS = ('single', 'batch', 'continuous')
+
+# Registers served by each modbus_server test instance
+SIMULATOR_REGISTERS = 100
+
+def percentiles(samples):
+    """Summarise a list of durations (seconds) in milliseconds"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def rank(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "max": round(ordered[-1] * 1000, 3)
+    }
+
+
+class StageTimer:
+    """
+    Times the internal stages of in-process requests
+
+    Wraps the pool, controller and codec entry points with timing shims
+    while installed, so a run can be broken down into connection acquire,
+    Modbus I/O, decode and total handler time.
+    """
+
+    def __init__(self):
+        self.samples = {}
+        self._patched = []
+        self._lock = threading.Lock()
+
+    def install(self, app):
+        """Wrap the timed functions; the app's WSGI handler is timed as 'handler'"""
+        from connection_pool import ConnectionPool
+        from modbus_controller import ModbusController
+        from pipelined_client import PipelinedModbusController
+
+        self._wrap(ConnectionPool, 'acquire', 'pool_acquire')
+        self._wrap(ModbusController, 'read_registers', 'modbus_read')
+        self._wrap(ModbusController, 'write_data', 'modbus_write')
+        self._wrap(ModbusController, 'decode_registers', 'decode')
+        self._wrap(PipelinedModbusController, 'read_registers', 'modbus_read')
+        self._wrap(PipelinedModbusController, 'read_register_blocks', 'modbus_read_blocks')
+        self._wrap(PipelinedModbusController, 'write_data', 'modbus_write')
+        self._wrap(app, 'wsgi_app', 'handler')
+
+    def uninstall(self):
+        """Restore the original functions"""
+        for owner, name, original, had_own in reversed(self._patched):
+            if had_own:
+                setattr(owner, name, original)
+            else:
+                delattr(owner, name)
+        self._patched = []
+
+    def reset(self):
+        """Drop the samples collected so far (e.g. after warm-up)"""
+        with self._lock:
+            self.samples = {}
+
+    def report(self):
+        """Return per-stage latency percentiles"""
+        with self._lock:
+            return {stage: percentiles(samples) for stage, samples in self.samples.items()}
+
+    def _wrap(self, owner, name, stage):
+        original = getattr(owner, name)
+        had_own = name in vars(owner)
+        timer = self
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with timer._lock:
+                    timer.samples.setdefault(stage, []).append(elapsed)
+
+        setattr(owner, name, timed)
+        self._patched.append((owner, name, original, had_own))
+
+
+def process_usage():
+    """CPU seconds used and current RSS (bytes) of this process"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    rss = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        # ru_maxrss is the peak, in KiB on Linux and bytes on macOS
+        rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return {"cpu_user": usage.ru_utime, "cpu_system": usage.ru_stime, "rss_bytes": rss}
+
+
+def start_simulators(args):
+    """
+    Start the Modbus servers to benchmark against and wait until they accept connections
+
+    'basic' starts one modbus_server process per port; 'scalable' runs all
+    devices in one device_simulator process, with the requested latency.
+    """
+    count, base_port = args.simulators, args.base_port
+    processes = []
+    if args.simulator == 'scalable':
+        config = device_simulator.config_from_args(device_simulator.parse_args([
+            '--devices', str(count), '--base-port', str(base_port), '--registers', str(SIMULATOR_REGISTERS),
+            '--latency', str(args.sim_latency), '--jitter', str(args.sim_jitter)]))
+        processes.append(multiprocessing.Process(target=device_simulator.run_simulator, args=(config,), daemon=True))
+    else:
+        for port in range(base_port, base_port + count):
+            processes.append(multiprocessing.Process(target=setup_server, kwargs={"port": port}, daemon=True))
+    for process in processes:
+        process.start()
+
+    deadline = time.monotonic() + 15
+    for port in range(base_port, base_port + count):
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Modbus test server on port {port} did not start")
+                time.sleep(0.1)
+    return processes
+
+
+def start_api():
+    """Serve the Flask app in a background thread; returns (base url, app, server)"""
+    from werkzeug.serving import make_server
+    from app import create_app
+
+    app = create_app()
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", app, server
+
+
+def run_load(send, concurrency, rate, duration, warmup, on_warm=None):
+    """
+    Call send(session) from concurrency threads for warmup + duration seconds
+
+    With rate > 0 each thread is paced so the total approaches rate
+    requests per second; latency is then measured from the scheduled send
+    time, so a stalled server is not hidden by the client slowing down.
+    Without rate, every thread sends back to back.
+
+    Returns:
+        Dict with throughput, error count and latency percentiles
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    start = time.perf_counter() + 0.05
+    measure_from = start + warmup
+    stop = measure_from + duration
+    period = concurrency / rate if rate else 0.0
+    warm = threading.Event()
+
+    def worker(n):
+        session = requests.Session()
+        next_send = start + (period * n / concurrency if period else 0.0)
+        while True:
+            now = time.perf_counter()
+            if period:
+                if next_send >= stop:
+                    break
+                if next_send > now:
+                    time.sleep(next_send - now)
+                scheduled = next_send
+                next_send += period
+            else:
+                if now >= stop:
+                    break
+                scheduled = now
+            if scheduled >= measure_from and not warm.is_set():
+                with lock:
+                    if not warm.is_set():
+                        if on_warm is not None:
+                            on_warm()
+                        warm.set()
+            try:
+                ok = send(session)
+                error = None if ok else "error response"
+            except requests.RequestException as e:
+                error = str(e)
+            elapsed = time.perf_counter() - scheduled
+            if scheduled >= measure_from:
+                with lock:
+                    latencies.append(elapsed)
+                    if error:
+                        errors.append(error)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "requests_per_second": round(len(latencies) / duration, 2),
+        "latency_ms": percentiles(latencies)
+    }
+
+
+def address_span(args):
+    """Number of start addresses at which a read of args.count values fits in the test server"""
+    from modbus_controller import register_count_for_type
+    # The test server's data blocks are offset by one register
+    return SIMULATOR_REGISTERS - register_count_for_type(args.data_type, args.count)
+
+
+def single_scenario(base_url, ports, args):
+    """Build the send function for single-device reads, spread over the simulators"""
+    counter = iter(range(1 << 62))
+
+    def send(session):
+        port = ports[next(counter) % len(ports)]
+        response = session.post(f"{base_url}/api/modbus/device", json={
+            "operation": "read",
+            "host": "127.0.0.1",
+            "port": port,
+            "address": 0,
+            "count": args.count,
+            "data_type": args.data_type,
+            "timeout": 5
+        })
+        return response.status_code == 200 and response.json().get("status") == "success"
+
+    return send
+
+
+def batch_scenario(base_url, ports, args):
+    """Build the send function for multi-device batches of batch_size reads"""
+    span = address_span(args)
+    step = max(1, span // args.batch_size)
+    operations = [{
+        "operation": "read",
+        "host": "127.0.0.1",
+        "port": ports[i % len(ports)],
+        "address": (i * step) % span,
+        "count": args.count,
+        "data_type": args.data_type,
+        "timeout": 5
+    } for i in range(args.batch_size)]
+
+    def send(session):
+        response = session.post(f"{base_url}/api/modbus/devices", json={"operations": operations, "deadline": 10})
+        body = response.json()
+        return (response.status_code == 200 and not body.get("partial")
+                and all(result["status"] == "success" for result in body["results"]))
+
+    return send
+
+
+def continuous_scenario(base_url, ports, args):
+    """Start continuous tasks, let them run and collect their scheduler statistics"""
+    session = requests.Session()
+    span = address_span(args)
+    started = []
+    start_latencies = []
+    first_start = time.perf_counter()
+    for i in range(args.tasks):
+        begin = time.perf_counter()
+        response = session.post(f"{base_url}/api/modbus/device/continuous", json={
+            "operation": "read",
+            "host": "127.0.0.1",
+            "port": ports[i % len(ports)],
+            "address": i % span,
+            "count": args.count,
+            "data_type": args.data_type,
+            "interval": args.task_interval,
+            "timeout": 5
+        })
+        start_latencies.append(time.perf_counter() - begin)
+        if response.status_code == 200:
+            started.append(response.json()["task_id"])
+
+    time.sleep(args.warmup + args.duration)
+    tasks = {task["id"]: task for task in session.get(f"{base_url}/api/modbus/tasks").json()["tasks"]}
+    elapsed = time.perf_counter() - first_start
+    for task_id in started:
+        session.delete(f"{base_url}/api/modbus/device/continuous/{task_id}")
+
+    stats = [tasks[task_id]["stats"] for task_id in started if tasks.get(task_id, {}).get("stats")]
+    runs = sum(s["runs"] for s in stats)
+    return {
+        "tasks": len(started),
+        "start_latency_ms": percentiles(start_latencies),
+        "polls": runs,
+        "polls_per_second": round(runs / elapsed, 2),
+        "expected_polls_per_second": round(len(started) / args.task_interval, 2),
+        "overruns": sum(s["overruns"] for s in stats),
+        "errors": sum(s["errors"] for s in stats),
+        "jitter_ms": {
+            "avg": round(sum(s["jitter_ms"]["avg"] * s["runs"] for s in stats) / runs, 3) if runs else 0.0,
+            "max": max((s["jitter_ms"]["max"] for s in stats), default=0.0)
+        },
+        "poll_duration_ms_max": max((s["duration_ms"]["max"] for s in stats), default=0.0)
+    }
+
+
+def git_revision():
+    """Commit of the working tree, to tell runs apart"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_benchmark(args):
+    """Run the selected scenarios and return the results document"""
+    ports = list(range(args.base_port, args.base_port + args.simulators))
+    simulators = start_simulators(args) if args.simulators else []
+
+    timer = None
+    server = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+    else:
+        base_url, app, server = start_api()
+        timer = StageTimer()
+        timer.install(app)
+
+    results = {
+        "meta": {
+            "timestamp": time.time(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "target": args.url or "in-process",
+            "settings": vars(args)
+        },
+        "scenarios": {}
+    }
+
+    try:
+        for scenario in args.scenarios:
+            if timer is not None:
+                timer.reset()
+            usage_before = process_usage()
+            wall_start = time.perf_counter()
+
+            if scenario == 'continuous':
+                result = continuous_scenario(base_url, ports, args)
+            else:
+                build = single_scenario if scenario == 'single' else batch_scenario
+                result = run_load(build(base_url, ports, args), args.concurrency, args.rate, args.duration,
+                                  args.warmup, on_warm=timer.reset if timer else None)
+
+            usage_after = process_usage()
+            wall = time.perf_counter() - wall_start
+            cpu = (usage_after["cpu_user"] - usage_before["cpu_user"]
+                   + usage_after["cpu_system"] - usage_before["cpu_system"])
+            result["process"] = {
+                "cpu_seconds": round(cpu, 3),
+                "cpu_percent": round(cpu / wall * 100, 1) if wall else 0.0,
+                "rss_bytes": usage_after["rss_bytes"]
+            }
+            if timer is not None:
+                result["stages_ms"] = timer.report()
+            results["scenarios"][scenario] = result
+            print(f"{scenario}: {json.dumps(result.get('latency_ms') or result.get('polls_per_second'))}",
+                  file=sys.stderr)
+    finally:
+        if timer is not None:
+            timer.uninstall()
+        if server is not None:
+            server.shutdown()
+        for process in simulators:
+            process.terminate()
+
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Modbus API against local test servers")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"Comma separated scenarios to run ({', '.join(SCENARIOS)})")
+    parser.add_argument('--url', help="Benchmark a running API instead of serving it in-process "
+                                      "(stage timings are only available in-process)")
+    parser.add_argument('--simulators', type=int, default=2, help="Modbus test servers to start (0 to use running ones)")
+    parser.add_argument('--simulator', choices=('basic', 'scalable'), default='basic',
+                        help="modbus_server processes, or one device_simulator process for all devices")
+    parser.add_argument('--sim-latency', type=float, default=0.0, help="Response latency of the scalable simulator")
+    parser.add_argument('--sim-jitter', type=float, default=0.0, help="Latency jitter of the scalable simulator")
+    parser.add_argument('--base-port', type=int, default=5020, help="Port of the first test server")
+    parser.add_argument('--concurrency', type=int, default=16, help="Client threads")
+    parser.add_argument('--rate', type=float, default=0, help="Target requests/s in total (0: as fast as possible)")
+    parser.add_argument('--duration', type=float, default=10, help="Measured seconds per scenario")
+    parser.add_argument('--warmup', type=float, default=1, help="Seconds run before measuring")
+    parser.add_argument('--count', type=int, default=10, help="Values per read")
+    parser.add_argument('--data-type', default='int16', help="Data type of each read")
+    parser.add_argument('--batch-size', type=int, default=10, help="Operations per batch request")
+    parser.add_argument('--tasks', type=int, default=50, help="Continuous tasks to start")
+    parser.add_argument('--task-interval', type=float, default=0.5, help="Poll interval of continuous tasks")
+    parser.add_argument('--output', help="Write the JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    args.scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = [s for s in args.scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    if args.count < 1:
+        parser.error("--count must be positive")
+    try:
+        if address_span(args) < 1:
+            parser.error(f"--count values of {args.data_type} don't fit in the test servers' {SIMULATOR_REGISTERS} registers")
+    except Exception as e:
+        parser.error(str(e))
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    # Per-request server logs would dominate the measurement
+    for name in (None, 'werkzeug', 'pymodbus'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    results = run_benchmark(args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
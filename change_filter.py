@@ -0,0 +1,100 @@
+import time
+
+# Request fields that configure report-by-exception for a tag
+FILTER_FIELDS = ('deadband', 'deadband_percent', 'heartbeat')
+
+class DeadbandFilter:
+    """
+    Report-by-exception filter for one polled tag
+
+    A value is reported when it moves further than the deadband from the
+    last reported value, when the last report is older than the heartbeat,
+    or when it is the first good value after a failed poll. Bools and
+    strings are reported on any change; for lists, one element moving
+    far enough reports the whole list.
+    """
+
+    def __init__(self, deadband=None, deadband_percent=None, heartbeat=None):
+        """
+        Create a filter
+
+        Args:
+            deadband (float): Absolute change needed to report a numeric value
+            deadband_percent (float): Change needed, in percent of the last reported value
+            heartbeat (float): Seconds after which a value is reported even if unchanged
+
+        Raises:
+            ValueError: For negative or non-numeric settings
+        """
+        for name, setting in zip(FILTER_FIELDS, (deadband, deadband_percent, heartbeat)):
+            if setting is not None and (not isinstance(setting, (int, float)) or isinstance(setting, bool)
+                                        or setting < 0):
+                raise ValueError(f"{name} must be a non-negative number")
+        self.deadband = deadband
+        self.deadband_percent = deadband_percent
+        self.heartbeat = heartbeat
+        self.reported = 0
+        self.suppressed = 0
+        self._last = None
+        self._last_report = None  # None until a good value has been reported
+
+    @classmethod
+    def from_config(cls, config, defaults=None):
+        """
+        Build a filter from an operation's fields, falling back to request-level defaults
+
+        Returns:
+            DeadbandFilter, or None if no filter field is set (report every poll)
+        """
+        defaults = defaults or {}
+        settings = {name: config.get(name, defaults.get(name)) for name in FILTER_FIELDS}
+        if all(setting is None for setting in settings.values()):
+            return None
+        return cls(**settings)
+
+    def check(self, value, timestamp=None):
+        """Decide whether a polled value is reported, and remember it if so"""
+        timestamp = timestamp if timestamp is not None else time.time()
+        if (self._last_report is None
+                or (self.heartbeat is not None and timestamp - self._last_report >= self.heartbeat)
+                or self._changed(self._last, value)):
+            self._last = value
+            self._last_report = timestamp
+            self.reported += 1
+            return True
+        self.suppressed += 1
+        return False
+
+    def failed(self):
+        """Record a failed poll; the next good value is reported whatever it is"""
+        self._last_report = None
+
+    def _changed(self, old, new):
+        """True if new differs significantly from old"""
+        if isinstance(new, list) or isinstance(old, list):
+            if not isinstance(new, list) or not isinstance(old, list) or len(new) != len(old):
+                return True
+            return any(self._changed(a, b) for a, b in zip(old, new))
+        if (isinstance(new, bool) or isinstance(old, bool)
+                or not isinstance(new, (int, float)) or not isinstance(old, (int, float))):
+            return new != old
+
+        difference = abs(new - old)
+        if self.deadband is None and self.deadband_percent is None:
+            return difference > 0
+        if self.deadband is not None and difference > self.deadband:
+            return True
+        if self.deadband_percent is not None and difference > abs(old) * self.deadband_percent / 100:
+            return True
+        return False
+
+
+def filter_stats(filters):
+    """Sum the reported/suppressed counts of a task's filters, or None if it has none"""
+    filters = [f for f in filters if f is not None]
+    if not filters:
+        return None
+    return {
+        "reported": sum(f.reported for f in filters),
+        "suppressed": sum(f.suppressed for f in filters)
+    }
@@ -0,0 +1,377 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from device_health import device_health
+from metrics import admission_rejected_total, class_latency_seconds, metrics, queue_wait_seconds
+from modbus_controller import CircuitOpenError, DeviceBusyError, ModbusController, ModbusError
+from pipelined_client import PipelinedModbusController
+from priority_classes import ADMISSION_SHARE, FairQueue, current_class
+
+# Smoothing of the per-device hold time estimate behind retry hints
+HOLD_TIME_ALPHA = 0.2
+# Retry hint while a device's hold time is unknown, and the smallest hint given
+DEFAULT_HOLD_TIME = 1.0
+MIN_RETRY_AFTER = 0.1
+
+def admit(device, name, waiting, max_queue, max_per_device, hold_time=None):
+    """
+    Admit a request of class name to a device queue already holding waiting requests
+
+    Raises DeviceBusyError once the class's share of max_queue is taken,
+    with a retry hint of about the time everyone queued ahead needs a
+    connection for (hold_time seconds each, over max_per_device connections).
+    """
+    if waiting < max_queue * ADMISSION_SHARE[name]:
+        return
+    admission_rejected_total.inc(device, name)
+    hold_time = DEFAULT_HOLD_TIME if hold_time is None else hold_time
+    retry_after = max(MIN_RETRY_AFTER, hold_time * (waiting + 1) / max_per_device)
+    raise DeviceBusyError(f"Too many requests queued for {device}", round(retry_after, 3))
+
+
+def smoothed_hold_time(previous, elapsed):
+    """New hold time estimate of a device after a connection was held for elapsed seconds"""
+    return elapsed if previous is None else previous + HOLD_TIME_ALPHA * (elapsed - previous)
+
+
+class ConnectionPool:
+    """Process-wide pool of persistent Modbus TCP connections keyed by (host, port)"""
+
+    def __init__(self, max_per_device=4, idle_timeout=60.0, acquire_timeout=10.0, max_queue=32):
+        """
+        Create a connection pool
+
+        Args:
+            max_per_device (int): Maximum open connections per (host, port)
+            idle_timeout (float): Seconds an unused connection is kept before it is closed
+            acquire_timeout (float): Seconds to wait for a free connection when a device is at its limit
+            max_queue (int): Requests allowed to wait for a device before new ones are turned away
+        """
+        self.max_per_device = max_per_device
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.max_queue = max_queue
+        self._idle = {}     # (host, port) -> list of (controller, released_at)
+        self._in_use = {}   # (host, port) -> number of checked out controllers
+        self._queues = {}   # (host, port) -> FairQueue of requests waiting for a connection
+        self._hold_times = {}  # (host, port) -> smoothed seconds a connection is held
+        self._pipelined = {}  # (host, port) -> in-flight window for pipelined devices
+        self._shared = {}     # (host, port) -> shared PipelinedModbusController
+        self._cond = threading.Condition()
+        # Set by the shard pool: (host, port, timeout) -> stand-in controller of a
+        # device another process owns, or None for devices served from here
+        self.remote = None
+
+    def enable_pipelining(self, host, port=502, window=8):
+        """
+        Serve a device over one shared pipelined connection
+
+        Every caller gets the same PipelinedModbusController, and up to
+        window requests from all of them are in flight on its socket at once.
+        Only enable this for devices or gateways that accept several
+        outstanding requests per connection.
+        """
+        if not isinstance(window, int) or window < 1:
+            raise ModbusError("Pipeline window must be a positive integer")
+        key = (host, port)
+        with self._cond:
+            if self._pipelined.get(key) == window:
+                return
+            self._pipelined[key] = window
+            shared = self._shared.pop(key, None)
+        if shared is not None:
+            shared.close()
+
+    def configure_pipelining(self, spec):
+        """Enable pipelining from a "host:port=window,host:port" list (window defaults to 8)"""
+        for entry in (spec or '').split(','):
+            if entry.strip():
+                address, _, window = entry.strip().partition('=')
+                host, _, port = address.rpartition(':')
+                self.enable_pipelining(host, int(port), int(window) if window else 8)
+
+    def disable_pipelining(self, host, port=502):
+        """Go back to exclusive pooled connections for a device"""
+        key = (host, port)
+        with self._cond:
+            self._pipelined.pop(key, None)
+            shared = self._shared.pop(key, None)
+        if shared is not None:
+            shared.close()
+
+    def is_pipelined(self, host, port=502):
+        """Check whether a device is served over a shared pipelined connection"""
+        with self._cond:
+            return (host, port) in self._pipelined
+
+    def acquire(self, host, port=502, timeout=30):
+        """
+        Borrow a connected controller for a device
+
+        Idle connections are reused (most recently used first) and health
+        checked before they are handed out; broken sockets are reconnected.
+        A new connection is only opened when no idle one exists and the
+        device is below its connection limit.
+
+        When the device is at its limit, requests wait in a per-device fair
+        queue: each priority class (see priority_classes) gets free
+        connections in proportion to its weight. Once the queue holds its
+        class's share of max_queue, a request fails fast with
+        DeviceBusyError, whose retry_after estimates when to try again.
+
+        Fails fast with CircuitOpenError while the device's circuit breaker
+        is open, and shortens timeout to the device's adaptive timeout once
+        enough round trips have been observed.
+        """
+        key = (host, port)
+        device = f"{host}:{port}"
+        error = device_health.check(device, timeout)
+        if error is not None:
+            raise CircuitOpenError(error)
+        timeout = device_health.timeout(device, timeout)
+        deadline = time.monotonic() + self.acquire_timeout
+        controller = None
+
+        with self._cond:
+            window = self._pipelined.get(key)
+            if window is not None:
+                controller = self._shared.get(key)
+        if window is not None:
+            return controller or self._open_shared(key, window, timeout)
+
+        with self._cond:
+            self._evict_idle_locked()
+            queue = self._queues.get(key)
+            if queue or not self._has_free_locked(key):
+                controller = self._wait_in_queue_locked(key, deadline)
+            else:
+                idle = self._idle.get(key)
+                controller = idle.pop()[0] if idle else None
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+
+        # Connect and health check outside the lock so a slow device
+        # doesn't block borrowers of other devices
+        try:
+            if controller is None:
+                controller = ModbusController(host, port, timeout)
+            else:
+                controller.set_timeout(timeout)
+                if not controller.is_healthy():
+                    controller.reconnect()
+        except Exception:
+            if controller is not None:
+                controller.close()
+            self._release_slot(key)
+            raise
+
+        return controller
+
+    def release(self, controller, broken=False):
+        """Return a borrowed controller; broken connections are closed instead of reused"""
+        key = (controller.host, controller.port)
+        if isinstance(controller, PipelinedModbusController):
+            # Shared connections stay open for the other callers: the reader
+            # thread keeps the stream framed even if one caller failed, and a
+            # lost socket is reopened by the next request
+            return
+        if broken or not controller.is_healthy():
+            controller.close()
+            self._release_slot(key)
+            return
+
+        with self._cond:
+            self._idle.setdefault(key, []).append((controller, time.monotonic()))
+            self._in_use[key] -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def connection(self, host, port=502, timeout=30):
+        """
+        Context manager that borrows a controller and returns it to the pool afterwards
+
+        A device owned by another process yields a stand-in whose requests
+        run on that process's pool instead.
+        """
+        remote = self.remote(host, port, timeout) if self.remote else None
+        if remote is not None:
+            yield remote
+            return
+        started = time.monotonic()
+        controller = self.acquire(host, port, timeout)
+        acquired = time.monotonic()
+        broken = False
+        try:
+            yield controller
+        except ModbusError:
+            # Device-level errors leave the socket usable; release() still
+            # health checks it in case the request timed out mid-response
+            raise
+        except Exception:
+            broken = True
+            raise
+        finally:
+            self.release(controller, broken)
+            finished = time.monotonic()
+            class_latency_seconds.observe(finished - started, current_class())
+            self._record_hold_time((host, port), finished - acquired)
+
+    def check(self, host, port=502, timeout=30):
+        """Make sure a device is reachable, leaving its connection in the pool (raises ModbusError)"""
+        remote = self.remote(host, port, timeout) if self.remote else None
+        if remote is not None:
+            remote.connect()
+            return
+        with self.connection(host, port, timeout):
+            pass
+
+    def warm(self, devices, timeout=5, max_workers=32):
+        """
+        Open a connection to each device in parallel, leaving it idle in the pool
+
+        Args:
+            devices: (host, port) pairs
+            timeout (float): Connect timeout per device
+
+        Returns:
+            {"host:port": error message or None}
+        """
+        def connect(device):
+            try:
+                self.check(device[0], device[1], timeout)
+                return None
+            except Exception as e:
+                return str(e)
+
+        devices = sorted(set(devices))
+        if not devices:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(devices)),
+                                thread_name_prefix='modbus-warm') as executor:
+            errors = list(executor.map(connect, devices))
+        return {f"{host}:{port}": error for (host, port), error in zip(devices, errors)}
+
+    def close_all(self):
+        """Close every idle connection (borrowed connections are closed on release)"""
+        with self._cond:
+            idle, self._idle = self._idle, {}
+            shared, self._shared = self._shared, {}
+        for entries in idle.values():
+            for controller, _ in entries:
+                controller.close()
+        for controller in shared.values():
+            controller.close()
+
+    def stats(self):
+        """Return the number of idle and in-use connections per device"""
+        with self._cond:
+            keys = set(self._idle) | set(self._in_use)
+            stats = {
+                f"{host}:{port}": {
+                    "idle": len(self._idle.get((host, port), [])),
+                    "in_use": self._in_use.get((host, port), 0)
+                }
+                for host, port in keys
+            }
+            for (host, port), window in self._pipelined.items():
+                shared = self._shared.get((host, port))
+                stats[f"{host}:{port}"] = {
+                    "pipeline_window": window,
+                    "in_flight": shared.connection.in_flight() if shared and shared.is_healthy() else 0
+                }
+            return stats
+
+    def _open_shared(self, key, window, timeout):
+        """Open the shared pipelined connection for a device (outside the lock)"""
+        controller = PipelinedModbusController(key[0], key[1], timeout, window)
+        with self._cond:
+            current = self._shared.get(key)
+            if current is None and self._pipelined.get(key) == window:
+                self._shared[key] = controller
+                return controller
+        # Another caller opened it first (or pipelining was reconfigured)
+        controller.close()
+        return current or self.acquire(key[0], key[1], timeout)
+
+    def queue_depths(self):
+        """Requests waiting for a connection per device and priority class"""
+        with self._cond:
+            return {f"{host}:{port}": queue.depths() for (host, port), queue in self._queues.items()}
+
+    def _has_free_locked(self, key):
+        return bool(self._idle.get(key)) or self._in_use.get(key, 0) < self.max_per_device
+
+    def _wait_in_queue_locked(self, key, deadline):
+        """
+        Wait in the device's fair queue until a connection is free (caller holds the lock)
+
+        Returns:
+            An idle controller, or None if a new connection may be opened
+        """
+        device = f"{key[0]}:{key[1]}"
+        name = current_class()
+        queue = self._queues.get(key)
+        admit(device, name, len(queue) if queue else 0, self.max_queue, self.max_per_device,
+              self._hold_times.get(key))
+
+        queue = self._queues.setdefault(key, FairQueue())
+        entry = queue.push(name)
+        started = time.monotonic()
+        served = False
+        try:
+            while True:
+                if queue.head() is entry and self._has_free_locked(key):
+                    served = True
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ModbusError(f"Timed out waiting for a free connection to {device}")
+                self._cond.wait(remaining)
+        finally:
+            queue.pop(entry, served)
+            if not queue:
+                del self._queues[key]
+            # The next waiter may be able to go now
+            self._cond.notify_all()
+        queue_wait_seconds.observe(time.monotonic() - started, name)
+        idle = self._idle.get(key)
+        return idle.pop()[0] if idle else None
+
+    def _record_hold_time(self, key, elapsed):
+        with self._cond:
+            self._hold_times[key] = smoothed_hold_time(self._hold_times.get(key), elapsed)
+
+    def _release_slot(self, key):
+        """Give back a connection slot without returning a controller"""
+        with self._cond:
+            self._in_use[key] -= 1
+            self._cond.notify_all()
+
+    def _evict_idle_locked(self):
+        """Close idle connections older than idle_timeout (caller holds the lock)"""
+        cutoff = time.monotonic() - self.idle_timeout
+        for key in list(self._idle):
+            entries = self._idle[key]
+            fresh = []
+            for controller, released_at in entries:
+                if released_at < cutoff:
+                    controller.close()
+                else:
+                    fresh.append((controller, released_at))
+            if fresh:
+                self._idle[key] = fresh
+            else:
+                del self._idle[key]
+
+
+# Shared pool used by all API routes
+connection_pool = ConnectionPool()
+
+metrics.callback('modbus_pool_connections', 'Pooled Modbus connections by device and state '
+                 '(idle, in_use, or in_flight requests on pipelined devices)', ('device', 'state'),
+                 lambda: {(device, state): value for device, counts in connection_pool.stats().items()
+                          for state, value in counts.items() if state != 'pipeline_window'})
+metrics.callback('modbus_device_queue_depth', 'Requests waiting for a device connection by priority class',
+                 ('device', 'class'),
+                 lambda: {(device, name): depth for device, depths in connection_pool.queue_depths().items()
+                          for name, depth in depths.items()})
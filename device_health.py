@@ -0,0 +1,183 @@
+import threading
+import time
+from collections import deque
+from metrics import errors_total, metrics
+
+# Error codes (see metrics.errors_total) meaning the device did not answer at all.
+# Modbus exception responses prove the device is alive and don't trip the breaker.
+UNREACHABLE_CODES = ('no_response', 'timeout', 'connection', 'connect')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+def _percentile(ordered, q):
+    """Nearest-rank percentile of a sorted list"""
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+class DeviceHealth:
+    """
+    Round-trip statistics and circuit breaker state for one device
+
+    After failure_threshold consecutive unanswered requests the circuit
+    opens and callers fail fast with the last error. Once the backoff
+    has passed, one caller is let through as a probe: success closes the
+    circuit, failure reopens it with the backoff doubled.
+    """
+
+    def __init__(self, device, registry):
+        self.device = device
+        self.registry = registry
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.failures = 0
+        self.rejected = 0
+        self.last_error = None
+        self.backoff = 0.0
+        self.retry_at = 0.0
+        self._rtts = deque(maxlen=registry.rtt_samples)
+        self._new_samples = 0
+        self._adaptive_timeout = None
+        self._lock = threading.Lock()
+
+    def check(self, timeout):
+        """Return the error to fail fast with while the circuit is open, or None to go ahead"""
+        now = time.monotonic()
+        with self._lock:
+            if self.state == CLOSED or now >= self.retry_at:
+                if self.state != CLOSED:
+                    # Let this caller probe; others keep failing fast until it
+                    # reports back or its request should have timed out
+                    self.state = HALF_OPEN
+                    self.retry_at = now + timeout
+                return None
+            self.rejected += 1
+            return (f"Circuit open for {self.device} after {self.consecutive_failures} failed requests, "
+                    f"retrying in {self.retry_at - now:.1f}s. Last error: {self.last_error}")
+
+    def timeout(self, requested):
+        """Timeout to use: requested, capped at a multiple of the observed p99 round-trip time"""
+        with self._lock:
+            adaptive = self._adaptive_timeout
+        return requested if adaptive is None else min(requested, adaptive)
+
+    def record(self, elapsed=None, code=None, error=None):
+        """Record the outcome of one request (code is None or a Modbus exception name on success)"""
+        registry = self.registry
+        with self._lock:
+            if code in UNREACHABLE_CODES:
+                self.failures += 1
+                self.consecutive_failures += 1
+                self.last_error = error or code
+                if self.state == HALF_OPEN:
+                    self.backoff = min(self.backoff * 2, registry.max_backoff)
+                elif self.consecutive_failures >= registry.failure_threshold and self.state == CLOSED:
+                    self.backoff = registry.base_backoff
+                else:
+                    return
+                self.state = OPEN
+                self.retry_at = time.monotonic() + self.backoff
+                return
+
+            self.state = CLOSED
+            self.consecutive_failures = 0
+            self.backoff = 0.0
+            if elapsed is not None:
+                self._rtts.append(elapsed)
+                self._new_samples += 1
+                # Re-derive the timeout every few samples rather than on every request
+                if self._new_samples >= 10 and len(self._rtts) >= registry.min_samples:
+                    self._new_samples = 0
+                    p99 = _percentile(sorted(self._rtts), 99)
+                    self._adaptive_timeout = max(registry.min_timeout, p99 * registry.timeout_multiplier)
+
+    def status(self):
+        """Return breaker state, failure counts, round-trip percentiles and the adaptive timeout"""
+        with self._lock:
+            ordered = sorted(self._rtts)
+            status = {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "last_error": self.last_error,
+                "retry_in": round(max(0.0, self.retry_at - time.monotonic()), 3) if self.state == OPEN else None,
+                "timeout": self._adaptive_timeout
+            }
+        status["rtt_ms"] = {
+            "p50": round(_percentile(ordered, 50) * 1000, 3),
+            "p99": round(_percentile(ordered, 99) * 1000, 3)
+        } if ordered else None
+        return status
+
+
+class DeviceHealthRegistry:
+    """Per-device health shared by every controller and connection pool, keyed by host:port"""
+
+    def __init__(self, failure_threshold=3, base_backoff=1.0, max_backoff=60.0, min_timeout=1.0,
+                 timeout_multiplier=4.0, rtt_samples=200, min_samples=20):
+        """
+        Create a registry
+
+        Args:
+            failure_threshold (int): Consecutive unanswered requests that open a device's circuit
+            base_backoff (float): Seconds before the first probe of an open circuit
+            max_backoff (float): Upper limit of the doubling probe backoff
+            min_timeout (float): Lower limit of adaptive timeouts
+            timeout_multiplier (float): Adaptive timeout as a multiple of the p99 round-trip time
+            rtt_samples (int): Round-trip times kept per device
+            min_samples (int): Samples needed before timeouts are adapted
+        """
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.min_timeout = min_timeout
+        self.timeout_multiplier = timeout_multiplier
+        self.rtt_samples = rtt_samples
+        self.min_samples = min_samples
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def get(self, device):
+        """Return the health entry of a device, creating it on first use"""
+        health = self._devices.get(device)
+        if health is None:
+            with self._lock:
+                health = self._devices.setdefault(device, DeviceHealth(device, self))
+        return health
+
+    def check(self, device, timeout):
+        """Return the fail-fast error for a device whose circuit is open, or None"""
+        error = self.get(device).check(timeout)
+        if error is not None:
+            errors_total.inc(device, 'circuit_open')
+        return error
+
+    def timeout(self, device, requested):
+        """Return the timeout to use for a device"""
+        return self.get(device).timeout(requested)
+
+    def record(self, device, elapsed=None, code=None, error=None):
+        """Record the outcome of one request to a device"""
+        self.get(device).record(elapsed, code, error)
+
+    def status(self, device):
+        """Return the health of a device, or None if it was never used"""
+        health = self._devices.get(device)
+        return health.status() if health is not None else None
+
+    def states(self):
+        """Return the breaker state of every known device"""
+        with self._lock:
+            devices = list(self._devices.values())
+        return {health.device: health.state for health in devices}
+
+
+# Shared registry fed by the controllers and consulted by the connection pools
+device_health = DeviceHealthRegistry()
+
+metrics.callback('modbus_circuit_state', 'Circuit breaker state per device (0 closed, 1 half open, 2 open)',
+                 ('device',), lambda: {(device,): _STATE_VALUES[state]
+                                       for device, state in device_health.states().items()})
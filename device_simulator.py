@@ -0,0 +1,461 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import struct
+import sys
+import time
+from array import array
+from register_codec import CodecError, encode_values, pack_bits, parse_data_type, unpack_bits
+
+# Load-test simulator: many virtual Modbus TCP devices in one asyncio process.
+#
+# Every device listens on its own port and answers for one or more unit
+# IDs. Register maps can hold time-varying signals, and each device can
+# inject latency, jitter, exception responses, unanswered requests and
+# dropped connections. Run from a JSON/YAML file or from the command line:
+#
+#   python3 device_simulator.py --devices 200 --base-port 6000 --latency 0.01 --jitter 0.005
+#   python3 device_simulator.py --config plant.json
+
+log = logging.getLogger(__name__)
+
+_MBAP = struct.Struct('>HHHB')
+
+READ_FUNCTIONS = {3: 'holding', 4: 'input'}
+READ_BIT_FUNCTIONS = {1: 'coil', 2: 'discrete'}
+MAX_READ_REGISTERS = 125
+MAX_READ_BITS = 2000
+MAX_WRITE_BITS = 1968
+
+ILLEGAL_FUNCTION = 1
+ILLEGAL_ADDRESS = 2
+ILLEGAL_VALUE = 3
+SLAVE_BUSY = 6
+GATEWAY_NO_RESPONSE = 11
+
+# Clamp ranges so signals never overflow their integer data type
+_INTEGER_RANGES = {
+    'int16': (-2 ** 15, 2 ** 15 - 1),
+    'uint16': (0, 2 ** 16 - 1),
+    'int32': (-2 ** 31, 2 ** 31 - 1),
+    'uint32': (0, 2 ** 32 - 1),
+    'int64': (-2 ** 63, 2 ** 63 - 1),
+    'uint64': (0, 2 ** 64 - 1),
+}
+
+class SimulatorError(ValueError):
+    """Invalid simulator configuration"""
+    pass
+
+
+class Signal:
+    """A time-varying value written into one or more registers on every read"""
+
+    TYPES = ('constant', 'ramp', 'sine', 'noise')
+
+    def __init__(self, config, rng):
+        self.type = config.get('type', 'constant')
+        if self.type not in self.TYPES:
+            raise SimulatorError(f"Unknown signal type: {self.type}. Use one of {', '.join(self.TYPES)}")
+        self.address = config.get('address')
+        if not isinstance(self.address, int) or self.address < 0:
+            raise SimulatorError("Signal 'address' must be a non-negative integer")
+        self.data_type = config.get('data_type', 'int16')
+        try:
+            spec = parse_data_type(self.data_type)
+        except CodecError as e:
+            raise SimulatorError(str(e))
+        if spec.fmt is None or self.data_type == 'bool':
+            raise SimulatorError(f"Signals must use a numeric data type, not {self.data_type}")
+        self.words = spec.words
+        self.is_float = self.data_type.startswith('float')
+
+        self.value = config.get('value', 0)
+        self.min = config.get('min', 0)
+        self.max = config.get('max', 100)
+        self.period = config.get('period', 60.0)
+        self.amplitude = config.get('amplitude', (self.max - self.min) / 2)
+        self.offset = config.get('offset', (self.max + self.min) / 2)
+        self.phase = config.get('phase', 0.0)
+        if self.period <= 0:
+            raise SimulatorError("Signal 'period' must be positive")
+        self._rng = rng
+
+    def registers(self, now):
+        """Encode the signal's value at time now"""
+        if self.type == 'constant':
+            value = self.value
+        elif self.type == 'ramp':
+            value = self.min + (self.max - self.min) * (((now + self.phase) / self.period) % 1.0)
+        elif self.type == 'sine':
+            value = self.offset + self.amplitude * math.sin(2 * math.pi * (now + self.phase) / self.period)
+        else:
+            value = self._rng.uniform(self.min, self.max)
+
+        if not self.is_float:
+            low, high = _INTEGER_RANGES[self.data_type]
+            value = min(high, max(low, int(round(value))))
+        return encode_values(value, self.data_type)
+
+
+class RegisterMap:
+    """One register table (holding or input) of a unit, with its signals"""
+
+    def __init__(self, config, rng):
+        self.size = config.get('size', 100)
+        if not isinstance(self.size, int) or not 0 < self.size <= 65536:
+            raise SimulatorError("Register map 'size' must be between 1 and 65536")
+        default = config.get('default', 'address')
+        if default == 'address':
+            self.registers = array('H', (i & 0xFFFF for i in range(self.size)))
+        else:
+            self.registers = array('H', [default & 0xFFFF]) * self.size
+        for address, value in config.get('values', {}).items():
+            self.registers[int(address)] = value & 0xFFFF
+
+        self.signals = [Signal(signal, rng) for signal in config.get('signals', [])]
+        for signal in self.signals:
+            if signal.address + signal.words > self.size:
+                raise SimulatorError(f"Signal at {signal.address} doesn't fit in {self.size} registers")
+
+    def read(self, address, count, now):
+        """Return count registers starting at address, with signals applied"""
+        for signal in self.signals:
+            if signal.address < address + count and signal.address + signal.words > address:
+                self.registers[signal.address:signal.address + signal.words] = array('H', signal.registers(now))
+        return self.registers[address:address + count]
+
+    def write(self, address, values):
+        """Store register values"""
+        self.registers[address:address + len(values)] = array('H', values)
+
+
+class BitMap:
+    """One bit table (coils or discrete inputs) of a unit"""
+
+    def __init__(self, config):
+        self.size = config.get('size', 100)
+        if not isinstance(self.size, int) or not 0 < self.size <= 65536:
+            raise SimulatorError("Bit map 'size' must be between 1 and 65536")
+        default = config.get('default', 'alternate')
+        if default == 'alternate':
+            self.bits = bytearray(i & 1 for i in range(self.size))
+        else:
+            self.bits = bytearray([1 if default else 0]) * self.size
+        for address, value in config.get('values', {}).items():
+            self.bits[int(address)] = 1 if value else 0
+
+    def read(self, address, count):
+        """Return count bits starting at address"""
+        return self.bits[address:address + count]
+
+    def write(self, address, values):
+        """Store bit values"""
+        self.bits[address:address + len(values)] = bytes(1 if value else 0 for value in values)
+
+
+class VirtualDevice:
+    """A simulated device or gateway on one port, with fault injection"""
+
+    def __init__(self, port, config, seed=None):
+        self.port = port
+        self.rng = random.Random(port if seed is None else seed)
+        self.latency = config.get('latency', 0.0)
+        self.jitter = config.get('jitter', 0.0)
+        self.pipelining = config.get('pipelining', False)
+
+        faults = config.get('faults', {})
+        self.exception_rate = faults.get('exception_rate', 0.0)
+        self.exception_code = faults.get('exception_code', SLAVE_BUSY)
+        self.no_response_rate = faults.get('no_response_rate', 0.0)
+        self.disconnect_rate = faults.get('disconnect_rate', 0.0)
+
+        registers = config.get('registers', {})
+        self.units = {}
+        for unit_id in config.get('unit_ids', [1]):
+            unit = {reg_type: RegisterMap(registers.get(reg_type, {}), self.rng) for reg_type in ('holding', 'input')}
+            unit.update({bit_type: BitMap(registers.get(bit_type, {})) for bit_type in ('coil', 'discrete')})
+            self.units[unit_id] = unit
+        self.stats = {"requests": 0, "exceptions": 0, "no_response": 0, "disconnects": 0}
+
+    def delay(self):
+        """Response delay for one request: latency plus uniform jitter"""
+        if not self.latency and not self.jitter:
+            return 0.0
+        return max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+
+    def fault(self):
+        """Pick the injected fault for one request, if any"""
+        roll = self.rng.random()
+        if roll < self.disconnect_rate:
+            return 'disconnect'
+        roll -= self.disconnect_rate
+        if roll < self.no_response_rate:
+            return 'no_response'
+        roll -= self.no_response_rate
+        if roll < self.exception_rate:
+            return 'exception'
+        return None
+
+    def handle(self, unit_id, pdu, now):
+        """Process a request PDU and return the response PDU"""
+        function_code = pdu[0]
+        unit = self.units.get(unit_id)
+        if unit is None:
+            return _exception(function_code, GATEWAY_NO_RESPONSE)
+
+        try:
+            if function_code in READ_FUNCTIONS:
+                address, count = struct.unpack_from('>HH', pdu, 1)
+                if not 1 <= count <= MAX_READ_REGISTERS:
+                    return _exception(function_code, ILLEGAL_VALUE)
+                table = unit[READ_FUNCTIONS[function_code]]
+                if address + count > table.size:
+                    return _exception(function_code, ILLEGAL_ADDRESS)
+                registers = table.read(address, count, now)
+                if sys.byteorder == 'little':
+                    registers.byteswap()
+                return struct.pack('>BB', function_code, count * 2) + registers.tobytes()
+
+            if function_code in READ_BIT_FUNCTIONS:
+                address, count = struct.unpack_from('>HH', pdu, 1)
+                if not 1 <= count <= MAX_READ_BITS:
+                    return _exception(function_code, ILLEGAL_VALUE)
+                table = unit[READ_BIT_FUNCTIONS[function_code]]
+                if address + count > table.size:
+                    return _exception(function_code, ILLEGAL_ADDRESS)
+                payload = pack_bits(table.read(address, count))
+                return struct.pack('>BB', function_code, len(payload)) + payload
+
+            if function_code == 5:
+                address, value = struct.unpack_from('>HH', pdu, 1)
+                if value not in (0x0000, 0xFF00):
+                    return _exception(function_code, ILLEGAL_VALUE)
+                table = unit['coil']
+                if address >= table.size:
+                    return _exception(function_code, ILLEGAL_ADDRESS)
+                table.write(address, [value])
+                return pdu[:5]
+
+            if function_code == 15:
+                address, count, byte_count = struct.unpack_from('>HHB', pdu, 1)
+                if not 1 <= count <= MAX_WRITE_BITS or byte_count != (count + 7) // 8 or len(pdu) < 6 + byte_count:
+                    return _exception(function_code, ILLEGAL_VALUE)
+                table = unit['coil']
+                if address + count > table.size:
+                    return _exception(function_code, ILLEGAL_ADDRESS)
+                table.write(address, unpack_bits(pdu[6:6 + byte_count], count))
+                return pdu[:5]
+
+            if function_code == 6:
+                address, value = struct.unpack_from('>HH', pdu, 1)
+                table = unit['holding']
+                if address >= table.size:
+                    return _exception(function_code, ILLEGAL_ADDRESS)
+                table.write(address, [value])
+                return pdu[:5]
+
+            if function_code == 16:
+                address, count, byte_count = struct.unpack_from('>HHB', pdu, 1)
+                if not 1 <= count <= 123 or byte_count != count * 2:
+                    return _exception(function_code, ILLEGAL_VALUE)
+                table = unit['holding']
+                if address + count > table.size:
+                    return _exception(function_code, ILLEGAL_ADDRESS)
+                table.write(address, struct.unpack_from(f'>{count}H', pdu, 6))
+                return pdu[:5]
+        except struct.error:
+            return _exception(function_code, ILLEGAL_VALUE)
+
+        return _exception(function_code, ILLEGAL_FUNCTION)
+
+
+def _exception(function_code, code):
+    """Build an exception response PDU"""
+    return bytes((function_code | 0x80, code))
+
+
+class DeviceSimulator:
+    """Runs a set of VirtualDevices in one event loop"""
+
+    def __init__(self, config):
+        """
+        Build the virtual devices
+
+        Args:
+            config (dict): {"host": ..., "devices": [device config, ...]}; a
+                           device config with "count" N is repeated on N
+                           consecutive ports starting at "port"
+
+        Raises:
+            SimulatorError: For invalid configuration
+        """
+        self.host = config.get('host', '127.0.0.1')
+        self.devices = []
+        for device_config in config.get('devices', []):
+            port = device_config.get('port')
+            if not isinstance(port, int):
+                raise SimulatorError("Every device needs a 'port'")
+            for offset in range(device_config.get('count', 1)):
+                self.devices.append(VirtualDevice(port + offset, device_config))
+        if not self.devices:
+            raise SimulatorError("No devices configured")
+        ports = [device.port for device in self.devices]
+        if len(set(ports)) != len(ports):
+            raise SimulatorError("Devices must not share ports")
+        self._servers = []
+
+    async def start(self):
+        """Start listening on every device's port"""
+        for device in self.devices:
+            server = await asyncio.start_server(
+                lambda reader, writer, device=device: self._serve(device, reader, writer),
+                self.host, device.port)
+            self._servers.append(server)
+        log.info(f"Simulating {len(self.devices)} devices on {self.host}:"
+                 f"{self.devices[0].port}-{self.devices[-1].port}")
+
+    async def serve_forever(self):
+        """Start the devices and serve until cancelled"""
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop listening"""
+        for server in self._servers:
+            server.close()
+        self._servers = []
+
+    def stats(self):
+        """Request and fault counts per port"""
+        return {device.port: dict(device.stats) for device in self.devices}
+
+    async def _serve(self, device, reader, writer):
+        """Read request frames from one client connection"""
+        pending = set()
+        try:
+            while True:
+                tid, _, length, unit_id = _MBAP.unpack(await reader.readexactly(_MBAP.size))
+                pdu = await reader.readexactly(length - 1)
+                if device.pipelining:
+                    # Requests are answered as they complete, possibly out of order
+                    task = asyncio.ensure_future(self._respond(device, writer, tid, unit_id, pdu))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                elif not await self._respond(device, writer, tid, unit_id, pdu):
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in pending:
+                task.cancel()
+            writer.close()
+
+    async def _respond(self, device, writer, tid, unit_id, pdu):
+        """Answer one request; returns False if the connection was dropped"""
+        device.stats["requests"] += 1
+        delay = device.delay()
+        if delay:
+            await asyncio.sleep(delay)
+
+        fault = device.fault()
+        if fault == 'disconnect':
+            device.stats["disconnects"] += 1
+            writer.transport.abort()
+            return False
+        if fault == 'no_response':
+            device.stats["no_response"] += 1
+            return True
+        if fault == 'exception':
+            device.stats["exceptions"] += 1
+            response = _exception(pdu[0], device.exception_code)
+        else:
+            response = device.handle(unit_id, pdu, time.time())
+
+        if not writer.is_closing():
+            writer.write(_MBAP.pack(tid, 0, len(response) + 1, unit_id) + response)
+        return True
+
+
+def load_config(path):
+    """Read a simulator configuration from a .json, .yaml or .yml file"""
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise SimulatorError("PyYAML is required for YAML simulator configuration files (pip install pyyaml)")
+            return yaml.safe_load(f) or {}
+        return json.load(f)
+
+
+def config_from_args(args):
+    """Build a configuration of identical devices from command line options"""
+    registers = {
+        "size": args.registers,
+        "default": "address",
+        "signals": [
+            {"address": 0, "type": "ramp", "min": 0, "max": 1000, "period": 60},
+            {"address": 1, "type": "sine", "amplitude": 100, "offset": 500, "period": 30},
+            {"address": 2, "type": "noise", "min": 0, "max": 50}
+        ] if args.registers >= 3 else []
+    }
+    return {
+        "host": args.host,
+        "devices": [{
+            "port": args.base_port,
+            "count": args.devices,
+            "unit_ids": [int(unit) for unit in args.unit_ids.split(',')],
+            "registers": {"holding": registers, "input": registers,
+                          "coil": {"size": args.registers}, "discrete": {"size": args.registers}},
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "pipelining": args.pipelining,
+            "faults": {
+                "exception_rate": args.exception_rate,
+                "exception_code": args.exception_code,
+                "no_response_rate": args.no_response_rate,
+                "disconnect_rate": args.disconnect_rate
+            }
+        }]
+    }
+
+
+def run_simulator(config):
+    """Run a simulator until interrupted (blocking)"""
+    simulator = DeviceSimulator(config)
+    try:
+        asyncio.run(simulator.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate many Modbus TCP devices in one process")
+    parser.add_argument('--config', help="JSON/YAML device configuration (overrides the options below)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--devices', type=int, default=10, help="Number of devices, one port each")
+    parser.add_argument('--base-port', type=int, default=5020, help="Port of the first device")
+    parser.add_argument('--unit-ids', default='1', help="Comma separated unit IDs served by every device")
+    parser.add_argument('--registers', type=int, default=1000, help="Holding and input registers per unit")
+    parser.add_argument('--latency', type=float, default=0.0, help="Response latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Uniform +/- jitter added to the latency")
+    parser.add_argument('--pipelining', action='store_true',
+                        help="Answer several outstanding requests per connection concurrently")
+    parser.add_argument('--exception-rate', type=float, default=0.0, help="Fraction of requests answered with an exception")
+    parser.add_argument('--exception-code', type=int, default=SLAVE_BUSY, help="Exception code to inject")
+    parser.add_argument('--no-response-rate', type=float, default=0.0, help="Fraction of requests never answered")
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help="Fraction of requests that drop the connection")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    run_simulator(load_config(args.config) if args.config else config_from_args(args))
@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import deque
+from metrics import metrics, stream_dropped_total
+
+# Subscriber buffer sizes (events), and how often idle streams send a keepalive
+DEFAULT_BUFFER = 256
+MAX_BUFFER = 10000
+KEEPALIVE_INTERVAL = 15.0
+
+class Subscription:
+    """
+    One client's view of a task's samples
+
+    The buffer is bounded: when the client falls behind, the oldest events
+    are dropped and counted, so publishing never waits for a reader.
+    """
+
+    def __init__(self, task_id, tags=None, changes_only=False, buffer_size=DEFAULT_BUFFER):
+        self.task_id = task_id
+        self.tags = set(tags) if tags else None
+        self.changes_only = changes_only
+        self.closed = False
+        self._events = deque(maxlen=buffer_size)
+        self._dropped = 0
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+    def wants(self, tag, changed):
+        return (self.tags is None or tag in self.tags) and (changed or not self.changes_only)
+
+    def push(self, event):
+        """Queue an event, dropping the oldest one if the buffer is full"""
+        with self._lock:
+            if len(self._events) == self._events.maxlen:
+                self._dropped += 1
+                stream_dropped_total.inc()
+            self._events.append(event)
+        self._ready.set()
+
+    def close(self):
+        """Mark the stream finished (the task stopped); readers drain what is left"""
+        self.closed = True
+        self._ready.set()
+
+    def wait(self, timeout=KEEPALIVE_INTERVAL):
+        """
+        Block until events arrive, the stream closes or the timeout passes
+
+        Returns:
+            (events, number of events dropped since the last call)
+        """
+        self._ready.wait(timeout)
+        with self._lock:
+            events = list(self._events)
+            self._events.clear()
+            dropped, self._dropped = self._dropped, 0
+            self._ready.clear()
+        if self.closed:
+            # Don't lose a close that raced with clearing the flag
+            self._ready.set()
+        return events, dropped
+
+
+class StreamHub:
+    """Fans each sample of a continuous task out to its live subscribers"""
+
+    def __init__(self):
+        self._subscribers = {}  # task_id -> [Subscription]
+        self._last = {}         # task_id -> {tag: (value, error)}
+        self._sequence = {}     # task_id -> id of the last published event
+        self._lock = threading.Lock()
+
+    def subscribe(self, task_id, tags=None, changes_only=False, buffer_size=DEFAULT_BUFFER):
+        """
+        Register a subscriber to a task's samples
+
+        Args:
+            task_id: Task identifier
+            tags (list): Only receive these tags (default: all)
+            changes_only (bool): Only receive samples whose value or error changed
+            buffer_size (int): Events kept for the subscriber before the oldest are dropped
+
+        Returns:
+            The Subscription to read events from
+        """
+        subscription = Subscription(task_id, tags, changes_only, buffer_size)
+        with self._lock:
+            self._subscribers.setdefault(task_id, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.task_id, [])
+            if subscription in subscribers:
+                subscribers.remove(subscription)
+            if not subscribers:
+                self._subscribers.pop(subscription.task_id, None)
+
+    def publish(self, task_id, tag, value=None, error=None, timestamp=None, changed=None):
+        """
+        Send a poll result to the task's subscribers; never blocks on a slow reader
+
+        Args:
+            changed (bool): Whether the sample is significant (e.g. from the task's
+                deadband filter); by default, whether it differs from the previous one
+        """
+        timestamp = timestamp if timestamp is not None else time.time()
+        with self._lock:
+            last = self._last.setdefault(task_id, {})
+            if changed is None:
+                changed = last.get(tag) != (value, error)
+            last[tag] = (value, error)
+            subscribers = self._subscribers.get(task_id)
+            if not subscribers:
+                return
+            subscribers = list(subscribers)
+            sequence = self._sequence[task_id] = self._sequence.get(task_id, 0) + 1
+
+        event = {"id": sequence, "tag": tag, "timestamp": timestamp}
+        if error is None:
+            event["value"] = value
+        else:
+            event["error"] = error
+        for subscription in subscribers:
+            if subscription.wants(tag, changed):
+                subscription.push(event)
+
+    def close(self, task_id):
+        """End every stream of a stopped task"""
+        with self._lock:
+            subscribers = self._subscribers.pop(task_id, [])
+            self._last.pop(task_id, None)
+            self._sequence.pop(task_id, None)
+        for subscription in subscribers:
+            subscription.close()
+
+    def subscriber_count(self, task_id=None):
+        """Number of subscribers of a task, or of all tasks"""
+        with self._lock:
+            if task_id is not None:
+                return len(self._subscribers.get(task_id, ()))
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+# Shared hub fed by continuous tasks and read by the stream endpoint
+stream_hub = StreamHub()
+
+metrics.callback('modbus_stream_subscribers', 'Clients subscribed to live task streams', (),
+                 stream_hub.subscriber_count)
@@ -0,0 +1,246 @@
+import threading
+from bisect import bisect_left
+
+# Histogram buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DECODE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01)
+
+def _escape(value):
+    """Escape a label value for the text exposition format"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    """Format a label set as {a="1",b="2"}"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _with_label(sample, label):
+    """Add a label to a rendered sample line"""
+    name, _, rest = sample.rpartition(' ')
+    if name.endswith('}'):
+        return f"{name[:-1]},{label}}} {rest}"
+    return f"{name}{{{label}}} {rest}"
+
+
+def _number(value):
+    """Format a sample value"""
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    """Monotonic counter with optional labels"""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # A counter without labels is exported as 0 before its first increment
+        self._values = {} if self.labelnames else {(): 0}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        """Add amount to the series with these label values"""
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}" for labels, value in values]
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets
+
+    An observation is one bisect and one short locked update, cheap
+    enough for every Modbus request.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [per-bucket counts (last is +Inf), sum]
+        if not self.labelnames:
+            self._series[()] = [[0] * (len(self.buckets) + 1), 0.0]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        """Record one observation for the series with these label values"""
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def collect(self):
+        with self._lock:
+            snapshot = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+
+        lines = []
+        for labels, counts, total in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    """Gauge (or counter) whose samples are read from live objects at scrape time"""
+
+    def __init__(self, name, help, labelnames, callback, type='gauge'):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self.type = type
+
+    def collect(self):
+        samples = self.callback()
+        if not isinstance(samples, dict):
+            samples = {(): samples}
+        return [f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+                for labels, value in samples.items()]
+
+
+class MetricsRegistry:
+    """Set of metrics rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name, help, labelnames, callback, type='gauge'):
+        """
+        Register a metric computed at scrape time
+
+        Args:
+            callback (callable): Returns a number, or a dict of label value tuple -> number
+        """
+        return self._add(CallbackMetric(name, help, labelnames, callback, type))
+
+    def families(self):
+        """Return the (name, help, type, sample lines) of every metric"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        families = []
+        for metric in metrics:
+            try:
+                samples = metric.collect()
+            except Exception:
+                # A failing collector must not break the whole scrape
+                continue
+            families.append((metric.name, metric.help, metric.type, samples))
+        return families
+
+    def render(self, remote=()):
+        """
+        Return every metric in the Prometheus text exposition format (version 0.0.4)
+
+        Args:
+            remote: (shard, families) pairs from worker processes; their samples
+                are added to the local ones with a shard label
+        """
+        extra = {}
+        for shard, families in remote:
+            for name, help, type, samples in families:
+                extra.setdefault(name, (help, type, []))[2].extend(
+                    _with_label(sample, f'shard="{_escape(shard)}"') for sample in samples)
+
+        lines = []
+        for name, help, type, samples in self.families():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            lines.extend(samples)
+            lines.extend(extra.pop(name, (None, None, []))[2])
+        for name, (help, type, samples) in extra.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+
+# Shared registry served on /metrics
+metrics = MetricsRegistry()
+
+# Modbus I/O, recorded by the controllers
+request_seconds = metrics.histogram(
+    'modbus_request_duration_seconds', 'Round-trip time of Modbus requests', ('device', 'function'))
+connect_seconds = metrics.histogram(
+    'modbus_connect_duration_seconds', 'Time taken to open Modbus TCP connections', ('device',))
+decode_seconds = metrics.histogram(
+    'modbus_decode_duration_seconds', 'Time taken to decode register blocks', ('data_type',), DECODE_BUCKETS)
+errors_total = metrics.counter(
+    'modbus_errors_total', 'Failed Modbus requests by device and error code (Modbus exception name, '
+                           'no_response, timeout, connection, connect or circuit_open)', ('device', 'code'))
+
+# Scheduler, recorded by the polling scheduler
+scheduler_lag_seconds = metrics.histogram(
+    'modbus_scheduler_lag_seconds', 'Delay between the scheduled and actual start of continuous polls')
+scheduler_overruns_total = metrics.counter(
+    'modbus_scheduler_overruns_total', 'Poll ticks skipped because the previous run was still in progress or late')
+poll_failures_total = metrics.counter(
+    'modbus_poll_failures_total', 'Failed operations of continuous polls by device, whatever the cause', ('device',))
+
+# Live task streams
+stream_dropped_total = metrics.counter(
+    'modbus_stream_dropped_events_total', 'Samples dropped because a stream subscriber fell behind')
+
+# Write queue, recorded by the per-device write queues
+queued_writes_total = metrics.counter(
+    'modbus_queued_writes_total', 'Writes submitted to the write queues by result (written, unchanged or failed)',
+    ('result',))
+write_requests_total = metrics.counter(
+    'modbus_write_requests_total', 'Modbus write requests sent by the write queues after merging')
+
+# Webhook spools, recorded by the on-disk segment logs
+spool_dropped_bytes_total = metrics.counter(
+    'modbus_spool_dropped_bytes_total', 'Undelivered spool data deleted to stay within the disk budget')
+
+# Serial gateways, recorded by the bus arbiters
+bus_wait_seconds = metrics.histogram(
+    'modbus_bus_wait_seconds', 'Time requests waited for a serial gateway bus by priority class', ('gateway', 'class'))
+
+# Device queues, recorded by the connection pool
+queue_wait_seconds = metrics.histogram(
+    'modbus_queue_wait_seconds', 'Time requests waited for a device connection by priority class', ('class',))
+class_latency_seconds = metrics.histogram(
+    'modbus_class_latency_seconds', 'Time from asking for a device connection to giving it back by priority class',
+    ('class',))
+admission_rejected_total = metrics.counter(
+    'modbus_admission_rejected_total', 'Requests turned away because the device queue was saturated',
+    ('device', 'class'))
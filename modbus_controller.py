@@ -1,13 +1,65 @@
 from pymodbus.client import ModbusTcpClient
 from pymodbus.exceptions import ModbusException
-from pymodbus.payload import BinaryPayloadBuilder, BinaryPayloadDecoder
-from pymodbus.constants import Endian
-import struct
+from register_codec import CodecError, decode_bits, decode_registers, encode_values, parse_data_type
+from metrics import connect_seconds, decode_seconds, errors_total, request_seconds
+from device_health import device_health
+from serial_gateway import serial_buses
+import select
+import time
+
+# Modbus exception codes, named as pymodbus reports them
+EXCEPTION_NAMES = {
+    1: 'IllegalFunction',
+    2: 'IllegalAddress',
+    3: 'IllegalValue',
+    4: 'SlaveFailure',
+    5: 'Acknowledge',
+    6: 'SlaveBusy',
+    8: 'MemoryParityError',
+    10: 'GatewayPathUnavailable',
+    11: 'GatewayNoResponse',
+}
+
+# Bit-addressed tables (function codes 1, 2, 5 and 15) and the per-request limits of the protocol
+BIT_TYPES = ('coil', 'discrete')
+MAX_READ_BITS = 2000
+MAX_WRITE_BITS = 1968
+MAX_WRITE_REGISTERS = 123
 
 class ModbusError(Exception):
     """Custom exception for Modbus errors"""
     pass
 
+class CircuitOpenError(ModbusError):
+    """A device's circuit breaker is open, so the request was not sent"""
+    pass
+
+class DeviceBusyError(ModbusError):
+    """A device's request queue is saturated, so the request was turned away"""
+    
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+    
+    def __reduce__(self):
+        # Sent between processes by the shard pool
+        return type(self), (str(self), self.retry_after)
+
+def register_count_for_type(data_type, count=1):
+    """Calculate how many registers are needed for count values of data_type"""
+    try:
+        return parse_data_type(data_type).words * count
+    except CodecError as e:
+        raise ModbusError(str(e))
+
+def error_code(result):
+    """Metric label for a failed pymodbus response: the exception name, or no_response"""
+    code = getattr(result, 'exception_code', None)
+    if code is None:
+        return 'no_response'
+    return EXCEPTION_NAMES.get(code, str(code))
+
+
 class ModbusController:
     """Controller class for Modbus operations with support for different data types"""
     
@@ -15,6 +67,7 @@ class ModbusController:
         self.host = host
         self.port = port
         self.timeout = timeout
+        self.device = f"{host}:{port}"
         self.client = ModbusTcpClient(host=host, port=port, timeout=timeout)
         self.connected = False
         self.connect()
@@ -22,9 +75,14 @@ class ModbusController:
     def connect(self):
         """Connect to the Modbus server"""
         if not self.connected:
+            started = time.perf_counter()
             self.connected = self.client.connect()
+            connect_seconds.observe(time.perf_counter() - started, self.device)
             if not self.connected:
-                raise ModbusError(f"Failed to connect to Modbus server at {self.host}:{self.port}")
+                message = f"Failed to connect to Modbus server at {self.host}:{self.port}"
+                errors_total.inc(self.device, 'connect')
+                device_health.record(self.device, code='connect', error=message)
+                raise ModbusError(message)
         return self.connected
     
     def close(self):
@@ -33,16 +91,43 @@ class ModbusController:
             self.client.close()
             self.connected = False
     
+    def reconnect(self):
+        """Drop the current socket and open a fresh connection"""
+        self.client.close()
+        self.connected = False
+        return self.connect()
+    
+    def set_timeout(self, timeout):
+        """Change the request timeout used by the underlying client"""
+        self.timeout = timeout
+        self.client.comm_params.timeout_connect = timeout
+        if self.client.socket is not None:
+            self.client.socket.settimeout(timeout)
+    
+    def is_healthy(self):
+        """Check that the socket is still open and has not been closed by the peer"""
+        sock = self.client.socket
+        if not self.connected or sock is None:
+            return False
+        try:
+            # An idle Modbus connection should never be readable: readable means
+            # either EOF from the peer or a stale response we can't match any more
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+    
     def read_data(self, reg_type, address, count, slave_id=1, data_type='int16'):
         """
         Read data from Modbus registers
         
         Args:
-            reg_type (str): 'holding' or 'input'
+            reg_type (str): 'holding', 'input', 'coil' or 'discrete'
             address (int): Register start address
-            count (int): Number of registers to read
+            count (int): Number of values to read (bits for coils and discrete inputs)
             slave_id (int): Slave ID
-            data_type (str): Data type to interpret the result
+            data_type (str): Data type to interpret the result (ignored for bits,
+                             which are always returned as bools)
                              Supported types: 
                              - int16, uint16, int32, uint32, int64, uint64
                              - float32, float64
@@ -52,43 +137,126 @@ class ModbusController:
         Returns:
             Data read from registers in the specified format
         """
-        # Ensure connected
-        if not self.connected:
-            self.connect()
+        if reg_type in BIT_TYPES:
+            return self.decode_bits(self.read_bits(reg_type, address, count, slave_id), count)
         
         # Determine how many registers to read based on data type
         registers_to_read = self._get_register_count_for_type(data_type, count)
         
+        # Read registers
+        registers = self.read_registers(reg_type, address, registers_to_read, slave_id)
+        
+        # Decode the result based on data type
+        return self.decode_registers(registers, data_type, count)
+    
+    def read_registers(self, reg_type, address, count, slave_id=1):
+        """
+        Read raw 16-bit register values
+        
+        Args:
+            reg_type (str): 'holding' or 'input'
+            address (int): Register start address
+            count (int): Number of registers to read
+            slave_id (int): Slave ID
+        
+        Returns:
+            List of register values
+        """
+        # Ensure connected
+        if not self.connected:
+            self.connect()
+        
         # Read registers
         if reg_type == 'holding':
-            result = self.client.read_holding_registers(address=address, count=registers_to_read, slave=slave_id)
+            read = self.client.read_holding_registers
         elif reg_type == 'input':
-            result = self.client.read_input_registers(address=address, count=registers_to_read, slave=slave_id)
+            read = self.client.read_input_registers
         else:
-            raise ModbusError(f"Invalid register type: {reg_type}. Use 'holding' or 'input'")
+            raise ModbusError(f"Invalid register type: {reg_type}. Use 'holding', 'input', 'coil' or 'discrete'")
+        result = self._timed('read_' + reg_type, read, address=address, count=count, slave=slave_id)
         
         # Check for errors
         if result.isError():
             raise ModbusError(f"Error reading registers: {result}")
         
-        # Decode the result based on data type
-        return self._decode_registers(result.registers, data_type, count)
+        return result.registers
+    
+    def read_bits(self, reg_type, address, count, slave_id=1):
+        """
+        Read coil or discrete input states
+        
+        Args:
+            reg_type (str): 'coil' or 'discrete'
+            address (int): First bit address
+            count (int): Number of bits to read (at most 2000)
+            slave_id (int): Slave ID
+        
+        Returns:
+            List of bools
+        """
+        if reg_type == 'coil':
+            read = self.client.read_coils
+        elif reg_type == 'discrete':
+            read = self.client.read_discrete_inputs
+        else:
+            raise ModbusError(f"Invalid bit type: {reg_type}. Use 'coil' or 'discrete'")
+        if not 1 <= count <= MAX_READ_BITS:
+            raise ModbusError(f"Bit count must be between 1 and {MAX_READ_BITS}")
+        
+        # Ensure connected
+        if not self.connected:
+            self.connect()
+        
+        result = self._timed('read_' + reg_type, read, address=address, count=count, slave=slave_id)
+        if result.isError():
+            raise ModbusError(f"Error reading bits: {result}")
+        
+        # Responses are padded to whole bytes
+        return result.bits[:count]
+    
+    def read_register_blocks(self, reg_type, blocks, slave_id=1):
+        """
+        Read several register (or bit) ranges, one request per range
+        
+        Args:
+            reg_type (str): 'holding', 'input', 'coil' or 'discrete'
+            blocks (list): (address, count) tuples
+            slave_id (int): Slave ID
+        
+        Returns:
+            List with the register values, or the ModbusError raised, for each block
+        """
+        read = self.read_bits if reg_type in BIT_TYPES else self.read_registers
+        results = []
+        for address, count in blocks:
+            try:
+                results.append(read(reg_type, address, count, slave_id))
+            except ModbusError as e:
+                results.append(e)
+        return results
     
-    def write_data(self, address, value, slave_id=1, data_type='int16'):
+    def write_data(self, address, value, slave_id=1, data_type='int16', reg_type='holding'):
         """
-        Write data to Modbus holding registers
+        Write data to Modbus holding registers or coils
         
         Args:
             address (int): Register start address
-            value: Value to write (type depends on data_type)
+            value: Value to write (type depends on data_type), or a list of
+                   values written to consecutive registers in one request
             slave_id (int): Slave ID
-            data_type (str): Data type of value
+            data_type (str): Data type of value (ignored for coils)
                              Supported types: 
                              - int16, uint16, int32, uint32, int64, uint64
                              - float32, float64
                              - string[N] (N bytes)
                              - bool
+            reg_type (str): 'holding' or 'coil'
         """
+        if reg_type == 'coil':
+            return self.write_bits(address, value, slave_id)
+        if reg_type != 'holding':
+            raise ModbusError(f"Cannot write to {reg_type}: only 'holding' and 'coil' are writable")
+        
         # Ensure connected
         if not self.connected:
             self.connect()
@@ -98,9 +266,11 @@ class ModbusController:
         
         # Use appropriate write function based on number of registers
         if len(registers) == 1:
-            result = self.client.write_register(address=address, value=registers[0], slave=slave_id)
+            result = self._timed('write', self.client.write_register,
+                                 address=address, value=registers[0], slave=slave_id)
         else:
-            result = self.client.write_registers(address=address, values=registers, slave=slave_id)
+            result = self._timed('write', self.client.write_registers,
+                                 address=address, values=registers, slave=slave_id)
         
         # Check for errors
         if result.isError():
@@ -108,126 +278,92 @@ class ModbusController:
         
         return True
     
+    def write_bits(self, address, value, slave_id=1):
+        """
+        Write one coil, or a list of consecutive coils in one request
+        
+        Args:
+            address (int): First coil address
+            value: bool, or a list of bools (at most 1968)
+            slave_id (int): Slave ID
+        """
+        values = value if isinstance(value, (list, tuple)) else [value]
+        if not 1 <= len(values) <= MAX_WRITE_BITS:
+            raise ModbusError(f"Coil count must be between 1 and {MAX_WRITE_BITS}")
+        
+        # Ensure connected
+        if not self.connected:
+            self.connect()
+        
+        if len(values) == 1:
+            result = self._timed('write_coil', self.client.write_coil,
+                                 address=address, value=bool(values[0]), slave=slave_id)
+        else:
+            result = self._timed('write_coil', self.client.write_coils,
+                                 address=address, values=[bool(v) for v in values], slave=slave_id)
+        
+        if result.isError():
+            raise ModbusError(f"Error writing coils: {result}")
+        
+        return True
+    
+    def _timed(self, function, call, **kwargs):
+        """Run a client request, recording its round-trip time under the given function label"""
+        bus = serial_buses.get(self.device)
+        if bus is not None:
+            # Gateway to a serial bus: wait for our turn on it, then time only the request
+            if not bus.acquire(kwargs['slave'], self.timeout):
+                raise ModbusError(f"Timed out waiting for the serial bus of {self.device}")
+            try:
+                return self._timed_request(function, call, **kwargs)
+            finally:
+                bus.release()
+        return self._timed_request(function, call, **kwargs)
+    
+    def _timed_request(self, function, call, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = call(**kwargs)
+        except ModbusException as e:
+            self._record(function, time.perf_counter() - started, 'connection', str(e))
+            raise
+        if result.isError():
+            self._record(function, time.perf_counter() - started, error_code(result), str(result))
+        else:
+            self._record(function, time.perf_counter() - started)
+        return result
+    
+    def _record(self, function, elapsed, code=None, error=None):
+        """Record a request's round-trip time and outcome in the metrics and the device's health"""
+        request_seconds.observe(elapsed, self.device, function)
+        if code is not None:
+            errors_total.inc(self.device, code)
+        device_health.record(self.device, elapsed, code, error)
+    
     def _get_register_count_for_type(self, data_type, count=1):
         """Calculate how many registers to read based on data type"""
-        # Each register is 16 bits (2 bytes)
-        if data_type.startswith('string['):
-            # For strings, extract the byte count from the format string[N]
-            try:
-                string_length = int(data_type.split('[')[1].split(']')[0])
-                # Calculate registers needed (2 bytes per register, rounded up)
-                return (string_length + 1) // 2 * count
-            except (IndexError, ValueError):
-                raise ModbusError(f"Invalid string data type format: {data_type}. Use 'string[N]'")
-        
-        # Standard data types
-        registers_per_type = {
-            'bool': 1,
-            'int16': 1,
-            'uint16': 1,
-            'int32': 2,
-            'uint32': 2,
-            'float32': 2,
-            'int64': 4,
-            'uint64': 4,
-            'float64': 4,
-        }
-        
-        if data_type not in registers_per_type:
-            raise ModbusError(f"Unsupported data type: {data_type}")
-        
-        return registers_per_type[data_type] * count
-    
-    def _decode_registers(self, registers, data_type, count=1):
+        return register_count_for_type(data_type, count)
+    
+    def decode_registers(self, registers, data_type, count=1):
         """Decode register values based on data type"""
-        # Create a decoder with the register values
-        decoder = BinaryPayloadDecoder.fromRegisters(
-            registers,
-            byteorder=Endian.BIG,
-            wordorder=Endian.LITTLE  # Most Modbus devices use this order
-        )
-        
-        # Special case for strings
-        if data_type.startswith('string['):
-            try:
-                string_length = int(data_type.split('[')[1].split(']')[0])
-                result = decoder.decode_string(string_length).decode('utf-8')
-                return result
-            except (IndexError, ValueError):
-                raise ModbusError(f"Invalid string data type format: {data_type}")
-        
-        # Handle multiple values
-        if count > 1:
-            results = []
-            for _ in range(count):
-                results.append(self._decode_single_value(decoder, data_type))
-            return results
-        else:
-            return self._decode_single_value(decoder, data_type)
-    
-    def _decode_single_value(self, decoder, data_type):
-        """Decode a single value from the decoder based on data type"""
-        if data_type == 'bool':
-            return decoder.decode_bits()[0]
-        elif data_type == 'int16':
-            return decoder.decode_16bit_int()
-        elif data_type == 'uint16':
-            return decoder.decode_16bit_uint()
-        elif data_type == 'int32':
-            return decoder.decode_32bit_int()
-        elif data_type == 'uint32':
-            return decoder.decode_32bit_uint()
-        elif data_type == 'int64':
-            return decoder.decode_64bit_int()
-        elif data_type == 'uint64':
-            return decoder.decode_64bit_uint()
-        elif data_type == 'float32':
-            return decoder.decode_32bit_float()
-        elif data_type == 'float64':
-            return decoder.decode_64bit_float()
-        else:
-            raise ModbusError(f"Unsupported data type: {data_type}")
+        started = time.perf_counter()
+        try:
+            return decode_registers(registers, data_type, count)
+        except CodecError as e:
+            raise ModbusError(str(e))
+        finally:
+            decode_seconds.observe(time.perf_counter() - started, data_type.split('[')[0])
+    
+    def decode_bits(self, bits, count=1):
+        """Decode coil or discrete input states"""
+        try:
+            return decode_bits(bits, count)
+        except CodecError as e:
+            raise ModbusError(str(e))
     
     def _encode_value(self, value, data_type):
-        """Encode a value to register format based on data type"""
-        builder = BinaryPayloadBuilder(
-            byteorder=Endian.BIG,
-            wordorder=Endian.LITTLE  # Most Modbus devices use this order
-        )
-        
-        # Handle string data type
-        if data_type.startswith('string['):
-            try:
-                string_length = int(data_type.split('[')[1].split(']')[0])
-                # Truncate or pad the string to the specified length
-                value_str = str(value)
-                if len(value_str) > string_length:
-                    value_str = value_str[:string_length]
-                builder.add_string(value_str.encode('utf-8'))
-            except (IndexError, ValueError):
-                raise ModbusError(f"Invalid string data type format: {data_type}")
-        
-        # Handle other data types
-        elif data_type == 'bool':
-            builder.add_bits([bool(value)])
-        elif data_type == 'int16':
-            builder.add_16bit_int(int(value))
-        elif data_type == 'uint16':
-            builder.add_16bit_uint(int(value))
-        elif data_type == 'int32':
-            builder.add_32bit_int(int(value))
-        elif data_type == 'uint32':
-            builder.add_32bit_uint(int(value))
-        elif data_type == 'int64':
-            builder.add_64bit_int(int(value))
-        elif data_type == 'uint64':
-            builder.add_64bit_uint(int(value))
-        elif data_type == 'float32':
-            builder.add_32bit_float(float(value))
-        elif data_type == 'float64':
-            builder.add_64bit_float(float(value))
-        else:
-            raise ModbusError(f"Unsupported data type: {data_type}")
-        
-        # Build the registers
-        return builder.to_registers()
\ No newline at end of file
+        """Encode a value (or a list of values) to register format based on data type"""
+        try:
+            return encode_values(value, data_type)
+        except CodecError as e:
+            raise ModbusError(str(e))
@@ -0,0 +1,422 @@
+import socket
+import struct
+import threading
+import time
+from device_health import device_health
+from metrics import connect_seconds, errors_total
+from modbus_controller import BIT_TYPES, EXCEPTION_NAMES, MAX_READ_BITS, MAX_WRITE_BITS, ModbusController, ModbusError
+from register_codec import pack_bits, unpack_bits
+from serial_gateway import serial_buses
+
+READ_FUNCTION_CODES = {'coil': 1, 'discrete': 2, 'holding': 3, 'input': 4}
+WRITE_SINGLE_COIL = 5
+WRITE_SINGLE_REGISTER = 6
+WRITE_MULTIPLE_COILS = 15
+WRITE_MULTIPLE_REGISTERS = 16
+
+_MBAP = struct.Struct('>HHHB')  # transaction id, protocol id, length, unit id
+# The MBAP length counts the unit id and the PDU, which is at most 253 bytes
+MIN_MBAP_LENGTH = 2
+MAX_MBAP_LENGTH = 254
+
+
+class ModbusExceptionResponse(ModbusError):
+    """A device answered with a Modbus exception code"""
+
+    def __init__(self, function_code, exception_code):
+        self.function_code = function_code
+        self.exception_code = exception_code
+        name = EXCEPTION_NAMES.get(exception_code, str(exception_code))
+        super().__init__(f"Exception Response({function_code | 0x80}, {function_code}, {name})")
+
+    def __reduce__(self):
+        # Sent between processes by the shard pool
+        return type(self), (self.function_code, self.exception_code)
+
+
+class PipelineTimeout(ModbusError):
+    """No response, or no free pipeline slot, within the timeout"""
+    pass
+
+
+class _Waiter:
+    """A caller waiting for the response with one transaction id"""
+
+    __slots__ = ('event', 'response', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class PipelinedConnection:
+    """
+    One Modbus TCP socket with several requests in flight
+
+    Requests are tagged with a transaction id and written as soon as a slot
+    in the in-flight window is free; a reader thread matches responses to
+    waiting callers by transaction id, in whatever order they arrive.
+    """
+
+    def __init__(self, host, port=502, timeout=30, window=8):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.window = window
+        try:
+            self.sock = socket.create_connection((host, port), timeout=timeout)
+        except OSError:
+            raise ModbusError(f"Failed to connect to Modbus server at {host}:{port}")
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.closed = False
+        self._slots = threading.BoundedSemaphore(window)
+        self._pending = {}
+        self._next_tid = 1
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_loop, name=f"modbus-pipeline-{host}:{port}", daemon=True)
+        self._reader.start()
+
+    def request(self, unit, pdu, timeout=None):
+        """
+        Send one request PDU and wait for its response PDU
+
+        Raises:
+            ModbusError: On timeout, a full window for longer than timeout, or a lost connection
+        """
+        timeout = self.timeout if timeout is None else timeout
+        return self.wait(self.send(unit, pdu, timeout), timeout)
+
+    def send(self, unit, pdu, timeout=None):
+        """
+        Write a request without waiting for the response
+
+        Blocks while the in-flight window is full. The slot is given back
+        when the response arrives, the request times out or the connection
+        fails, so callers can send several requests before waiting.
+
+        Returns:
+            (transaction id, waiter) to pass to wait()
+        """
+        timeout = self.timeout if timeout is None else timeout
+        if not self._slots.acquire(timeout=timeout):
+            raise PipelineTimeout(f"Timed out waiting for a pipeline slot on {self.host}:{self.port}")
+
+        waiter = _Waiter()
+        with self._lock:
+            if self.closed:
+                self._slots.release()
+                raise ModbusError(f"Connection to {self.host}:{self.port} is closed")
+            tid = self._next_tid
+            self._next_tid = tid % 0xFFFF + 1
+            self._pending[tid] = waiter
+            try:
+                self.sock.sendall(_MBAP.pack(tid, 0, len(pdu) + 1, unit) + pdu)
+            except OSError as e:
+                del self._pending[tid]
+                self._slots.release()
+                raise ModbusError(f"Error sending request to {self.host}:{self.port}: {e}")
+        return tid, waiter
+
+    def wait(self, request, timeout=None):
+        """Wait for the response to a request returned by send()"""
+        tid, waiter = request
+        timeout = self.timeout if timeout is None else timeout
+        if not waiter.event.wait(timeout):
+            with self._lock:
+                expired = self._pending.pop(tid, None) is waiter
+            if expired:
+                self._slots.release()
+                raise PipelineTimeout(f"No response from {self.host}:{self.port} within {timeout} seconds")
+            # The response arrived just as we gave up; it is being handed over
+            waiter.event.wait()
+        if waiter.error is not None:
+            raise ModbusError(waiter.error)
+        return waiter.response
+
+    def in_flight(self):
+        """Number of requests waiting for a response"""
+        with self._lock:
+            return len(self._pending)
+
+    def close(self):
+        """Close the socket and fail every waiting request"""
+        self._fail("Connection closed")
+
+    def _read_loop(self):
+        """Reader thread: hand each response to the caller waiting for its transaction id"""
+        try:
+            while True:
+                tid, _, length, _ = _MBAP.unpack(self._recv_exact(_MBAP.size))
+                if not MIN_MBAP_LENGTH <= length <= MAX_MBAP_LENGTH:
+                    # Where the next frame starts is unknown: give up on the stream
+                    self._fail(f"Protocol error from {self.host}:{self.port}: invalid MBAP length {length}")
+                    return
+                pdu = self._recv_exact(length - 1)
+                with self._lock:
+                    waiter = self._pending.pop(tid, None)
+                # Responses nobody waits for any more (timed out) are dropped
+                if waiter is not None:
+                    self._slots.release()
+                    waiter.response = pdu
+                    waiter.event.set()
+        except (OSError, struct.error) as e:
+            self._fail(f"Connection to {self.host}:{self.port} lost: {e}")
+
+    def _recv_exact(self, size):
+        """Read exactly size bytes from the socket"""
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("connection closed by peer")
+            data += chunk
+        return data
+
+    def _fail(self, reason):
+        """Mark the connection closed and wake every waiter with an error"""
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending, self._pending = self._pending, {}
+        for waiter in pending.values():
+            self._slots.release()
+            waiter.error = reason
+            waiter.event.set()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class PipelinedModbusController(ModbusController):
+    """
+    ModbusController that pipelines requests from many threads over one socket
+
+    Only the transport differs: decoding, encoding and the public read/write
+    methods behave exactly as in ModbusController, and the instance is
+    safe to share between threads.
+    """
+
+    def __init__(self, host, port=502, timeout=30, window=8):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.window = window
+        self.device = f"{host}:{port}"
+        self.connection = None
+        self.connected = False
+        self._connect_lock = threading.Lock()
+        self.connect()
+
+    def connect(self):
+        """Open the pipelined connection"""
+        if not self.connected:
+            started = time.perf_counter()
+            try:
+                self.connection = PipelinedConnection(self.host, self.port, self.timeout, self.window)
+            except ModbusError as e:
+                errors_total.inc(self.device, 'connect')
+                device_health.record(self.device, code='connect', error=str(e))
+                raise
+            finally:
+                connect_seconds.observe(time.perf_counter() - started, self.device)
+            self.connected = True
+        return self.connected
+
+    def close(self):
+        """Close the pipelined connection"""
+        if self.connection is not None:
+            self.connection.close()
+        self.connected = False
+
+    def reconnect(self):
+        """Drop the current socket and open a fresh connection"""
+        self.close()
+        return self.connect()
+
+    def set_timeout(self, timeout):
+        """Change the request timeout"""
+        self.timeout = timeout
+        if self.connection is not None:
+            self.connection.timeout = timeout
+
+    def is_healthy(self):
+        """Check that the connection is still open"""
+        return self.connected and self.connection is not None and not self.connection.closed
+
+    def read_registers(self, reg_type, address, count, slave_id=1):
+        """Read raw 16-bit register values"""
+        if reg_type in BIT_TYPES:
+            raise ModbusError(f"Invalid register type: {reg_type}. Use 'holding', 'input', 'coil' or 'discrete'")
+        pdu = self._read_request(reg_type, address, count)
+        return self._registers(self._execute(slave_id, pdu, 'read_' + reg_type, "reading registers"))
+
+    def read_bits(self, reg_type, address, count, slave_id=1):
+        """Read coil or discrete input states"""
+        if reg_type not in BIT_TYPES:
+            raise ModbusError(f"Invalid bit type: {reg_type}. Use 'coil' or 'discrete'")
+        pdu = self._read_request(reg_type, address, count)
+        return self._bits(self._execute(slave_id, pdu, 'read_' + reg_type, "reading bits"), count)
+
+    def read_register_blocks(self, reg_type, blocks, slave_id=1):
+        """
+        Read several register (or bit) ranges with all requests in flight at once
+
+        Returns:
+            List with the register values, or the ModbusError raised, for each block
+        """
+        try:
+            pdus = [self._read_request(reg_type, address, count) for address, count in blocks]
+        except ModbusError as e:
+            return [e] * len(blocks)
+        if serial_buses.get(self.device) is not None:
+            # A serial bus answers one request at a time: queue each block for it
+            return ModbusController.read_register_blocks(self, reg_type, blocks, slave_id)
+        self._ensure_connected()
+        connection = self.connection
+
+        function = 'read_' + reg_type
+        if reg_type in BIT_TYPES:
+            action = "reading bits"
+            unpack = [lambda response, count=count: self._bits(response, count) for _, count in blocks]
+        else:
+            action = "reading registers"
+            unpack = [self._registers] * len(blocks)
+
+        requests = []
+        for pdu in pdus:
+            started = time.perf_counter()
+            try:
+                requests.append((started, connection.send(slave_id, pdu, self.timeout)))
+            except ModbusError as e:
+                self._failed(function, started, e)
+                requests.append(e)
+
+        results = []
+        for request, unpack_response in zip(requests, unpack):
+            if isinstance(request, ModbusError):
+                results.append(request)
+                continue
+            started, request = request
+            try:
+                response = self._response(function, started, connection.wait(request, self.timeout))
+            except ModbusError as e:
+                self._failed(function, started, e)
+                results.append(e)
+                continue
+            try:
+                results.append(unpack_response(self._check(pdus[0][0], response, action)))
+            except ModbusError as e:
+                results.append(e)
+        return results
+
+    def write_data(self, address, value, slave_id=1, data_type='int16', reg_type='holding'):
+        """Write data to holding registers or coils (see ModbusController.write_data)"""
+        if reg_type == 'coil':
+            return self.write_bits(address, value, slave_id)
+        if reg_type != 'holding':
+            raise ModbusError(f"Cannot write to {reg_type}: only 'holding' and 'coil' are writable")
+        registers = self._encode_value(value, data_type)
+        if len(registers) == 1:
+            pdu = struct.pack('>BHH', WRITE_SINGLE_REGISTER, address, registers[0])
+        else:
+            pdu = struct.pack(f'>BHHB{len(registers)}H', WRITE_MULTIPLE_REGISTERS, address,
+                              len(registers), len(registers) * 2, *registers)
+        self._execute(slave_id, pdu, 'write', "writing registers")
+        return True
+
+    def write_bits(self, address, value, slave_id=1):
+        """Write one coil, or a list of consecutive coils in one request"""
+        values = value if isinstance(value, (list, tuple)) else [value]
+        if not 1 <= len(values) <= MAX_WRITE_BITS:
+            raise ModbusError(f"Coil count must be between 1 and {MAX_WRITE_BITS}")
+        if len(values) == 1:
+            pdu = struct.pack('>BHH', WRITE_SINGLE_COIL, address, 0xFF00 if values[0] else 0x0000)
+        else:
+            payload = pack_bits(values)
+            pdu = struct.pack('>BHHB', WRITE_MULTIPLE_COILS, address, len(values), len(payload)) + payload
+        self._execute(slave_id, pdu, 'write_coil', "writing coils")
+        return True
+
+    def _execute(self, slave_id, pdu, function, action):
+        """Send a request, reconnecting first if the connection was lost, and check the response"""
+        self._ensure_connected()
+        bus = serial_buses.get(self.device)
+        if bus is not None and not bus.acquire(slave_id, self.timeout):
+            raise ModbusError(f"Timed out waiting for the serial bus of {self.device}")
+        started = time.perf_counter()
+        try:
+            response = self._response(function, started, self.connection.request(slave_id, pdu, self.timeout))
+        except ModbusError as e:
+            self._failed(function, started, e)
+            raise
+        finally:
+            if bus is not None:
+                bus.release()
+        return self._check(pdu[0], response, action)
+
+    def _response(self, function, started, response):
+        """Record the round-trip time and outcome of an answered request"""
+        if len(response) < 2:
+            raise ModbusError(f"Malformed response from {self.device}: {len(response)} byte PDU")
+        code = EXCEPTION_NAMES.get(response[1], str(response[1])) if response[0] & 0x80 else None
+        self._record(function, time.perf_counter() - started, code)
+        return response
+
+    def _failed(self, function, started, error):
+        """Record a request that got no response"""
+        code = 'timeout' if isinstance(error, PipelineTimeout) else 'connection'
+        self._record(function, time.perf_counter() - started, code, str(error))
+
+    def _ensure_connected(self):
+        """Reconnect if the connection was lost (once, however many threads notice)"""
+        if not self.is_healthy():
+            with self._connect_lock:
+                if not self.is_healthy():
+                    self.reconnect()
+
+    @staticmethod
+    def _read_request(reg_type, address, count):
+        """Build a read registers, coils or discrete inputs request PDU"""
+        function_code = READ_FUNCTION_CODES.get(reg_type)
+        if function_code is None:
+            raise ModbusError(f"Invalid register type: {reg_type}. Use 'holding', 'input', 'coil' or 'discrete'")
+        if reg_type in BIT_TYPES and not 1 <= count <= MAX_READ_BITS:
+            raise ModbusError(f"Bit count must be between 1 and {MAX_READ_BITS}")
+        return struct.pack('>BHH', function_code, address, count)
+
+    @staticmethod
+    def _check(function_code, response, action):
+        """Raise for exception responses, in the same words as ModbusController"""
+        if response[0] & 0x80:
+            error = ModbusExceptionResponse(function_code, response[1])
+            raise ModbusError(f"Error {action}: {error}")
+        return response
+
+    @classmethod
+    def _bits(cls, response, count):
+        """Unpack count bit states of a read coils/discrete inputs response PDU"""
+        data = cls._data(response)
+        if len(data) * 8 < count:
+            raise ModbusError(f"Malformed read response: {len(data)} bytes for {count} bits")
+        return unpack_bits(data, count)
+
+    @classmethod
+    def _registers(cls, response):
+        """Unpack the register values of a read response PDU"""
+        data = cls._data(response)
+        if len(data) % 2:
+            raise ModbusError(f"Malformed read response: odd byte count {len(data)}")
+        return list(struct.unpack(f'>{len(data) // 2}H', data))
+
+    @staticmethod
+    def _data(response):
+        """Data bytes of a read response PDU, checked against its byte count"""
+        if len(response) != 2 + response[1]:
+            raise ModbusError(f"Malformed read response: byte count {response[1]}, {len(response) - 2} data bytes")
+        return response[2:]
@@ -0,0 +1,95 @@
+import functools
+import heapq
+import itertools
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Request priority classes, most urgent first
+CONTROL_WRITE = 'control_write'
+INTERACTIVE = 'interactive'
+POLL = 'poll'
+BULK = 'bulk'
+PRIORITY_CLASSES = (CONTROL_WRITE, INTERACTIVE, POLL, BULK)
+CLASS_RANK = {name: rank for rank, name in enumerate(PRIORITY_CLASSES)}
+
+# Share of a busy device's connections each class gets while all of them wait
+CLASS_WEIGHTS = {CONTROL_WRITE: 8, INTERACTIVE: 4, POLL: 2, BULK: 1}
+# Fraction of a device's queue limit a class may fill; bulk and polls are shed first
+ADMISSION_SHARE = {CONTROL_WRITE: 1.0, INTERACTIVE: 1.0, POLL: 0.75, BULK: 0.5}
+
+# Per thread, and per asyncio task (which inherits its creator's class)
+_current = ContextVar('priority_class', default=INTERACTIVE)
+
+def current_class():
+    """Priority class of the requests made by this thread or task (interactive unless set)"""
+    return _current.get()
+
+
+@contextmanager
+def priority_class(name):
+    """Run the enclosed requests of this thread or task in the given priority class"""
+    token = _current.set(name)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def with_class(name, func):
+    """Wrap a function so the requests it makes (on whatever thread runs it) are in the given class"""
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        with priority_class(name):
+            return func(*args, **kwargs)
+    return run
+
+
+class FairQueue:
+    """
+    Requests waiting for one device, served by self-clocked weighted fair queuing
+
+    Each waiter gets a finish tag of max(virtual time, its class's previous
+    tag) + 1 / weight, and the smallest tag is served first; the virtual
+    time is the tag of the last waiter served. A backlogged class thus gets
+    connections in proportion to its weight, and a class that was idle
+    starts level with the others instead of catching up. Not thread safe:
+    the owner's lock guards it.
+    """
+
+    def __init__(self):
+        self.virtual_time = 0.0
+        self._finish = {}   # class -> finish tag of its last waiter
+        self._heap = []     # (finish tag, sequence, class)
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, name):
+        """Queue a waiter of class name and return its entry"""
+        tag = max(self.virtual_time, self._finish.get(name, 0.0)) + 1.0 / CLASS_WEIGHTS[name]
+        self._finish[name] = tag
+        entry = (tag, next(self._seq), name)
+        heapq.heappush(self._heap, entry)
+        return entry
+
+    def head(self):
+        """Entry to serve next, or None"""
+        return self._heap[0] if self._heap else None
+
+    def pop(self, entry, served=True):
+        """Remove an entry, advancing the virtual time if it is being served"""
+        if self._heap[0] is entry:
+            heapq.heappop(self._heap)
+        else:
+            self._heap.remove(entry)
+            heapq.heapify(self._heap)
+        if served:
+            self.virtual_time = entry[0]
+
+    def depths(self):
+        """Waiters per class"""
+        depths = dict.fromkeys(PRIORITY_CLASSES, 0)
+        for _, _, name in self._heap:
+            depths[name] += 1
+        return depths
@@ -0,0 +1,225 @@
+from modbus_controller import BIT_TYPES, MAX_READ_BITS, ModbusError, register_count_for_type
+from serial_gateway import serial_buses
+
+# A single read holding/input registers request can return at most 125 registers
+MAX_READ_REGISTERS = 125
+
+# Unrequested registers we are willing to read to avoid another round trip
+DEFAULT_MAX_GAP = 8
+
+# Bits are 16 times cheaper on the wire than registers, so coil and discrete
+# input plans tolerate gaps 16 times as wide
+BIT_GAP_FACTOR = 16
+
+class ReadBlock:
+    """One Modbus read request covering one or more tags"""
+
+    def __init__(self, address, count):
+        self.address = address
+        self.count = count
+        self.members = []  # (tag index, register offset in block, register count)
+
+    def __repr__(self):
+        return f"ReadBlock(address={self.address}, count={self.count}, tags={len(self.members)})"
+
+
+def plan_reads(ranges, max_gap=DEFAULT_MAX_GAP, max_registers=MAX_READ_REGISTERS):
+    """
+    Merge register ranges into the minimum number of read requests
+
+    Args:
+        ranges (list): (address, register count) per tag
+        max_gap (int): Largest run of unrequested registers allowed inside a block
+        max_registers (int): Largest block size (PDU limit)
+
+    Returns:
+        List of ReadBlock sorted by address
+    """
+    blocks = []
+    current = None
+    order = sorted(range(len(ranges)), key=lambda i: ranges[i])
+
+    for index in order:
+        address, length = ranges[index]
+        end = address + length
+        if current is not None:
+            current_end = current.address + current.count
+            merged_end = max(current_end, end)
+            if address <= current_end + max_gap and merged_end - current.address <= max_registers:
+                current.count = merged_end - current.address
+                current.members.append((index, address - current.address, length))
+                continue
+
+        # Tags larger than the PDU limit still get their own block so the
+        # device reports the error exactly as an uncoalesced read would
+        current = ReadBlock(address, length)
+        current.members.append((index, 0, length))
+        blocks.append(current)
+
+    return blocks
+
+
+class ReadPlan:
+    """Precompiled coalesced reads for a fixed set of tags on one (host, port, slave, reg_type)"""
+
+    def __init__(self, host, port, slave_id, reg_type, tags, max_gap=None,
+                 max_registers=MAX_READ_REGISTERS):
+        """
+        Compile a read plan
+
+        Args:
+            host (str): Device host
+            port (int): Device port
+            slave_id (int): Slave ID
+            reg_type (str): 'holding', 'input', 'coil' or 'discrete'
+            tags (list): (address, count, data_type) per tag; data_type is ignored for bits
+            max_gap (int): Gap tolerance passed to plan_reads (in registers); by default
+                           DEFAULT_MAX_GAP, or the break-even gap of a serial gateway's bus
+            max_registers (int): Block size limit passed to plan_reads (bit plans use MAX_READ_BITS)
+
+        Raises:
+            ModbusError: If a tag uses an unsupported data type
+        """
+        self.host = host
+        self.port = port
+        self.slave_id = slave_id
+        self.reg_type = reg_type
+        self.tags = list(tags)
+        self.bits = reg_type in BIT_TYPES
+        if max_gap is None:
+            max_gap = serial_buses.max_gap(host, port, DEFAULT_MAX_GAP, max_registers)
+        if self.bits:
+            ranges = [(address, count) for address, count, _ in self.tags]
+            self.blocks = plan_reads(ranges, max_gap * BIT_GAP_FACTOR, MAX_READ_BITS)
+        else:
+            ranges = [(address, register_count_for_type(data_type, count))
+                      for address, count, data_type in self.tags]
+            self.blocks = plan_reads(ranges, max_gap, max_registers)
+
+        # Block index of every tag, for running only the blocks a caller needs
+        self.tag_blocks = [None] * len(self.tags)
+        for block_index, block in enumerate(self.blocks):
+            for index, _, _ in block.members:
+                self.tag_blocks[index] = block_index
+
+    def execute(self, controller, blocks=None):
+        """
+        Run the plan on a connected controller
+
+        A block that fails (for example because a gap register is not
+        implemented by the device) is retried tag by tag, so each tag gets
+        the same result it would have had on its own.
+
+        Args:
+            controller (ModbusController): Connected controller
+            blocks (iterable): Indexes of the blocks to run (default: all)
+
+        Returns:
+            List with the decoded value, or the ModbusError raised, for each
+            tag (None for tags outside the selected blocks)
+        """
+        results = [None] * len(self.tags)
+        selected = self.blocks if blocks is None else [self.blocks[i] for i in blocks]
+
+        # All blocks are requested together so a pipelined controller can
+        # keep them in flight at once
+        responses = controller.read_register_blocks(
+            self.reg_type, [(block.address, block.count) for block in selected], self.slave_id)
+
+        for block, registers in zip(selected, responses):
+            if isinstance(registers, ModbusError):
+                e = registers
+                if len(block.members) == 1:
+                    results[block.members[0][0]] = e
+                    continue
+                for index, _, _ in block.members:
+                    address, count, data_type = self.tags[index]
+                    try:
+                        results[index] = controller.read_data(self.reg_type, address, count, self.slave_id, data_type)
+                    except ModbusError as tag_error:
+                        results[index] = tag_error
+                continue
+
+            self._decode(controller, block, registers, results)
+
+        return results
+
+    async def execute_async(self, controller, blocks=None):
+        """Run the plan on an AsyncModbusController (same results as execute)"""
+        results = [None] * len(self.tags)
+        selected = self.blocks if blocks is None else [self.blocks[i] for i in blocks]
+
+        read = controller.read_bits if self.bits else controller.read_registers
+        for block in selected:
+            try:
+                registers = await read(self.reg_type, block.address, block.count, self.slave_id)
+            except ModbusError as e:
+                if len(block.members) == 1:
+                    results[block.members[0][0]] = e
+                    continue
+                for index, _, _ in block.members:
+                    address, count, data_type = self.tags[index]
+                    try:
+                        results[index] = await controller.read_data(self.reg_type, address, count, self.slave_id, data_type)
+                    except ModbusError as tag_error:
+                        results[index] = tag_error
+                continue
+
+            self._decode(controller, block, registers, results)
+
+        return results
+
+    def _decode(self, controller, block, values, results):
+        """Decode the tags of one block from its registers (or bits)"""
+        for index, offset, length in block.members:
+            _, count, data_type = self.tags[index]
+            try:
+                if self.bits:
+                    results[index] = controller.decode_bits(values[offset:offset + length], count)
+                else:
+                    results[index] = controller.decode_registers(values[offset:offset + length], data_type, count)
+            except ModbusError as e:
+                results[index] = e
+
+    def __repr__(self):
+        return (f"ReadPlan({self.host}:{self.port}, slave={self.slave_id}, reg_type={self.reg_type}, "
+                f"tags={len(self.tags)}, blocks={len(self.blocks)})")
+
+
+def build_read_plans(operations, indexes=None, max_gap=None):
+    """
+    Compile one ReadPlan per (host, port, slave_id, reg_type) from API read operations
+
+    Args:
+        operations (list): Operation dicts as accepted by the API routes
+        indexes (list): Indexes of the read operations to plan (default: all reads)
+        max_gap (int): Gap tolerance for merging (default: per device, see ReadPlan)
+
+    Returns:
+        Tuple of (list of (plan, operation indexes), indexes that could not be planned)
+    """
+    if indexes is None:
+        indexes = [i for i, op in enumerate(operations) if op.get('operation', 'read') == 'read']
+
+    grouped = {}
+    unplanned = []
+    for i in indexes:
+        op = operations[i]
+        try:
+            register_count_for_type(op.get('data_type', 'int16'), op.get('count', 1))
+        except ModbusError:
+            unplanned.append(i)
+            continue
+        key = (op.get('host', '127.0.0.1'), op.get('port', 502), op.get('slave_id', 1), op.get('reg_type', 'holding'))
+        grouped.setdefault(key, []).append(i)
+
+    plans = []
+    for (host, port, slave_id, reg_type), members in grouped.items():
+        tags = [(operations[i].get('address', 0), operations[i].get('count', 1),
+                 operations[i].get('data_type', 'int16')) for i in members]
+        try:
+            plans.append((ReadPlan(host, port, slave_id, reg_type, tags, max_gap), members))
+        except ModbusError:
+            unplanned.extend(members)
+
+    return plans, unplanned
@@ -0,0 +1,214 @@
+import base64
+import struct
+import sys
+from array import array
+from functools import lru_cache
+
+class CodecError(ValueError):
+    """Raised for unsupported data types or register blocks that don't fit the type"""
+    pass
+
+class TypeSpec:
+    """Parsed form of a data type string"""
+
+    def __init__(self, name, words, fmt=None, string_length=None):
+        self.name = name
+        self.words = words                  # registers per value
+        self.fmt = fmt                      # struct format character for numeric types
+        self.string_length = string_length  # bytes, for string[N]
+
+    @property
+    def is_string(self):
+        return self.string_length is not None
+
+    def __repr__(self):
+        return f"TypeSpec({self.name!r}, words={self.words})"
+
+
+# Numeric types: (registers per value, struct format character)
+_NUMERIC_TYPES = {
+    'int16': (1, 'h'),
+    'uint16': (1, 'H'),
+    'int32': (2, 'i'),
+    'uint32': (2, 'I'),
+    'float32': (2, 'f'),
+    'int64': (4, 'q'),
+    'uint64': (4, 'Q'),
+    'float64': (4, 'd'),
+}
+
+# Bit set in a register holding a bool (bit 0 of the high byte)
+_BOOL_MASK = 0x0100
+
+_NEEDS_BYTESWAP = sys.byteorder == 'little'
+
+# Response encodings for coil and discrete input reads: a list of booleans,
+# a '0'/'1' string in address order, or base64 of the bytes as framed by
+# Modbus (first bit in the least significant bit of the first byte)
+BIT_FORMATS = ('list', 'bitstring', 'packed')
+
+
+@lru_cache(maxsize=256)
+def parse_data_type(data_type):
+    """
+    Parse a data type string once and cache the result
+
+    Raises:
+        CodecError: If the data type is not supported
+    """
+    if data_type.startswith('string['):
+        try:
+            string_length = int(data_type.split('[')[1].split(']')[0])
+        except (IndexError, ValueError):
+            raise CodecError(f"Invalid string data type format: {data_type}. Use 'string[N]'")
+        return TypeSpec(data_type, (string_length + 1) // 2, string_length=string_length)
+
+    if data_type == 'bool':
+        return TypeSpec(data_type, 1)
+
+    if data_type not in _NUMERIC_TYPES:
+        raise CodecError(f"Unsupported data type: {data_type}")
+    words, fmt = _NUMERIC_TYPES[data_type]
+    return TypeSpec(data_type, words, fmt)
+
+
+@lru_cache(maxsize=1024)
+def _block_struct(fmt, count):
+    """Precompiled big-endian struct for count values of one format"""
+    return struct.Struct(f">{count}{fmt}")
+
+
+def _swap_words(words, width):
+    """
+    Reverse the word order inside every group of width registers
+
+    Devices send the low word first, while struct expects big-endian
+    values. Slice assignment does the swap for the whole block at once.
+    """
+    if width == 1:
+        return words
+    swapped = list(words)
+    for i in range(width):
+        swapped[i::width] = words[width - 1 - i::width]
+    return swapped
+
+
+def _registers_to_bytes(registers):
+    """Pack registers into big-endian bytes"""
+    packed = array('H', registers)
+    if _NEEDS_BYTESWAP:
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _bytes_to_registers(payload):
+    """Unpack big-endian bytes into registers"""
+    registers = array('H', payload)
+    if _NEEDS_BYTESWAP:
+        registers.byteswap()
+    return registers.tolist()
+
+
+def decode_registers(registers, data_type, count=1):
+    """
+    Decode a block of registers in one pass
+
+    Byte order is big-endian within a register and word order is
+    little-endian (low word first), matching what the controller has
+    always used.
+
+    Returns:
+        A single value when count is 1, otherwise a list of count values
+    """
+    spec = parse_data_type(data_type)
+    needed = spec.words * max(count, 1)
+    if len(registers) < needed:
+        raise CodecError(f"Expected {needed} registers for {count} x {data_type}, got {len(registers)}")
+
+    if spec.is_string:
+        try:
+            return _registers_to_bytes(registers[:spec.words])[:spec.string_length].decode('utf-8')
+        except UnicodeDecodeError:
+            raise CodecError(f"Registers do not hold a valid UTF-8 {data_type}")
+
+    if spec.fmt is None:
+        values = [bool(register & _BOOL_MASK) for register in registers[:needed]]
+    else:
+        words = _swap_words(list(registers[:needed]), spec.words)
+        values = list(_block_struct(spec.fmt, len(words) // spec.words).unpack(_registers_to_bytes(words)))
+
+    return values if count > 1 else values[0]
+
+
+def encode_values(values, data_type):
+    """
+    Encode one value, or a list of values, into registers in one pass
+
+    Uses the same byte and word order as decode_registers. Strings are
+    truncated or padded with NUL bytes to their declared length.
+    """
+    spec = parse_data_type(data_type)
+
+    if spec.is_string:
+        payload = str(values).encode('utf-8')[:spec.string_length].ljust(spec.words * 2, b'\x00')
+        return _bytes_to_registers(payload)
+
+    if not isinstance(values, (list, tuple)):
+        values = [values]
+
+    if spec.fmt is None:
+        return [_BOOL_MASK if bool(value) else 0 for value in values]
+
+    try:
+        if spec.fmt in 'fd':
+            values = [float(value) for value in values]
+        else:
+            values = [int(value) for value in values]
+        payload = _block_struct(spec.fmt, len(values)).pack(*values)
+    except (struct.error, TypeError, ValueError) as e:
+        raise CodecError(f"Cannot encode {values} as {data_type}: {e}")
+
+    return _swap_words(_bytes_to_registers(payload), spec.words)
+
+
+def decode_bits(bits, count=1):
+    """
+    Decode a block of coil or discrete input states
+
+    Returns:
+        A single bool when count is 1, otherwise a list of count bools
+    """
+    if len(bits) < count:
+        raise CodecError(f"Expected {count} bits, got {len(bits)}")
+    values = [bool(bit) for bit in bits[:count]]
+    return values if count > 1 else values[0]
+
+
+def pack_bits(bits):
+    """Pack bits into bytes in Modbus order (first bit in the least significant bit of the first byte)"""
+    value = 0
+    for index, bit in enumerate(bits):
+        if bit:
+            value |= 1 << index
+    return value.to_bytes((len(bits) + 7) // 8, 'little')
+
+
+def unpack_bits(payload, count):
+    """Unpack count bits from bytes in Modbus order"""
+    value = int.from_bytes(payload, 'little')
+    return [bool(value >> index & 1) for index in range(count)]
+
+
+def format_bits(values, bit_format='list'):
+    """
+    Encode decoded bits for an API response (see BIT_FORMATS)
+
+    A single value (count 1) is returned unchanged.
+    """
+    if bit_format not in BIT_FORMATS:
+        raise CodecError(f"Invalid bit_format: {bit_format}. Use one of {', '.join(BIT_FORMATS)}")
+    if not isinstance(values, list) or bit_format == 'list':
+        return values
+    if bit_format == 'bitstring':
+        return ''.join('1' if value else '0' for value in values)
+    return base64.b64encode(pack_bits(values)).decode('ascii')
@@ -0,0 +1,248 @@
+import json
+import math
+import struct
+import sys
+from array import array
+from functools import lru_cache
+from importlib.util import find_spec
+from flask import Response
+from register_codec import CodecError, parse_data_type
+
+# Response encodings of the read endpoints, chosen from the Accept header.
+# MessagePack and CBOR carry the same documents as JSON; typed arrays only
+# carry the values, packed as raw little-endian arrays (format below).
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+CBOR = 'application/cbor'
+TYPED_ARRAYS = 'application/vnd.modbus.typed-arrays'
+
+# Optional module needed by each encoding (JSON falls back to the standard library)
+_MODULES = {MSGPACK: 'msgpack', CBOR: 'cbor2'}
+_ALIASES = {'application/x-msgpack': MSGPACK, 'application/vnd.msgpack': MSGPACK}
+
+# Typed array body: header, then one section per value
+#   header:  magic b'MBTA', version (uint16), section count (uint32)
+#   section: quality (uint8), type code (char), name length (uint16),
+#            item count (uint32), timestamp (float64, NaN if none),
+#            then the UTF-8 name and count items of the type code
+# Type codes are struct format characters (h H i I q Q f d ?), or 's' for
+# UTF-8 text with several strings separated by NUL. A bad section carries
+# the error message as text.
+MAGIC = b'MBTA'
+VERSION = 1
+_HEADER = struct.Struct('<4sHI')
+_SECTION = struct.Struct('<BcHId')
+QUALITIES = {'good': 0, 'stale': 1, 'bad': 2}
+
+_NEEDS_BYTESWAP = sys.byteorder == 'big'
+_orjson = None
+
+@lru_cache(maxsize=None)
+def _available(media_type):
+    """Whether the optional module an encoding needs is installed"""
+    module = _MODULES.get(media_type)
+    return module is None or find_spec(module) is not None
+
+
+def negotiate(accept):
+    """
+    Pick the response encoding for an Accept header
+
+    Each encoding takes the q of the most specific range matching it, so
+    "application/json;q=0, */*" excludes JSON. Among equal q, a type named
+    in the header wins over one matched by a wildcard, and the earlier
+    named type wins; wildcards prefer JSON. A malformed q counts as 1.
+
+    Args:
+        accept (str): Accept header value (None or empty means JSON)
+
+    Returns:
+        The media type to respond with, or None if none of the accepted
+        types can be produced (respond with 406)
+    """
+    if not accept:
+        return JSON
+
+    ranges = {}  # media range -> (q, position in the header)
+    for position, item in enumerate(accept.split(',')):
+        media_range, *params = [part.strip() for part in item.split(';')]
+        q = 1.0
+        for param in params:
+            if param.replace(' ', '').startswith('q='):
+                try:
+                    q = float(param.split('=', 1)[1])
+                except ValueError:
+                    q = 1.0
+                if not 0.0 <= q <= 1.0:
+                    q = 1.0
+        media_range = media_range.lower()
+        ranges.setdefault(_ALIASES.get(media_range, media_range), (q, position))
+
+    best, best_key = None, None
+    for order, media_type in enumerate((JSON, MSGPACK, CBOR, TYPED_ARRAYS)):
+        if not _available(media_type):
+            continue
+        if media_type in ranges:
+            q, position = ranges[media_type]
+        elif 'application/*' in ranges or '*/*' in ranges:
+            q = ranges.get('application/*', ranges.get('*/*'))[0]
+            position = len(ranges) + order
+        else:
+            continue
+        key = (q, -position)
+        if q > 0 and (best_key is None or key > best_key):
+            best, best_key = media_type, key
+    return best
+
+
+def not_acceptable_message():
+    """Error message for a 406 response, listing the encodings this server can produce"""
+    missing = [f"{media_type} (pip install {module})" for media_type, module in _MODULES.items()
+               if not _available(media_type)]
+    message = ("No acceptable response encoding. Supported: "
+               + ', '.join(media_type for media_type in (JSON, MSGPACK, CBOR, TYPED_ARRAYS)
+                           if _available(media_type)))
+    return message + (f". Not installed: {', '.join(missing)}" if missing else '')
+
+
+def dumps_json(payload):
+    """Serialize like Flask's jsonify (sorted keys, compact), with orjson when it is installed"""
+    global _orjson
+    if _orjson is None:
+        try:
+            import orjson
+            _orjson = orjson
+        except ImportError:
+            _orjson = False
+    if _orjson:
+        try:
+            return _orjson.dumps(payload, option=_orjson.OPT_SORT_KEYS | _orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. integers beyond 64 bits; the standard library handles everything else
+            pass
+    return json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def encode(payload, media_type, sections=None):
+    """
+    Encode a response document
+
+    Args:
+        payload (dict): Response document
+        media_type (str): Encoding returned by negotiate()
+        sections (callable): Returns the (name, quality, value, timestamp, data_type)
+            sections of the typed array encoding
+
+    Returns:
+        The response body as bytes
+    """
+    if media_type == MSGPACK:
+        import msgpack
+        return msgpack.packb(payload, use_bin_type=True)
+    if media_type == CBOR:
+        import cbor2
+        return cbor2.dumps(payload)
+    if media_type == TYPED_ARRAYS:
+        return typed_arrays(sections())
+    return dumps_json(payload)
+
+
+def negotiated_response(media_type, payload, sections=None, status=200):
+    """Flask response with the payload encoded as negotiated"""
+    return Response(encode(payload, media_type, sections), status=status, content_type=media_type,
+                    headers={'Vary': 'Accept'})
+
+
+def retry_after_header(seconds):
+    """Retry-After header value for a retry hint: whole seconds, rounded up"""
+    return str(max(1, math.ceil(seconds)))
+
+
+def typed_arrays(sections):
+    """Pack (name, quality, value, timestamp, data_type) sections in the typed array format"""
+    parts = [_HEADER.pack(MAGIC, VERSION, len(sections))]
+    for name, quality, value, timestamp, data_type in sections:
+        typecode, count, payload = _pack_value(value, data_type)
+        name = name.encode('utf-8')
+        parts.append(_SECTION.pack(QUALITIES[quality], typecode, len(name), count,
+                                   math.nan if timestamp is None else timestamp))
+        parts.append(name)
+        parts.append(payload)
+    return b''.join(parts)
+
+
+def _pack_value(value, data_type=None):
+    """Return (type code, item count, little-endian bytes) of a value or list of values"""
+    if value is None:
+        return b's', 0, b''
+    if isinstance(value, str):
+        payload = value.encode('utf-8')
+        return b's', len(payload), payload
+
+    values = value if isinstance(value, (list, tuple)) else [value]
+    if not values:
+        return b's', 0, b''
+    if isinstance(values[0], str):
+        payload = '\0'.join(values).encode('utf-8')
+        return b's', len(payload), payload
+    if isinstance(values[0], bool):
+        return b'?', len(values), bytes(values)
+
+    packed = None
+    fmt = _type_fmt(data_type)
+    if fmt is not None:
+        try:
+            packed = array(fmt, values)
+        except (TypeError, OverflowError):
+            pass
+    if packed is None:
+        # No usable type hint (scaled tags, mixed values): 64-bit ints or floats
+        fmt = 'd' if any(isinstance(v, float) for v in values) else 'q'
+        try:
+            packed = array(fmt, values)
+        except OverflowError:
+            fmt, packed = 'd', array('d', values)
+    if _NEEDS_BYTESWAP:
+        packed.byteswap()
+    return fmt.encode(), len(values), packed.tobytes()
+
+
+@lru_cache(maxsize=256)
+def _type_fmt(data_type):
+    """struct format character of a numeric data type, or None"""
+    if not data_type:
+        return None
+    try:
+        fmt = parse_data_type(data_type).fmt
+    except CodecError:
+        return None
+    # array's 'i'/'I' follow the C int, which must be 4 bytes to match the format
+    return fmt if fmt and array(fmt).itemsize == struct.calcsize('<' + fmt) else None
+
+
+def value_sections(value, data_type=None):
+    """Sections of a single read result"""
+    return [('', 'good', value, None, data_type)]
+
+
+def batch_sections(operations, results):
+    """Sections of a batch response, one per operation, named host:port"""
+    sections = []
+    for op, result in zip(operations, results):
+        name = f"{result.get('host')}:{result.get('port')}"
+        if result.get('status') == 'success':
+            sections.append((name, 'good', result.get('data'), None, op.get('data_type', 'int16')))
+        else:
+            sections.append((name, 'bad', result.get('message'), None, None))
+    return sections
+
+
+def tag_sections(tags, prefix=''):
+    """Sections of cached task values, named prefix + tag; bad tags carry their error"""
+    sections = []
+    for tag, entry in tags.items():
+        if entry['quality'] == 'bad':
+            sections.append((prefix + tag, 'bad', entry['error'], entry['error_timestamp'], None))
+        else:
+            sections.append((prefix + tag, entry['quality'], entry['value'], entry['timestamp'], None))
+    return sections
@@ -1,106 +1,418 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify
+import logging
 import threading
 import time
-from modbus_controller import ModbusController, ModbusError
+from modbus_controller import ModbusError
+from connection_pool import connection_pool
+from read_planner import build_read_plans
+from scheduler import scheduler
+from value_cache import value_cache
+from tag_history import DEFAULT_MAX_POINTS, TIER_NAMES, history_store
+from change_filter import FILTER_FIELDS, DeadbandFilter, filter_stats
+from webhook_delivery import DEFAULT_REPLAY_RATE, POLICIES, webhook_dispatcher
+from metrics import poll_failures_total
+from response_encoding import dumps_json, negotiate, negotiated_response, not_acceptable_message, tag_sections
+from write_queue import write_queue
+from live_stream import DEFAULT_BUFFER, KEEPALIVE_INTERVAL, MAX_BUFFER, stream_hub
+from task_store import task_store
+from shard_pool import shard_pool
+from priority_classes import POLL, with_class
+
+log = logging.getLogger(__name__)
 
 # Dictionary to store active continuous tasks
 continuous_tasks = {}
 next_task_id = 0
 task_lock = threading.Lock()
 
+# Restored tasks: connect timeout of the parallel pre-warm, and the phase step
+# (fraction of the interval per task id) that staggers their first polls
+WARM_TIMEOUT = 5
+PHASE_STEP = 0.6180339887498949
+# Seconds a stop waits for a poll in progress
+STOP_TIMEOUT = 5.0
+
 # Create Blueprint for continuous operations
 continuous_bp = Blueprint('continuous', __name__, url_prefix='/api/modbus')
 
-@continuous_bp.route('/device/continuous', methods=['POST'])
-def start_continuous_operation():
-    """Start continuous read or write operations on a single device"""
-    try:
-        data = request.get_json()
-        
-        # Extract device connection parameters
-        host = data.get('host', '127.0.0.1')
-        port = data.get('port', 502)
-        timeout = data.get('timeout', 30)
-        slave_id = data.get('slave_id', 1)
-        
-        # Extract operation parameters
-        operation = data.get('operation', 'read')  # 'read' or 'write'
-        reg_type = data.get('reg_type', 'holding')  # 'holding' or 'input'
-        address = data.get('address', 0)
-        count = data.get('count', 1)
-        data_type = data.get('data_type', 'int16')
-        
-        # Continuous operation specific parameters
-        interval = data.get('interval', 1.0)  # seconds between operations
-        callback_url = data.get('callback_url', None)  # Optional webhook URL to send results to
-        
-        # Value only needed for write operations
-        value = data.get('value', None)
-        
-        if operation == 'write' and value is None:
-            return jsonify({"status": "error", "message": "Value is required for write operations"}), 400
-        
-        # Create a new continuous task
-        controller = ModbusController(host, port, timeout)
-        stop_event = threading.Event()
+def _register_task(device, operation, callback_url=None, filters=(), devices=(), task_id=None, shard=None):
+    """Allocate a task id (unless given one) and store a new task entry"""
+    global next_task_id
+    with task_lock:
+        if task_id is None:
+            task_id = next_task_id
+        next_task_id = max(next_task_id, task_id + 1)
         
-        global next_task_id
+        # Store task info
+        continuous_tasks[task_id] = {
+            'job': None,
+            'status': 'starting',
+            'device': device,
+            'operation': operation,
+            'callback_url': callback_url,
+            'filters': filters,
+            'devices': sorted(set(devices)),
+            'shard': shard,
+            'finished': threading.Event()
+        }
+    return task_id
+
+def _tag_name(op):
+    """Name under which an operation's values are cached"""
+    if op.get('tag'):
+        return op['tag']
+    return (f"{op.get('host', '127.0.0.1')}:{op.get('port', 502)}/{op.get('slave_id', 1)}/"
+            f"{op.get('reg_type', 'holding')}/{op.get('address', 0)}")
+
+def _poll_failed(task_id, device, error):
+    """Log a failed poll and count it, whether or not a Modbus request failed"""
+    poll_failures_total.inc(device)
+    log.warning("Continuous task %s failed on %s: %s", task_id, device, error)
+
+def _positive(value, integer=False):
+    """Check that a task option is a positive number (or int); bools don't count"""
+    kinds = int if integer else (int, float)
+    return isinstance(value, kinds) and not isinstance(value, bool) and value > 0
+
+def _callback_options(data):
+    """
+    Extract webhook delivery settings from a continuous task request
+    
+    Raises:
+        ValueError: If a setting is out of range
+    """
+    options = {
+        "max_size": data.get('callback_queue_size', 1000),
+        "batch_size": data.get('callback_batch_size', 50),
+        "batch_interval": data.get('callback_batch_interval', 1.0),
+        "policy": data.get('callback_policy', 'drop_oldest'),
+        "max_retries": data.get('callback_retries', 3),
+        # Keep undelivered samples in an on-disk spool and replay them when the URL is back
+        "spool": bool(data.get('callback_spool', False)),
+        "replay_rate": data.get('callback_replay_rate', DEFAULT_REPLAY_RATE)
+    }
+    spool_max_mb = data.get('callback_spool_max_mb', 256)
+    
+    if options['policy'] not in POLICIES:
+        raise ValueError(f"Invalid callback_policy. Use one of {', '.join(POLICIES)}")
+    if not _positive(options['max_size'], integer=True):
+        raise ValueError("callback_queue_size must be a positive integer")
+    if not _positive(options['batch_size'], integer=True):
+        raise ValueError("callback_batch_size must be a positive integer")
+    if not _positive(options['batch_interval']):
+        raise ValueError("callback_batch_interval must be a positive number of seconds")
+    retries = options['max_retries']
+    if not (isinstance(retries, int) and not isinstance(retries, bool) and retries >= 0):
+        raise ValueError("callback_retries must be a non-negative integer")
+    if not _positive(options['replay_rate']):
+        raise ValueError("callback_replay_rate must be a positive number of samples per second")
+    if not _positive(spool_max_mb):
+        raise ValueError("callback_spool_max_mb must be a positive number")
+    options['spool_max_bytes'] = int(spool_max_mb * 1024 * 1024)
+    return options
+
+def _history_plan(kind, data):
+    """
+    Validate a task's interval and size its history (see HistoryStore.plan)
+    
+    History is kept in the API process, so tasks on shards are checked here too.
+    """
+    interval = data.get('interval', 1.0)
+    if not _positive(interval):
+        raise ValueError("interval must be a positive number of seconds")
+    # Values per sample of each numeric read; strings are never recorded
+    widths = [op.get('count', 1) for op in (data.get('devices', []) if kind == 'devices' else [data])
+              if op.get('operation', 'read') == 'read'
+              and not str(op.get('data_type', 'int16')).startswith('string')]
+    widths = [width if _positive(width, integer=True) else 1 for width in widths]
+    return history_store.plan(data.get('history', None), interval, widths)
+
+def _start_task(task_id, poll, interval, lane=None, history=None, start_delay=0.0):
+    """Hand a task's poll function to the shared scheduler"""
+    value_cache.register(task_id, interval)
+    history_store.register(task_id, interval, history)
+    # Polls queue behind control writes and interactive requests for busy devices
+    job = scheduler.schedule(task_id, with_class(POLL, poll), interval, lane=lane, start_delay=start_delay)
+    with task_lock:
+        continuous_tasks[task_id]['job'] = job
+        continuous_tasks[task_id]['status'] = 'running'
+
+def task_details(task):
+    """Scheduler, filter and device state of a task running in this process"""
+    return {
+        "stats": task["job"].stats() if task["job"] else None,
+        "reporting": filter_stats(task["filters"]),
+        "health": shard_pool.health(task["devices"])
+    }
+
+def task_summaries():
+    """Return the status and statistics of every task (shared with the ASGI app)"""
+    # Tasks on shard processes report their scheduler, filter and device state from there
+    remote = shard_pool.task_details() if shard_pool.enabled else {}
+    with task_lock:
+        tasks = list(continuous_tasks.items())
+    # Outside the lock: the device health of tasks polled from here comes from the shards too
+    return [dict({
+        "id": tid,
+        "status": task["status"],
+        "device": task["device"],
+        "operation": task["operation"],
+        "delivery": webhook_dispatcher.stats(tid, task["callback_url"]) if task["callback_url"] else None,
+        "history_bytes": history_store.memory_usage(tid),
+        "subscribers": stream_hub.subscriber_count(tid),
+        "shard": task["shard"]
+    }, **(task_details(task) if task["shard"] is None
+           else remote.get(tid, {"stats": None, "reporting": None, "health": None})))
+        for tid, task in tasks]
+
+def _task_devices(kind, data):
+    """(host, port) of every device a task definition polls"""
+    return sorted({(device.get('host', '127.0.0.1'), device.get('port', 502))
+                   for device in (data.get('devices', []) if kind == 'devices' else [data])})
+
+def _create_task(kind, data, task_id=None, start_delay=0.0, connect=True):
+    """
+    Start a task in this process, or on the shard process that owns its devices
+    
+    Tasks whose devices hash to different shards are scheduled here, but
+    each of their requests still runs on the shard owning the device.
+    """
+    global next_task_id
+    devices = _task_devices(kind, data)
+    shard = shard_pool.owner(devices) if shard_pool.enabled and devices else None
+    if task_id is None:
         with task_lock:
             task_id = next_task_id
             next_task_id += 1
+    if shard is None:
+        return _start_local_task(kind, data, task_id, start_delay, connect)
+    
+    _history_plan(kind, data)
+    shard_pool.call(shard, 'create', kind, data, task_id, start_delay, connect)
+    device = 'multiple' if kind == 'devices' else f"{devices[0][0]}:{devices[0][1]}"
+    operation = 'multiple' if kind == 'devices' else data.get('operation', 'read')
+    _register_task(device, operation, data.get('callback_url', None), (),
+                   [f"{host}:{port}" for host, port in devices], task_id, shard)
+    with task_lock:
+        continuous_tasks[task_id]['status'] = 'running'
+    return task_id
+
+def _start_local_task(kind, data, task_id, start_delay=0.0, connect=True):
+    """Start a task in this process, releasing what it had set up if it fails to start"""
+    start = _start_devices_task if kind == 'devices' else _start_device_task
+    try:
+        return start(data, task_id, start_delay, connect)
+    except Exception:
+        with task_lock:
+            task = continuous_tasks.pop(task_id, None)
+        if task is not None:
+            if task['callback_url']:
+                webhook_dispatcher.unregister(task_id, task['callback_url'])
+            value_cache.remove(task_id)
+            history_store.remove(task_id)
+        raise
+
+def _cancel_task(task_id, task):
+    """Remove a task from its scheduler; returns False if a run is still in progress"""
+    if task['shard'] is None:
+        return scheduler.cancel(task_id, timeout=STOP_TIMEOUT)
+    try:
+        return shard_pool.call(task['shard'], 'stop', task_id)
+    except ModbusError:
+        # The shard process is gone, and the task with it
+        return True
+
+def _finish_task(task_id, task):
+    """Release what a stopped task holds: its webhook queue, streams, cached values and history"""
+    if task['callback_url']:
+        webhook_dispatcher.unregister(task_id, task['callback_url'])
+    stream_hub.close(task_id)
+    # Shard workers forward the removal too; this covers one that exited
+    value_cache.remove(task_id)
+    history_store.remove(task_id)
+    with task_lock:
+        task['status'] = 'stopped'
+    task['finished'].set()
+
+def _finish_when_idle(task_id, task):
+    """Wait out the poll that outlived a stop, then release the task"""
+    try:
+        if task['shard'] is None:
+            task['job'].idle.wait()
+        else:
+            shard_pool.call(task['shard'], 'finish', task_id, timeout=None)
+    except ModbusError:
+        # The shard process is gone, and the task with it
+        pass
+    _finish_task(task_id, task)
+
+def _stop_response(stopped):
+    """Reply to a stop request"""
+    if not stopped:
+        return jsonify({"status": "warning", "message": "Task stop signal sent, but the current poll is still running"})
+    return jsonify({"status": "success", "message": "Task stopped successfully"})
+
+def _start_device_task(data, task_id=None, start_delay=0.0, connect=True):
+    """
+    Create and schedule a single-device continuous task
+    
+    Args:
+        data (dict): Task definition, as sent to /device/continuous
+        task_id (int): Id of a saved task being restored (default: a new id)
+        start_delay (float): Seconds before the first poll
+        connect (bool): Check that the device is reachable first
+    
+    Returns:
+        The task id
+    
+    Raises:
+        ValueError: If the definition is invalid
+    """
+    # Extract device connection parameters
+    host = data.get('host', '127.0.0.1')
+    port = data.get('port', 502)
+    timeout = data.get('timeout', 30)
+    slave_id = data.get('slave_id', 1)
+    
+    # Extract operation parameters
+    operation = data.get('operation', 'read')  # 'read' or 'write'
+    reg_type = data.get('reg_type', 'holding')  # 'holding' or 'input'
+    address = data.get('address', 0)
+    count = data.get('count', 1)
+    data_type = data.get('data_type', 'int16')
+    
+    # Continuous operation specific parameters
+    interval = data.get('interval', 1.0)  # seconds between operations
+    callback_url = data.get('callback_url', None)  # Optional webhook URL to send results to
+    
+    # Value only needed for write operations
+    value = data.get('value', None)
+    skip_unchanged = data.get('skip_unchanged', True)  # don't rewrite a setpoint the device already has
+    
+    if operation == 'write' and value is None:
+        raise ValueError("Value is required for write operations")
+    callback_options = _callback_options(data) if callback_url else None
+    history = _history_plan('device', data)
+    # Report-by-exception: only significant changes and heartbeats go downstream
+    change_filter = DeadbandFilter.from_config(data) if operation == 'read' else None
+    
+    if connect:
+        # Make sure the device is reachable before creating the task
+        connection_pool.check(host, port, timeout)
+    
+    task_id = _register_task(f"{host}:{port}", operation, callback_url, [change_filter], [f"{host}:{port}"],
+                             task_id)
+    if callback_url:
+        webhook_dispatcher.register(task_id, callback_url, **callback_options)
+    tag = _tag_name(data)
+    
+    # Poll function run by the scheduler on every interval
+    def poll():
+        try:
+            if operation == 'write':
+                # Queued with other writes to the device; an unchanged setpoint is not resent
+                write_queue.write(host, port, address, value, slave_id, data_type, reg_type, timeout,
+                                  skip_unchanged)
+                return
             
-            # Store task info
-            continuous_tasks[task_id] = {
-                'stop_event': stop_event,
-                'thread': None,
-                'status': 'starting',
-                'device': f"{host}:{port}",
-                'operation': operation
-            }
-        
-        # Define the worker function
-        def continuous_worker(controller, stop_event, operation, reg_type, address, 
-                              count, slave_id, data_type, value, interval, callback_url):
-            try:
-                while not stop_event.is_set():
-                    try:
-                        if operation == 'read':
-                            result = controller.read_data(reg_type, address, count, slave_id, data_type)
-                            # If webhook callback is provided, send the result (not implemented here)
-                            if callback_url:
-                                # This would be implemented with requests library
-                                pass
-                        else:  # write
-                            controller.write_data(address, value, slave_id, data_type)
-                    
-                    except Exception as e:
-                        print(f"Error in continuous operation: {str(e)}")
-                    
-                    # Wait for the next interval
-                    time.sleep(interval)
-            finally:
-                controller.close()
+            with connection_pool.connection(host, port, timeout) as controller:
+                result = controller.read_data(reg_type, address, count, slave_id, data_type)
+                timestamp = time.time()
+                significant = change_filter is None or change_filter.check(result, timestamp)
+                # Live subscribers get every sample; the filter decides what counts as a change
+                stream_hub.publish(task_id, tag, result, timestamp=timestamp,
+                                   changed=None if change_filter is None else significant)
+                if not significant:
+                    # Unchanged: only confirm that the cached value is still current
+                    value_cache.touch(task_id, tag, timestamp)
+                    return
+                value_cache.update(task_id, tag, result, timestamp=timestamp)
+                history_store.record(task_id, tag, result, timestamp)
+                # Hand the sample to the delivery pipeline; this never blocks polling
+                if callback_url:
+                    webhook_dispatcher.submit(task_id, callback_url, {
+                        "task_id": task_id,
+                        "tag": tag,
+                        "timestamp": timestamp,
+                        "data": result
+                    }, key=tag)
         
-        # Start the worker thread
-        worker_thread = threading.Thread(
-            target=continuous_worker,
-            args=(controller, stop_event, operation, reg_type, address, count, 
-                  slave_id, data_type, value, interval, callback_url)
-        )
-        worker_thread.daemon = True
-        worker_thread.start()
-        
-        # Update task info
-        with task_lock:
-            continuous_tasks[task_id]['thread'] = worker_thread
-            continuous_tasks[task_id]['status'] = 'running'
+        except Exception as e:
+            if operation == 'read':
+                value_cache.update(task_id, tag, error=str(e))
+                stream_hub.publish(task_id, tag, error=str(e))
+                if change_filter is not None:
+                    change_filter.failed()
+            _poll_failed(task_id, f"{host}:{port}", e)
+            raise
+    
+    # Tasks on the same device share a lane so they reuse one connection;
+    # pipelined devices take concurrent polls on their shared connection
+    lane = None if connection_pool.is_pipelined(host, port) else (host, port)
+    _start_task(task_id, poll, interval, lane=lane, history=history, start_delay=start_delay)
+    return task_id
+
+def restore_tasks():
+    """
+    Recreate the tasks saved in task_store (called by create_app)
+    
+    Connections to all their devices are opened in parallel first, then each
+    task starts at its own phase within its interval, so a restart doesn't
+    hit the devices with a burst of connects and simultaneous first polls.
+    
+    Returns:
+        Number of tasks restored
+    """
+    global next_task_id
+    saved = [(task_id, kind, data) for task_id, kind, data in task_store.load() if task_id not in continuous_tasks]
+    with task_lock:
+        next_task_id = max(next_task_id, task_store.next_id())
+    
+    # Warm each device in the process that will poll it: all shards and this one at once
+    groups = {}
+    for _, kind, data in saved:
+        devices = _task_devices(kind, data)
+        shard = shard_pool.owner(devices) if shard_pool.enabled and devices else None
+        groups.setdefault(shard, set()).update(devices)
+    remote = [shard_pool.submit(shard, 'warm', sorted(devices), WARM_TIMEOUT)
+              for shard, devices in groups.items() if shard is not None]
+    errors = connection_pool.warm(groups.get(None, ()), timeout=WARM_TIMEOUT)
+    for future in remote:
+        try:
+            errors.update(future.result())
+        except Exception as e:
+            log.error("Error warming shard connections: %s", e)
+    for device, error in errors.items():
+        if error is not None:
+            log.warning("Device %s unreachable while restoring tasks: %s", device, error)
+    
+    restored = 0
+    for task_id, kind, data in saved:
+        try:
+            # Golden-ratio phases spread any number of tasks evenly over the interval
+            phase = (task_id * PHASE_STEP) % 1.0 * data.get('interval', 1.0)
+            _create_task(kind, data, task_id, start_delay=phase, connect=False)
+            restored += 1
+        except Exception as e:
+            log.error("Error restoring continuous task %s: %s", task_id, e)
+    return restored
+
+@continuous_bp.route('/device/continuous', methods=['POST'])
+def start_continuous_operation():
+    """Start continuous read or write operations on a single device"""
+    try:
+        data = request.get_json()
+        task_id = _create_task('device', data)
+        task_store.save(task_id, 'device', data)
         
         return jsonify({
-            "status": "success", 
-            "message": "Continuous operation started", 
+            "status": "success",
+            "message": "Continuous operation started",
             "task_id": task_id
         })
-        
+    
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": f"Error starting continuous operation: {str(e)}"}), 500
 
@@ -113,137 +425,185 @@ def stop_continuous_operation(task_id):
             return jsonify({"status": "error", "message": "Task not found"}), 404
         
         task = continuous_tasks[task_id]
-        if task['status'] != 'running':
-            return jsonify({"status": "error", "message": f"Task is not running, current status: {task['status']}"}), 400
-        
-        # Signal the thread to stop
-        task['stop_event'].set()
-        task['status'] = 'stopping'
+        status = task['status']
+        if status == 'running':
+            task['status'] = 'stopping'
+        elif status not in ('stopping', 'stop_timeout', 'stopped'):
+            return jsonify({"status": "error", "message": f"Task is not running, current status: {status}"}), 400
     
-    # Wait for the thread to terminate (with timeout)
-    task['thread'].join(timeout=5.0)
+    if status != 'running':
+        # A repeated stop: report the first one, giving a late poll a little more time
+        return _stop_response(task['finished'].wait(STOP_TIMEOUT))
     
-    with task_lock:
-        if task['thread'].is_alive():
+    # Remove the task from the scheduler and wait for a run in progress (with timeout)
+    stopped = _cancel_task(task_id, task)
+    task_store.delete(task_id)
+    
+    if stopped:
+        _finish_task(task_id, task)
+    else:
+        with task_lock:
             task['status'] = 'stop_timeout'
-            return jsonify({"status": "warning", "message": "Task stop signal sent, but thread is still running"})
-        else:
-            task['status'] = 'stopped'
-            return jsonify({"status": "success", "message": "Task stopped successfully"})
+        threading.Thread(target=_finish_when_idle, args=(task_id, task), name=f"modbus-task-{task_id}-stop",
+                         daemon=True).start()
+    return _stop_response(stopped)
 
 
-@continuous_bp.route('/devices/continuous', methods=['POST'])
-def start_continuous_multiple_devices():
-    """Start continuous operations on multiple devices"""
-    try:
-        data = request.get_json()
-        devices = data.get('devices', [])
-        interval = data.get('interval', 1.0)
-        callback_url = data.get('callback_url', None)
-        
-        if not devices:
-            return jsonify({"status": "error", "message": "No devices specified"}), 400
-        
-        # Create controller for each device
-        controllers = []
-        for device in devices:
-            host = device.get('host', '127.0.0.1')
-            port = device.get('port', 502)
-            timeout = device.get('timeout', 30)
-            controllers.append(ModbusController(host, port, timeout))
+def _start_devices_task(data, task_id=None, start_delay=0.0, connect=True):
+    """
+    Create and schedule a multi-device continuous task
+    
+    Args and return value as for _start_device_task; data is the body sent to /devices/continuous
+    """
+    devices = data.get('devices', [])
+    interval = data.get('interval', 1.0)
+    callback_url = data.get('callback_url', None)
+    skip_unchanged = data.get('skip_unchanged', True)  # per-device setting takes precedence
+    
+    if not devices:
+        raise ValueError("No devices specified")
+    callback_options = _callback_options(data) if callback_url else None
+    history = _history_plan('devices', data)
+    # Per-tag deadbands; request-level settings apply to every read without its own
+    defaults = {name: data.get(name) for name in FILTER_FIELDS}
+    filters = [DeadbandFilter.from_config(device, defaults)
+               if device.get('operation', 'read') == 'read' else None
+               for device in devices]
+    filtering = any(f is not None for f in filters)
+    
+    # Make sure every device is reachable before creating the task
+    for device in devices if connect else ():
+        host = device.get('host', '127.0.0.1')
+        port = device.get('port', 502)
+        timeout = device.get('timeout', 30)
+        connection_pool.check(host, port, timeout)
+    
+    task_id = _register_task('multiple', 'multiple', callback_url, filters,
+                             [f"{d.get('host', '127.0.0.1')}:{d.get('port', 502)}" for d in devices], task_id)
+    if callback_url:
+        webhook_dispatcher.register(task_id, callback_url, **callback_options)
+    
+    # The device list is fixed for the lifetime of the task, so reads are
+    # planned once and every poll reuses the same coalesced requests
+    read_plans, unplanned_reads = build_read_plans(devices, max_gap=data.get('max_gap'))
+    
+    tags = [_tag_name(device) for device in devices]
+    
+    def device_result(device, status, **fields):
+        return dict({"device": f"{device.get('host')}:{device.get('port')}", "status": status}, **fields)
+    
+    # Poll function run by the scheduler on every interval
+    def poll():
+        results = [None] * len(devices)
         
-        # Create stop event and task
-        stop_event = threading.Event()
+        for plan, members in read_plans:
+            timeout = max(devices[i].get('timeout', 30) for i in members)
+            try:
+                with connection_pool.connection(plan.host, plan.port, timeout) as controller:
+                    values = plan.execute(controller)
+            except Exception as e:
+                values = [e] * len(members)
+            for i, value in zip(members, values):
+                if isinstance(value, Exception):
+                    _poll_failed(task_id, f"{plan.host}:{plan.port}", value)
+                    results[i] = device_result(devices[i], "error", message=str(value))
+                else:
+                    results[i] = device_result(devices[i], "success", data=value)
         
-        global next_task_id
-        with task_lock:
-            task_id = next_task_id
-            next_task_id += 1
-            
-            continuous_tasks[task_id] = {
-                'stop_event': stop_event,
-                'thread': None,
-                'status': 'starting',
-                'device': 'multiple',
-                'operation': 'multiple'
-            }
+        # This poll's writes are queued together, so each device's writes
+        # go out merged into as few requests as possible
+        writes = [i for i, device in enumerate(devices)
+                  if device.get('operation', 'read') == 'write' and device.get('value') is not None]
+        write_futures = dict(zip(writes, write_queue.submit_many([devices[i] for i in writes], skip_unchanged)))
         
-        # Worker function for multiple devices
-        def multi_device_worker(controllers, devices, stop_event, interval, callback_url):
+        for i, device in enumerate(devices):
+            operation = device.get('operation', 'read')
+            if results[i] is not None or (operation == 'read' and i not in unplanned_reads):
+                continue
             try:
-                while not stop_event.is_set():
-                    results = []
-                    
-                    for i, device in enumerate(devices):
-                        try:
-                            controller = controllers[i]
-                            operation = device.get('operation', 'read')
-                            reg_type = device.get('reg_type', 'holding')
-                            address = device.get('address', 0)
-                            count = device.get('count', 1)
-                            slave_id = device.get('slave_id', 1)
-                            data_type = device.get('data_type', 'int16')
-                            value = device.get('value', None)
-                            
-                            if operation == 'read':
-                                result = controller.read_data(reg_type, address, count, slave_id, data_type)
-                                results.append({
-                                    "device": f"{device.get('host')}:{device.get('port')}",
-                                    "status": "success",
-                                    "data": result
-                                })
-                            elif operation == 'write':
-                                if value is not None:
-                                    controller.write_data(address, value, slave_id, data_type)
-                                    results.append({
-                                        "device": f"{device.get('host')}:{device.get('port')}",
-                                        "status": "success",
-                                        "message": "Write operation completed"
-                                    })
-                                else:
-                                    results.append({
-                                        "device": f"{device.get('host')}:{device.get('port')}",
-                                        "status": "error",
-                                        "message": "Value is required for write operations"
-                                    })
-                        
-                        except Exception as e:
-                            results.append({
-                                "device": f"{device.get('host')}:{device.get('port')}",
-                                "status": "error",
-                                "message": str(e)
-                            })
-                    
-                    # If webhook callback is provided, send the results
-                    if callback_url:
-                        # This would be implemented with requests library
-                        pass
-                        
-                    time.sleep(interval)
+                host = device.get('host', '127.0.0.1')
+                port = device.get('port', 502)
+                timeout = device.get('timeout', 30)
+                reg_type = device.get('reg_type', 'holding')
+                address = device.get('address', 0)
+                count = device.get('count', 1)
+                slave_id = device.get('slave_id', 1)
+                data_type = device.get('data_type', 'int16')
+                value = device.get('value', None)
+                
+                if operation == 'read':
+                    with connection_pool.connection(host, port, timeout) as controller:
+                        result = controller.read_data(reg_type, address, count, slave_id, data_type)
+                    results[i] = device_result(device, "success", data=result)
+                elif operation == 'write':
+                    if value is not None:
+                        write_queue.result(write_futures[i], timeout)
+                        results[i] = device_result(device, "success", message="Write operation completed")
+                    else:
+                        results[i] = device_result(device, "error", message="Value is required for write operations")
             
-            finally:
-                for controller in controllers:
-                    controller.close()
+            except Exception as e:
+                _poll_failed(task_id, f"{device.get('host', '127.0.0.1')}:{device.get('port', 502)}", e)
+                results[i] = device_result(device, "error", message=str(e))
         
-        # Start the worker thread
-        worker_thread = threading.Thread(
-            target=multi_device_worker,
-            args=(controllers, devices, stop_event, interval, callback_url)
-        )
-        worker_thread.daemon = True
-        worker_thread.start()
+        # Cache the latest value of every read and append it to the history;
+        # with deadbands, unchanged reads and successful writes are left out
+        # of the sample and only confirm the cached value
+        timestamp = time.time()
+        reported = [True] * len(devices)
+        for i, device in enumerate(devices):
+            result = results[i]
+            if result is None:
+                continue
+            if device.get('operation', 'read') != 'read':
+                reported[i] = not filtering or result["status"] != "success"
+                continue
+            if result["status"] == "success":
+                significant = filters[i] is None or filters[i].check(result["data"], timestamp)
+                stream_hub.publish(task_id, tags[i], result["data"], timestamp=timestamp,
+                                   changed=None if filters[i] is None else significant)
+                if not significant:
+                    reported[i] = False
+                    value_cache.touch(task_id, tags[i], timestamp)
+                    continue
+                value_cache.update(task_id, tags[i], result["data"], timestamp=timestamp)
+                history_store.record(task_id, tags[i], result["data"], timestamp)
+            else:
+                value_cache.update(task_id, tags[i], error=result["message"], timestamp=timestamp)
+                stream_hub.publish(task_id, tags[i], error=result["message"], timestamp=timestamp)
+                if filters[i] is not None:
+                    filters[i].failed()
         
-        # Update task info
-        with task_lock:
-            continuous_tasks[task_id]['thread'] = worker_thread
-            continuous_tasks[task_id]['status'] = 'running'
+        # Operations other than read/write produce no result, as before
+        results = [result for i, result in enumerate(results) if result is not None and reported[i]]
+        
+        # If webhook callback is provided, queue the results for delivery
+        if callback_url and (results or not filtering):
+            webhook_dispatcher.submit(task_id, callback_url, {
+                "task_id": task_id,
+                "timestamp": timestamp,
+                "results": results
+            }, key=task_id)
+    
+    _start_task(task_id, poll, interval, history=history, start_delay=start_delay)
+    return task_id
+
+@continuous_bp.route('/devices/continuous', methods=['POST'])
+def start_continuous_multiple_devices():
+    """Start continuous operations on multiple devices"""
+    try:
+        data = request.get_json()
+        task_id = _create_task('devices', data)
+        task_store.save(task_id, 'devices', data)
         
         return jsonify({
-            "status": "success", 
-            "message": "Continuous multi-device operation started", 
+            "status": "success",
+            "message": "Continuous multi-device operation started",
             "task_id": task_id
         })
-        
+    
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": f"Error starting continuous operation: {str(e)}"}), 500
 
@@ -251,15 +611,175 @@ def start_continuous_multiple_devices():
 @continuous_bp.route('/tasks', methods=['GET'])
 def list_tasks():
     """List all active tasks"""
-    with task_lock:
-        task_list = [{
-            "id": tid,
-            "status": task["status"],
-            "device": task["device"],
-            "operation": task["operation"]
-        } for tid, task in continuous_tasks.items()]
-    
     return jsonify({
         "status": "success",
-        "tasks": task_list
-    })
\ No newline at end of file
+        "tasks": task_summaries()
+    })
+
+
+@continuous_bp.route('/tasks/<int:task_id>/data', methods=['GET'])
+def get_task_data(task_id):
+    """Return the latest cached values of a continuous read task"""
+    media_type = negotiate(request.headers.get('Accept'))
+    if media_type is None:
+        return jsonify({"status": "error", "message": not_acceptable_message()}), 406
+    
+    tags = request.args.get('tags')
+    values = value_cache.get(task_id, tags.split(',') if tags else None)
+    if values is None:
+        return jsonify({"status": "error", "message": "Task not found"}), 404
+    
+    return negotiated_response(media_type, {
+        "status": "success",
+        "task_id": task_id,
+        "tags": values
+    }, lambda: tag_sections(values))
+
+
+@continuous_bp.route('/tasks/<int:task_id>/stream', methods=['GET'])
+@continuous_bp.route('/tasks/<int:task_id>/stream', methods=['GET'], websocket=True, endpoint='stream_task_data_ws')
+def stream_task_data(task_id):
+    """Push the samples of a continuous task as Server-Sent Events, or WebSocket messages on upgrade"""
+    tags = request.args.get('tags')
+    changes_only = request.args.get('changes', 'false').lower() in ('1', 'true', 'yes')
+    buffer_size = request.args.get('buffer', DEFAULT_BUFFER, type=int)
+    if not 1 <= buffer_size <= MAX_BUFFER:
+        return jsonify({"status": "error", "message": f"buffer must be between 1 and {MAX_BUFFER}"}), 400
+    
+    # Subscribe before taking the snapshot so no sample falls in between
+    subscription = stream_hub.subscribe(task_id, tags.split(',') if tags else None, changes_only, buffer_size)
+    snapshot = value_cache.get(task_id, tags.split(',') if tags else None)
+    if snapshot is None:
+        stream_hub.unsubscribe(subscription)
+        return jsonify({"status": "error", "message": "Task not found"}), 404
+    
+    if request.headers.get('Upgrade', '').lower() == 'websocket':
+        return _websocket_stream(subscription, snapshot)
+    
+    def events():
+        try:
+            yield _sse_event('snapshot', {"task_id": task_id, "tags": snapshot})
+            while True:
+                samples, dropped = subscription.wait(KEEPALIVE_INTERVAL)
+                # One write per wakeup, however many samples queued up
+                chunk = [_sse_event('dropped', {"dropped": dropped})] if dropped else []
+                chunk.extend(_sse_event('sample', sample, sample["id"]) for sample in samples)
+                if subscription.closed and not samples:
+                    yield b''.join(chunk) + _sse_event('end', {"task_id": task_id})
+                    return
+                # A comment line keeps proxies from timing out and detects gone clients
+                yield b''.join(chunk) if chunk else b': keepalive\n\n'
+        finally:
+            stream_hub.unsubscribe(subscription)
+    
+    return Response(events(), content_type='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def _sse_event(name, data, event_id=None):
+    """Format one Server-Sent Event"""
+    prefix = f"event: {name}\n" + (f"id: {event_id}\n" if event_id is not None else "")
+    return prefix.encode() + b'data: ' + dumps_json(data) + b'\n\n'
+
+
+def _websocket_stream(subscription, snapshot):
+    """Serve a subscription over a WebSocket (needs the optional simple-websocket package)"""
+    try:
+        from simple_websocket import ConnectionClosed, Server
+    except ImportError:
+        stream_hub.unsubscribe(subscription)
+        return jsonify({"status": "error", "message": "WebSocket streams need simple-websocket "
+                                                      "(pip install simple-websocket); use Server-Sent Events instead"}), 501
+    
+    try:
+        ws = Server.accept(request.environ)
+    except RuntimeError as e:
+        # The WSGI server doesn't expose its socket (only Werkzeug, Gunicorn, Eventlet and Gevent do)
+        stream_hub.unsubscribe(subscription)
+        return jsonify({"status": "error", "message": f"WebSocket streams are not supported here: {str(e)}"}), 501
+    
+    try:
+        ws.send(dumps_json({"event": "snapshot", "task_id": subscription.task_id, "tags": snapshot}).decode())
+        while ws.connected:
+            samples, dropped = subscription.wait(KEEPALIVE_INTERVAL)
+            if dropped:
+                ws.send(dumps_json({"event": "dropped", "dropped": dropped}).decode())
+            for sample in samples:
+                ws.send(dumps_json(dict(sample, event="sample")).decode())
+            if subscription.closed and not samples:
+                ws.send(dumps_json({"event": "end", "task_id": subscription.task_id}).decode())
+                break
+    except ConnectionClosed:
+        pass
+    finally:
+        stream_hub.unsubscribe(subscription)
+        if ws.connected:
+            ws.close()
+    
+    class WebSocketResponse(Response):
+        def __call__(self, *args, **kwargs):
+            # The socket was taken over; the development server drops the
+            # connection on ConnectionError instead of writing a response
+            if ws.mode == 'werkzeug':
+                raise ConnectionError()
+            return []
+    
+    return WebSocketResponse()
+
+
+@continuous_bp.route('/tasks/<int:task_id>/history', methods=['GET'])
+def get_task_history(task_id):
+    """Return the history of a continuous read task over a time range"""
+    try:
+        tags = request.args.get('tags')
+        start = request.args.get('start', None, type=float)
+        end = request.args.get('end', None, type=float)
+        max_points = request.args.get('max_points', DEFAULT_MAX_POINTS, type=int)
+        tier = request.args.get('tier', None)  # 'raw', '1s' or '1m'; chosen from the span by default
+        
+        if tier is not None and tier not in TIER_NAMES:
+            return jsonify({"status": "error", "message": f"Invalid tier. Use one of {', '.join(TIER_NAMES)}"}), 400
+        if start is not None and end is not None and start > end:
+            return jsonify({"status": "error", "message": "start must not be after end"}), 400
+        
+        history = history_store.query(task_id, tags.split(',') if tags else None, start, end, tier, max_points)
+        if history is None:
+            return jsonify({"status": "error", "message": "Task not found or keeps no history"}), 404
+        
+        return jsonify({
+            "status": "success",
+            "task_id": task_id,
+            "tags": history
+        })
+    
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Unexpected error: {str(e)}"}), 500
+
+
+@continuous_bp.route('/tasks/data', methods=['POST'])
+def get_tasks_data():
+    """Return the latest cached values of many tasks in one response"""
+    try:
+        media_type = negotiate(request.headers.get('Accept'))
+        if media_type is None:
+            return jsonify({"status": "error", "message": not_acceptable_message()}), 406
+        
+        data = request.get_json(silent=True) or {}
+        task_ids = data.get('task_ids') or value_cache.task_ids()
+        tags = data.get('tags', None)  # optional filter applied to every task
+        
+        results = {}
+        for task_id in task_ids:
+            values = value_cache.get(task_id, tags)
+            if values is not None:
+                results[str(task_id)] = values
+        
+        # Typed array sections are named task_id/tag
+        return negotiated_response(media_type, {
+            "status": "success",
+            "tasks": results
+        }, lambda: [section for task_id, values in results.items()
+                    for section in tag_sections(values, f"{task_id}/")])
+    
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Unexpected error: {str(e)}"}), 500
@@ -0,0 +1,11 @@
+from flask import Blueprint, Response
+from metrics import metrics
+from shard_pool import shard_pool
+
+# Create Blueprint for the Prometheus scrape endpoint
+metrics_bp = Blueprint('metrics', __name__)
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Return all metrics in the Prometheus text exposition format, including those of shard processes"""
+    return Response(metrics.render(shard_pool.metric_families()), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,85 +1,245 @@
 from flask import Blueprint, request, jsonify
-from modbus_controller import ModbusController, ModbusError
+from concurrent.futures import ThreadPoolExecutor, wait
+import time
+from modbus_controller import BIT_TYPES, DeviceBusyError, ModbusError
+from connection_pool import connection_pool
+from register_codec import BIT_FORMATS, CodecError, format_bits
+from read_planner import build_read_plans
+from write_queue import write_queue
+from shard_pool import shard_pool
+from priority_classes import BULK, PRIORITY_CLASSES, with_class
+from response_encoding import batch_sections, negotiate, negotiated_response, not_acceptable_message, retry_after_header
 
 # Create Blueprint for multi-device operations
 multi_device_bp = Blueprint('multi_device', __name__, url_prefix='/api/modbus/devices')
 
+# Bounded worker pool shared by all batch requests
+MAX_BATCH_WORKERS = 32
+batch_executor = ThreadPoolExecutor(max_workers=MAX_BATCH_WORKERS, thread_name_prefix='modbus-batch')
+
+def execute_operation(op):
+    """Run one batch operation and return its result entry"""
+    # Extract device connection parameters
+    host = op.get('host', '127.0.0.1')
+    port = op.get('port', 502)
+    timeout = op.get('timeout', 30)
+    slave_id = op.get('slave_id', 1)
+
+    # Extract operation parameters
+    operation = op.get('operation', 'read')
+    reg_type = op.get('reg_type', 'holding')
+    address = op.get('address', 0)
+    count = op.get('count', 1)
+    data_type = op.get('data_type', 'int16')
+    bit_format = op.get('bit_format', 'list')
+    value = op.get('value', None)
+
+    try:
+        if operation not in ('read', 'write'):
+            return {
+                "status": "error",
+                "host": host,
+                "port": port,
+                "message": "Invalid operation. Use 'read' or 'write'"
+            }
+        if operation == 'write' and value is None:
+            return {
+                "status": "error",
+                "host": host,
+                "port": port,
+                "message": "Value is required for write operations"
+            }
+        if bit_format not in BIT_FORMATS:
+            return {
+                "status": "error",
+                "host": host,
+                "port": port,
+                "message": f"Invalid bit_format. Use one of {', '.join(BIT_FORMATS)}"
+            }
+
+        if operation == 'write':
+            result = write_queue.write(host, port, address, value, slave_id, data_type, reg_type,
+                                       timeout, op.get('skip_unchanged', False))
+            return _write_result(op, result)
+
+        with connection_pool.connection(host, port, timeout) as controller:
+            result = controller.read_data(reg_type, address, count, slave_id, data_type)
+            if reg_type in BIT_TYPES:
+                result = format_bits(result, bit_format)
+            return {
+                "status": "success",
+                "host": host,
+                "port": port,
+                "data": result
+            }
+
+    except ModbusError as e:
+        return _error_result(op, e)
+    except Exception as e:
+        return {
+            "status": "error",
+            "host": host,
+            "port": port,
+            "message": f"Unexpected error: {str(e)}"
+        }
+
+def _error_result(op, error):
+    """Build the result entry for a failed operation; a saturated device adds a retry hint"""
+    result = {"status": "error", "host": op.get('host', '127.0.0.1'), "port": op.get('port', 502),
+              "message": str(error)}
+    if isinstance(error, DeviceBusyError):
+        result["retry_after"] = error.retry_after
+    return result
+
+def _read_result(op, value):
+    """Build the result entry for a coalesced read"""
+    host = op.get('host', '127.0.0.1')
+    port = op.get('port', 502)
+    if isinstance(value, ModbusError):
+        return _error_result(op, value)
+    if op.get('reg_type', 'holding') in BIT_TYPES:
+        try:
+            value = format_bits(value, op.get('bit_format', 'list'))
+        except CodecError as e:
+            return {"status": "error", "host": host, "port": port, "message": str(e)}
+    return {"status": "success", "host": host, "port": port, "data": value}
+
+def _write_result(op, result):
+    """Build the result entry for a completed write ('written' or 'unchanged')"""
+    return {
+        "status": "success",
+        "host": op.get('host', '127.0.0.1'),
+        "port": op.get('port', 502),
+        "message": "Write operation completed",
+        "result": result
+    }
+
+def _run_writes(operations, indexes, results):
+    """Run a run of write operations on one device through its write queue, merged into few requests"""
+    futures = write_queue.submit_many([operations[i] for i in indexes])
+    for i, future in zip(indexes, futures):
+        op = operations[i]
+        try:
+            results[i] = _write_result(op, write_queue.result(future, op.get('timeout', 30)))
+        except ModbusError as e:
+            results[i] = _error_result(op, e)
+        except Exception as e:
+            results[i] = {"status": "error", "host": op.get('host', '127.0.0.1'), "port": op.get('port', 502),
+                          "message": f"Unexpected error: {str(e)}"}
+
+def _run_reads(operations, indexes, results, max_gap):
+    """Run a run of read operations on one device using coalesced read plans"""
+    if len(indexes) <= 1:
+        for i in indexes:
+            results[i] = execute_operation(operations[i])
+        return
+
+    plans, unplanned = build_read_plans(operations, indexes, max_gap)
+    for i in unplanned:
+        results[i] = execute_operation(operations[i])
+
+    for plan, members in plans:
+        timeout = max(operations[i].get('timeout', 30) for i in members)
+        try:
+            with connection_pool.connection(plan.host, plan.port, timeout) as controller:
+                values = plan.execute(controller)
+        except ModbusError as e:
+            values = [e] * len(members)
+        except Exception as e:
+            values = [ModbusError(f"Unexpected error: {str(e)}")] * len(members)
+        for i, value in zip(members, values):
+            results[i] = _read_result(operations[i], value)
+
+def _run_device_group(operations, indexes, results, deadline, coalesce, max_gap):
+    """Run the operations for one device in request order, stopping at the deadline"""
+    # Consecutive reads can be reordered among themselves, so they are
+    # collected and coalesced until the next write; consecutive writes are
+    # likewise merged until the next read (the last write to an address wins)
+    reads = []
+    writes = []
+    for i in indexes:
+        if time.monotonic() >= deadline:
+            return
+        operation = operations[i].get('operation', 'read')
+        if coalesce and operation == 'read':
+            _run_writes(operations, writes, results)
+            writes = []
+            reads.append(i)
+            continue
+        _run_reads(operations, reads, results, max_gap)
+        reads = []
+        if coalesce and operation == 'write' and operations[i].get('value') is not None:
+            writes.append(i)
+            continue
+        _run_writes(operations, writes, results)
+        writes = []
+        if time.monotonic() >= deadline:
+            return
+        results[i] = execute_operation(operations[i])
+    _run_reads(operations, reads, results, max_gap)
+    _run_writes(operations, writes, results)
+
 @multi_device_bp.route('', methods=['POST'])
 def multi_device_operation():
     """Perform operations on multiple devices"""
     try:
+        # Results are encoded as the Accept header asks (JSON by default)
+        media_type = negotiate(request.headers.get('Accept'))
+        if media_type is None:
+            return jsonify({"status": "error", "message": not_acceptable_message()}), 406
+
         data = request.get_json()
         operations = data.get('operations', [])
-        results = []
-        
-        for op in operations:
-            # Extract device connection parameters
-            host = op.get('host', '127.0.0.1')
-            port = op.get('port', 502)
-            timeout = op.get('timeout', 30)
-            slave_id = op.get('slave_id', 1)
-            
-            # Extract operation parameters
-            operation = op.get('operation', 'read')
-            reg_type = op.get('reg_type', 'holding')
-            address = op.get('address', 0)
-            count = op.get('count', 1)
-            data_type = op.get('data_type', 'int16')
-            value = op.get('value', None)
-            
-            try:
-                controller = ModbusController(host, port, timeout)
-                
-                if operation == 'read':
-                    result = controller.read_data(reg_type, address, count, slave_id, data_type)
-                    results.append({
-                        "status": "success",
-                        "host": host,
-                        "port": port,
-                        "data": result
-                    })
-                elif operation == 'write':
-                    if value is None:
-                        results.append({
-                            "status": "error",
-                            "host": host,
-                            "port": port,
-                            "message": "Value is required for write operations"
-                        })
-                        continue
-                    controller.write_data(address, value, slave_id, data_type)
-                    results.append({
-                        "status": "success",
-                        "host": host,
-                        "port": port,
-                        "message": "Write operation completed"
-                    })
-                else:
-                    results.append({
-                        "status": "error",
-                        "host": host,
-                        "port": port,
-                        "message": "Invalid operation. Use 'read' or 'write'"
-                    })
-                
-                controller.close()
-                
-            except ModbusError as e:
-                results.append({
-                    "status": "error",
-                    "host": host,
-                    "port": port,
-                    "message": str(e)
-                })
-            except Exception as e:
-                results.append({
+        deadline_seconds = data.get('deadline', 30)  # seconds for the whole batch
+        deadline = time.monotonic() + deadline_seconds
+        coalesce = data.get('coalesce', True)  # merge nearby reads into fewer requests
+        max_gap = data.get('max_gap')
+        priority = data.get('priority', BULK)  # class of the batch's reads when devices are busy
+        if priority not in PRIORITY_CLASSES:
+            return jsonify({"status": "error", "message": f"Invalid priority. Use one of {', '.join(PRIORITY_CLASSES)}"}), 400
+
+        # Group operations per device so each device sees its operations in
+        # request order, while different devices are served concurrently
+        groups = {}
+        for i, op in enumerate(operations):
+            key = (op.get('host', '127.0.0.1'), op.get('port', 502))
+            groups.setdefault(key, []).append(i)
+
+        results = [None] * len(operations)
+        futures = [
+            batch_executor.submit(with_class(priority, _run_device_group), operations, indexes, results, deadline,
+                                  coalesce, max_gap)
+            for indexes in groups.values()
+        ]
+        wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+
+        # Snapshot the results; operations that didn't finish in time are
+        # reported as errors and any late results are discarded
+        results = list(results)
+        partial = False
+        for i, result in enumerate(results):
+            if result is None:
+                partial = True
+                results[i] = {
                     "status": "error",
-                    "host": host,
-                    "port": port,
-                    "message": f"Unexpected error: {str(e)}"
-                })
-        
-        return jsonify({"status": "success", "results": results})
-            
+                    "host": operations[i].get('host', '127.0.0.1'),
+                    "port": operations[i].get('port', 502),
+                    "message": "Batch deadline exceeded"
+                }
+
+        # Breaker state and timing of every device in the batch
+        health = shard_pool.health([f"{host}:{port}" for host, port in groups])
+
+        payload = {"status": "success", "partial": partial, "results": results, "devices": health}
+
+        # Operations turned away by saturated devices carry a retry hint; if
+        # the whole batch was turned away, so is the request
+        retry_hints = [result["retry_after"] for result in results if "retry_after" in result]
+        status = 429 if retry_hints and len(retry_hints) == len(results) else 200
+        response = negotiated_response(media_type, payload, lambda: batch_sections(operations, results), status)
+        if retry_hints:
+            response.headers['Retry-After'] = retry_after_header(max(retry_hints))
+        return response
+
     except Exception as e:
-        return jsonify({"status": "error", "message": f"Unexpected error: {str(e)}"}), 500
\ No newline at end of file
+        return jsonify({"status": "error", "message": f"Unexpected error: {str(e)}"}), 500
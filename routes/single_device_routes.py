@@ -1,5 +1,10 @@
 from flask import Blueprint, request, jsonify
-from modbus_controller import ModbusController, ModbusError
+from modbus_controller import BIT_TYPES, DeviceBusyError, ModbusError
+from connection_pool import connection_pool
+from register_codec import BIT_FORMATS, format_bits
+from write_queue import write_queue
+from priority_classes import INTERACTIVE, PRIORITY_CLASSES, priority_class
+from response_encoding import negotiate, negotiated_response, not_acceptable_message, retry_after_header, value_sections
 
 # Create Blueprint for single device operations
 single_device_bp = Blueprint('single_device', __name__, url_prefix='/api/modbus/device')
@@ -18,30 +23,48 @@ def single_device_operation():
         
         # Extract operation parameters
         operation = data.get('operation', 'read')  # 'read' or 'write'
-        reg_type = data.get('reg_type', 'holding')  # 'holding' or 'input'
+        reg_type = data.get('reg_type', 'holding')  # 'holding', 'input', 'coil' or 'discrete'
         address = data.get('address', 0)
         count = data.get('count', 1)
         data_type = data.get('data_type', 'int16')  # 'int16', 'uint16', 'float32', etc.
+        bit_format = data.get('bit_format', 'list')  # coils/discrete inputs: 'list', 'bitstring' or 'packed'
         
         # Value only needed for write operations
         value = data.get('value', None)
+        skip_unchanged = data.get('skip_unchanged', False)  # don't resend the value last written
+        priority = data.get('priority', INTERACTIVE)  # class of a read when the device is busy
         
-        controller = ModbusController(host, port, timeout)
+        if operation == 'write' and value is None:
+            return jsonify({"status": "error", "message": "Value is required for write operations"}), 400
+        if operation not in ('read', 'write'):
+            return jsonify({"status": "error", "message": "Invalid operation. Use 'read' or 'write'"}), 400
+        if bit_format not in BIT_FORMATS:
+            return jsonify({"status": "error", "message": f"Invalid bit_format. Use one of {', '.join(BIT_FORMATS)}"}), 400
+        if priority not in PRIORITY_CLASSES:
+            return jsonify({"status": "error", "message": f"Invalid priority. Use one of {', '.join(PRIORITY_CLASSES)}"}), 400
+        
+        # Reads are encoded as the Accept header asks (JSON by default)
+        media_type = negotiate(request.headers.get('Accept'))
+        if operation == 'read' and media_type is None:
+            return jsonify({"status": "error", "message": not_acceptable_message()}), 406
         
-        if operation == 'read':
+        if operation == 'write':
+            # Writes go through the device's write queue, merged with concurrent writes
+            result = write_queue.write(host, port, address, value, slave_id, data_type, reg_type,
+                                       timeout, skip_unchanged)
+            return jsonify({"status": "success", "message": "Write operation completed", "result": result})
+        
+        with priority_class(priority), connection_pool.connection(host, port, timeout) as controller:
             result = controller.read_data(reg_type, address, count, slave_id, data_type)
-            controller.close()
-            return jsonify({"status": "success", "data": result})
-        elif operation == 'write':
-            if value is None:
-                return jsonify({"status": "error", "message": "Value is required for write operations"}), 400
-            controller.write_data(address, value, slave_id, data_type)
-            controller.close()
-            return jsonify({"status": "success", "message": "Write operation completed"})
-        else:
-            controller.close()
-            return jsonify({"status": "error", "message": "Invalid operation. Use 'read' or 'write'"}), 400
-            
+            if reg_type in BIT_TYPES:
+                result = format_bits(result, bit_format)
+            return negotiated_response(media_type, {"status": "success", "data": result},
+                                       lambda: value_sections(result, data_type))
+    
+    except DeviceBusyError as e:
+        # The device's queue is saturated: tell the client when to come back
+        return (jsonify({"status": "error", "message": str(e), "retry_after": e.retry_after}), 429,
+                {"Retry-After": retry_after_header(e.retry_after)})
     except ModbusError as e:
         return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
@@ -0,0 +1,105 @@
+from flask import Blueprint, request, jsonify
+from modbus_controller import DeviceBusyError, ModbusError
+from tag_registry import tag_registry
+from routes.multi_device_routes import batch_executor
+
+# Create Blueprint for the device/tag registry
+tag_bp = Blueprint('tags', __name__, url_prefix='/api/modbus')
+
+@tag_bp.route('/registry', methods=['GET'])
+def get_registry():
+    """Return the device, tag and group configuration"""
+    return jsonify({"status": "success", "registry": tag_registry.to_dict()})
+
+
+@tag_bp.route('/registry', methods=['PUT'])
+def replace_registry():
+    """Replace the whole configuration"""
+    try:
+        tag_registry.replace(request.get_json())
+        return jsonify({"status": "success", "message": "Registry updated"})
+    except ModbusError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Unexpected error: {str(e)}"}), 500
+
+
+@tag_bp.route('/registry/devices/<name>', methods=['PUT'])
+def put_device(name):
+    """Add or replace a device and its tags"""
+    try:
+        tag_registry.set_device(name, request.get_json())
+        return jsonify({"status": "success", "message": f"Device {name} updated"})
+    except ModbusError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Unexpected error: {str(e)}"}), 500
+
+
+@tag_bp.route('/registry/devices/<name>', methods=['DELETE'])
+def delete_device(name):
+    """Remove a device"""
+    try:
+        tag_registry.remove_device(name)
+        return jsonify({"status": "success", "message": f"Device {name} removed"})
+    except KeyError:
+        return jsonify({"status": "error", "message": "Device not found"}), 404
+    except ModbusError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+
+@tag_bp.route('/registry/groups/<name>', methods=['PUT'])
+def put_group(name):
+    """Add or replace a group of tags"""
+    try:
+        data = request.get_json()
+        tag_registry.set_group(name, data.get('tags', []))
+        return jsonify({"status": "success", "message": f"Group {name} updated"})
+    except ModbusError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Unexpected error: {str(e)}"}), 500
+
+
+@tag_bp.route('/registry/groups/<name>', methods=['DELETE'])
+def delete_group(name):
+    """Remove a group"""
+    try:
+        tag_registry.remove_group(name)
+        return jsonify({"status": "success", "message": f"Group {name} removed"})
+    except KeyError:
+        return jsonify({"status": "error", "message": "Group not found"}), 404
+
+
+@tag_bp.route('/tags', methods=['GET'])
+def list_tags():
+    """List all compiled tags"""
+    return jsonify({"status": "success", "tags": tag_registry.list_tags()})
+
+
+@tag_bp.route('/tags/read', methods=['POST'])
+def read_tags():
+    """Read tags by name and/or group; devices are read concurrently"""
+    try:
+        data = request.get_json()
+        work = tag_registry.resolve(data.get('tags', []), data.get('groups', []))
+        
+        futures = [batch_executor.submit(device.read, tag_names, selection)
+                   for device, tag_names, selection in work]
+        
+        results = {}
+        for future in futures:
+            for name, value in future.result().items():
+                if isinstance(value, DeviceBusyError):
+                    results[name] = {"status": "error", "message": str(value), "retry_after": value.retry_after}
+                elif isinstance(value, Exception):
+                    results[name] = {"status": "error", "message": str(value)}
+                else:
+                    results[name] = {"status": "success", "value": value}
+        
+        return jsonify({"status": "success", "tags": results})
+    
+    except ModbusError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Unexpected error: {str(e)}"}), 500
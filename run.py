@@ -12,11 +12,11 @@ if __name__ == '__main__':
     print("Setting up the Modbus Flask API server...")
     
     try:
-        from app import create_app
+        from app import create_app, serving_process
         
-        app = create_app()
+        app = create_app(serving=serving_process())
         print("Starting the server...")
-        app.run(debug=True, host='0.0.0.0', port=5000)
+        app.run(host='0.0.0.0', port=5000)
     except ImportError as e:
         print(f"Error: {e}")
         print("Please install the required dependencies:")
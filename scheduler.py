@@ -0,0 +1,239 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics, scheduler_lag_seconds, scheduler_overruns_total
+
+def _lane_label(lane):
+    """Metric label for a lane; device lanes are (host, port) tuples"""
+    if isinstance(lane, tuple) and len(lane) == 2:
+        return f"{lane[0]}:{lane[1]}"
+    return str(lane)
+
+
+class ScheduledJob:
+    """A periodic job and its timing statistics"""
+
+    def __init__(self, job_id, func, interval, lane=None):
+        self.job_id = job_id
+        self.func = func
+        self.interval = interval
+        self.lane = lane
+        self.cancelled = False
+        self.pending = False  # dispatched (queued on its lane or running) and not yet finished
+        self.idle = threading.Event()
+        self.idle.set()
+
+        # Timing statistics (seconds)
+        self.runs = 0
+        self.overruns = 0
+        self.errors = 0
+        self.last_error = None
+        self.last_jitter = 0.0
+        self.max_jitter = 0.0
+        self.total_jitter = 0.0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+
+    def stats(self):
+        """Return jitter, duration and overrun statistics in milliseconds"""
+        return {
+            "interval": self.interval,
+            "runs": self.runs,
+            "overruns": self.overruns,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "jitter_ms": {
+                "last": round(self.last_jitter * 1000, 3),
+                "max": round(self.max_jitter * 1000, 3),
+                "avg": round(self.total_jitter / self.runs * 1000, 3) if self.runs else 0.0
+            },
+            "duration_ms": {
+                "last": round(self.last_duration * 1000, 3),
+                "max": round(self.max_duration * 1000, 3)
+            }
+        }
+
+
+class PollingScheduler:
+    """
+    Heap-based fixed-rate scheduler running all periodic jobs on a small worker pool
+
+    Jobs run on a fixed grid (start + n * interval), so time spent in a run
+    doesn't push later runs back. A run that is still in progress when its
+    next tick comes due counts as an overrun and that tick is skipped. Jobs
+    that share a lane (one lane per device) never run at the same time, so
+    they share one pooled connection instead of opening one each.
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self._heap = []       # (next run, sequence, job)
+        self._jobs = {}
+        self._busy_lanes = set()
+        self._lane_queues = {}  # lane -> deque of (job, scheduled time) waiting for the lane
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = None
+        self._thread = None
+
+    def schedule(self, job_id, func, interval, lane=None, start_delay=0.0):
+        """
+        Add a periodic job
+
+        Args:
+            job_id: Unique job identifier
+            func (callable): Called with no arguments on every tick
+            interval (float): Seconds between ticks
+            lane: Jobs with the same lane are never run concurrently
+            start_delay (float): Seconds before the first run
+
+        Returns:
+            The ScheduledJob
+        """
+        if interval <= 0:
+            raise ValueError("Interval must be greater than zero")
+
+        job = ScheduledJob(job_id, func, interval, lane)
+        with self._cond:
+            self._ensure_started()
+            self._jobs[job_id] = job
+            heapq.heappush(self._heap, (time.monotonic() + start_delay, next(self._seq), job))
+            self._cond.notify_all()
+        return job
+
+    def cancel(self, job_id, timeout=5.0):
+        """
+        Stop a job and wait for an in-progress run to finish
+
+        Returns:
+            True if the job is idle, False if a run was still in progress after timeout
+        """
+        with self._cond:
+            job = self._jobs.pop(job_id, None)
+            if job is None:
+                return True
+            job.cancelled = True
+            queue = self._lane_queues.get(job.lane)
+            if queue:
+                remaining = deque(entry for entry in queue if entry[0] is not job)
+                if len(remaining) != len(queue):
+                    self._lane_queues[job.lane] = remaining
+                    job.pending = False
+                    job.idle.set()
+            self._cond.notify_all()
+        return job.idle.wait(timeout)
+
+    def get_job(self, job_id):
+        """Return the scheduled job with this id, or None"""
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def job_count(self):
+        """Number of scheduled jobs"""
+        with self._cond:
+            return len(self._jobs)
+
+    def queue_depths(self):
+        """Number of due runs waiting for their lane to come free, per lane"""
+        with self._cond:
+            return {lane: len(queue) for lane, queue in self._lane_queues.items()}
+
+    def _ensure_started(self):
+        """Start the dispatcher thread and worker pool (caller holds the lock)"""
+        if self._thread is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='modbus-poll')
+            self._thread = threading.Thread(target=self._dispatch_loop, name='modbus-scheduler', daemon=True)
+            self._thread.start()
+
+    def _dispatch_loop(self):
+        """Pop due jobs off the heap and hand them to the worker pool"""
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                scheduled, _, job = self._heap[0]
+                if job.cancelled:
+                    heapq.heappop(self._heap)
+                    continue
+
+                now = time.monotonic()
+                if scheduled > now:
+                    self._cond.wait(scheduled - now)
+                    continue
+
+                heapq.heappop(self._heap)
+
+                # Next tick on the fixed grid; ticks already missed are overruns
+                next_run = scheduled + job.interval
+                if next_run <= now:
+                    missed = int((now - next_run) // job.interval) + 1
+                    job.overruns += missed
+                    scheduler_overruns_total.inc(amount=missed)
+                    next_run += missed * job.interval
+                heapq.heappush(self._heap, (next_run, next(self._seq), job))
+
+                if job.pending:
+                    # Previous run hasn't finished: skip this tick
+                    job.overruns += 1
+                    scheduler_overruns_total.inc()
+                    continue
+
+                job.pending = True
+                job.idle.clear()
+                if job.lane is not None and job.lane in self._busy_lanes:
+                    self._lane_queues.setdefault(job.lane, deque()).append((job, scheduled))
+                    continue
+                if job.lane is not None:
+                    self._busy_lanes.add(job.lane)
+                self._executor.submit(self._execute, job, scheduled)
+
+    def _execute(self, job, scheduled):
+        """Run one tick of a job on a worker thread and record its timing"""
+        started = time.monotonic()
+        jitter = started - scheduled
+        scheduler_lag_seconds.observe(jitter)
+        try:
+            job.func()
+        except Exception as e:
+            job.errors += 1
+            job.last_error = str(e)
+        finally:
+            duration = time.monotonic() - started
+            with self._cond:
+                job.runs += 1
+                job.last_jitter = jitter
+                job.max_jitter = max(job.max_jitter, jitter)
+                job.total_jitter += jitter
+                job.last_duration = duration
+                job.max_duration = max(job.max_duration, duration)
+                job.pending = False
+                job.idle.set()
+                self._release_lane(job.lane)
+
+    def _release_lane(self, lane):
+        """Start the next job waiting on a lane, or mark the lane free (caller holds the lock)"""
+        if lane is None:
+            return
+        queue = self._lane_queues.get(lane)
+        while queue:
+            job, scheduled = queue.popleft()
+            if not job.cancelled:
+                self._executor.submit(self._execute, job, scheduled)
+                return
+            job.pending = False
+            job.idle.set()
+        self._lane_queues.pop(lane, None)
+        self._busy_lanes.discard(lane)
+
+
+# Shared scheduler for all continuous tasks
+scheduler = PollingScheduler()
+
+metrics.callback('modbus_scheduler_jobs', 'Scheduled continuous poll jobs', (), scheduler.job_count)
+metrics.callback('modbus_scheduler_lane_queue_depth', 'Due polls waiting for a busy device lane', ('lane',),
+                 lambda: {(_lane_label(lane),): depth for lane, depth in scheduler.queue_depths().items()})
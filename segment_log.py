@@ -0,0 +1,309 @@
+import mmap
+import os
+import struct
+import threading
+import zlib
+from metrics import spool_dropped_bytes_total
+
+# Record framing: payload length (uint32) and CRC-32 of the payload, then the
+# payload. Segments are preallocated and zero filled, so a zero length marks
+# the end of the written data; a CRC mismatch marks a write torn by a crash.
+RECORD_HEADER = struct.Struct('<II')
+SEGMENT_SUFFIX = '.seg'
+CURSOR_FILE = 'cursor'
+
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_SYNC_INTERVAL = 1.0
+
+class SegmentLog:
+    """
+    Append-only log of byte records in memory-mapped segment files, with one consumer cursor
+
+    Records are addressed by a global byte offset: segment files are named
+    after the offset of their first byte. Appends are a copy into the mapped
+    active segment; a background thread fsyncs the written data and the
+    cursor every sync_interval seconds, so up to that much can be lost (or
+    replayed again) after a power cut. Segments that are fully consumed are
+    deleted on rotation, and the oldest ones are deleted, consumed or not,
+    to stay within max_bytes.
+    """
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE, max_bytes=DEFAULT_MAX_BYTES,
+                 sync_interval=DEFAULT_SYNC_INTERVAL):
+        """
+        Open or create a log, recovering the write position after a crash
+
+        Args:
+            directory (str): Directory holding the segment files and the cursor
+            segment_size (int): Bytes per segment file
+            max_bytes (int): Disk space after which the oldest segments are dropped
+            sync_interval (float): Seconds between fsyncs of written data and the cursor
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max(max_bytes, 2 * segment_size)
+        self.sync_interval = sync_interval
+        self.dropped_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+
+        self._segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                                if name.endswith(SEGMENT_SUFFIX))
+        self._cursor = self._load_cursor()
+        self._synced_cursor = self._cursor
+        self._reader = None  # (base, mmap) of the segment the cursor is in
+        self._closed = False
+        self._cond = threading.Condition()
+        self._sync_lock = threading.Lock()
+        self._retired = []   # (file, mmap) of rotated segments waiting for their last sync
+        # Held by the consumer from read() to commit(), so a replaced consumer can't overlap it
+        self.consumer_lock = threading.Lock()
+
+        if self._segments:
+            self._open_active(self._segments[-1])
+            self._position = self._scan(self._active_map, verify=True)
+        else:
+            self._create_segment(self._cursor)
+        # The cursor may point before retained data, or past data lost in a power cut
+        self._cursor = min(max(self._cursor, self._segments[0]), self._active_base + self._position)
+        self._pending = self._count_pending()
+        self._dirty = False
+
+        self._thread = threading.Thread(target=self._sync_loop, name=f"segment-log-{directory}", daemon=True)
+        self._thread.start()
+
+    def append(self, payload):
+        """
+        Add a record (bytes) and return the offset just after it
+
+        Raises:
+            ValueError: If the record doesn't fit in a segment
+        """
+        size = RECORD_HEADER.size + len(payload)
+        if size > self.segment_size - RECORD_HEADER.size:
+            raise ValueError(f"Record of {len(payload)} bytes doesn't fit in a {self.segment_size} byte segment")
+
+        with self._cond:
+            if self._closed:
+                raise ValueError("Segment log is closed")
+            # Keep room for the zero header that marks the end of the segment
+            if self._position + size > self.segment_size - RECORD_HEADER.size:
+                self._rotate()
+            position = self._position
+            self._active_map[position + RECORD_HEADER.size:position + size] = payload
+            self._active_map[position:position + RECORD_HEADER.size] = RECORD_HEADER.pack(
+                len(payload), zlib.crc32(payload))
+            self._position = position + size
+            self._pending += 1
+            self._dirty = True
+            self._cond.notify_all()
+            return self._active_base + self._position
+
+    def read(self, max_records):
+        """
+        Return up to max_records (offset after the record, payload) pairs from the cursor, without consuming them
+        """
+        records = []
+        with self._cond:
+            offset = self._cursor
+            while len(records) < max_records:
+                base = self._segment_of(offset)
+                if base is None:
+                    break
+                data = self._active_map if base == self._active_base else self._reader_map(base)
+                position = offset - base
+                end = self._position if base == self._active_base else self.segment_size
+                payload = self._record_at(data, position, end)
+                if payload is None:
+                    if base == self._active_base:
+                        break
+                    # End of a rotated segment: continue in the next one
+                    offset = self._segments[self._segments.index(base) + 1]
+                    continue
+                offset += RECORD_HEADER.size + len(payload)
+                records.append((offset, payload))
+        return records
+
+    def commit(self, offset, count):
+        """Move the cursor past count records read up to offset; synced with the next fsync"""
+        with self._cond:
+            if offset > self._cursor:
+                self._cursor = offset
+                self._pending = max(0, self._pending - count)
+
+    def wait(self, count, timeout=None, stop=None):
+        """Wait until at least count records are pending, the log closes, stop() is true or the timeout passes"""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: self._pending >= count or self._closed or (stop is not None and stop()), timeout)
+
+    def pending(self):
+        """Number of records after the cursor"""
+        with self._cond:
+            return self._pending
+
+    def backlog_bytes(self):
+        """Bytes between the cursor and the end of the log (including segment tails)"""
+        with self._cond:
+            return self._active_base + self._position - self._cursor
+
+    def wake(self):
+        """Wake threads blocked in wait() so they check their stop condition"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def close(self):
+        """Sync and close the log"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._sync()
+        with self._cond:
+            self._active_map.close()
+            self._active_file.close()
+            if self._reader is not None:
+                self._reader[1].close()
+                self._reader = None
+
+    def _path(self, base):
+        return os.path.join(self.directory, f"{base:020d}{SEGMENT_SUFFIX}")
+
+    def _create_segment(self, base):
+        with open(self._path(base), 'wb') as f:
+            f.truncate(self.segment_size)
+        self._segments.append(base)
+        self._open_active(base)
+        self._position = 0
+
+    def _open_active(self, base):
+        self._active_base = base
+        self._active_file = open(self._path(base), 'r+b')
+        self._active_map = mmap.mmap(self._active_file.fileno(), self.segment_size)
+
+    def _rotate(self):
+        """Start a new segment (caller holds the lock); the old one is synced by the sync thread"""
+        self._retired.append((self._active_file, self._active_map))
+        self._create_segment(self._active_base + self.segment_size)
+        self._drop_segments()
+
+    def _drop_segments(self):
+        """Delete consumed segments, and the oldest ones beyond max_bytes"""
+        while len(self._segments) > 1:
+            oldest, following = self._segments[0], self._segments[1]
+            consumed = self._cursor >= following or (
+                self._cursor >= oldest
+                and self._record_at(self._reader_map(oldest), self._cursor - oldest, self.segment_size) is None)
+            if not consumed and len(self._segments) * self.segment_size <= self.max_bytes:
+                break
+            if not consumed:
+                self.dropped_bytes += following - self._cursor
+                spool_dropped_bytes_total.inc(amount=following - self._cursor)
+                self._pending = self._count_pending(start=following)
+            self._cursor = max(self._cursor, following)
+            if self._reader is not None and self._reader[0] == oldest:
+                self._reader[1].close()
+                self._reader = None
+            self._segments.pop(0)
+            os.remove(self._path(oldest))
+
+    def _segment_of(self, offset):
+        """Base of the segment holding offset, or None if it is past the end"""
+        for base in reversed(self._segments):
+            if base <= offset:
+                return base if offset < base + self.segment_size else None
+        return None
+
+    def _reader_map(self, base):
+        """Read-only map of a rotated segment, kept open while the cursor is in it"""
+        if self._reader is None or self._reader[0] != base:
+            if self._reader is not None:
+                self._reader[1].close()
+            with open(self._path(base), 'rb') as f:
+                self._reader = (base, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        return self._reader[1]
+
+    def _record_at(self, data, position, end, verify=False):
+        """Payload of the record at position, or None at the end of the data"""
+        if position + RECORD_HEADER.size > end:
+            return None
+        length, crc = RECORD_HEADER.unpack_from(data, position)
+        start = position + RECORD_HEADER.size
+        if length == 0 or start + length > end:
+            return None
+        payload = bytes(data[start:start + length])
+        if verify and zlib.crc32(payload) != crc:
+            return None
+        return payload
+
+    def _scan(self, data, verify=False, position=0):
+        """Position after the last complete record of a segment"""
+        while True:
+            payload = self._record_at(data, position, self.segment_size - RECORD_HEADER.size, verify)
+            if payload is None:
+                if verify:
+                    # Clear a torn record so it can't be mistaken for data later
+                    data[position:position + RECORD_HEADER.size] = bytes(RECORD_HEADER.size)
+                return position
+            position += RECORD_HEADER.size + len(payload)
+
+    def _count_pending(self, start=None):
+        """Count the records from start (default: the cursor) to the end of the log"""
+        offset = self._cursor if start is None else start
+        count = 0
+        for base in self._segments:
+            if base + self.segment_size <= offset:
+                continue
+            data = self._active_map if base == self._active_base else self._reader_map(base)
+            position = max(0, offset - base)
+            end = self._position if base == self._active_base else self.segment_size
+            while True:
+                if position + RECORD_HEADER.size > end:
+                    break
+                length = RECORD_HEADER.unpack_from(data, position)[0]
+                if length == 0 or position + RECORD_HEADER.size + length > end:
+                    break
+                position += RECORD_HEADER.size + length
+                count += 1
+        return count
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _sync_loop(self):
+        """fsync written data and the cursor in batches, off the append path"""
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed, self.sync_interval)
+                if self._closed:
+                    return
+            self._sync()
+
+    def _sync(self):
+        with self._sync_lock:
+            with self._cond:
+                dirty, self._dirty = self._dirty, False
+                retired, self._retired = self._retired, []
+                active = self._active_file
+                cursor = self._cursor
+            for f, data in retired:
+                os.fsync(f.fileno())
+                data.close()
+                f.close()
+            if dirty:
+                # Dirty pages of the shared mapping are written back by fsync on the file
+                os.fsync(active.fileno())
+            if cursor != self._synced_cursor:
+                path = os.path.join(self.directory, CURSOR_FILE)
+                with open(path + '.tmp', 'w') as f:
+                    f.write(str(cursor))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(path + '.tmp', path)
+                self._synced_cursor = cursor
@@ -0,0 +1,208 @@
+import itertools
+import threading
+import time
+from collections import deque
+from metrics import bus_wait_seconds, metrics
+from priority_classes import CLASS_RANK, PRIORITY_CLASSES, current_class
+
+# RTU characters are 11 bits (start, 8 data, parity or second stop, stop)
+BITS_PER_CHAR = 11
+# Above 19200 baud the spec fixes the inter-frame gap at 1.75 ms instead of 3.5 characters
+FIXED_GAP_BAUD = 19200
+FIXED_GAP = 0.00175
+# Bytes of an RTU read request, and of a read response besides its data
+REQUEST_FRAME_BYTES = 8
+RESPONSE_OVERHEAD_BYTES = 5
+# Assumed time a slave takes to start answering, on top of the frames
+DEFAULT_TURNAROUND = 0.005
+# Consecutive frames granted to one unit ID while other units of the same class wait
+MAX_UNIT_BURST = 8
+# Seconds of history behind the utilization figure
+UTILIZATION_WINDOW = 10.0
+
+class SerialBus:
+    """
+    One RS-485 segment behind a Modbus TCP gateway, shared by all unit IDs on it
+
+    Only one request is on the bus at a time. When several are waiting, the
+    most urgent priority class goes first (control writes, then interactive
+    requests, polls and bulk batches); within a class, the unit ID that
+    just had the bus keeps it for up to MAX_UNIT_BURST frames so requests
+    for one slave run back to back, then the oldest request goes. Each
+    frame starts at least the inter-frame gap after the previous response.
+    """
+
+    def __init__(self, gateway, baud=9600, gap=None, turnaround=DEFAULT_TURNAROUND):
+        """
+        Args:
+            gateway (str): "host:port" of the gateway
+            baud (int): Baud rate of the serial segment
+            gap (float): Seconds between frames (default: 3.5 characters, or 1.75 ms above 19200 baud)
+            turnaround (float): Assumed seconds a slave takes to start its response
+        """
+        self.gateway = gateway
+        self.baud = baud
+        self.char_time = BITS_PER_CHAR / baud
+        if gap is None:
+            gap = FIXED_GAP if baud > FIXED_GAP_BAUD else 3.5 * self.char_time
+        self.gap = gap
+        self.turnaround = turnaround
+        self.frames = 0
+        self._waiting = []  # (class rank, sequence, unit)
+        self._seq = itertools.count()
+        self._busy = False
+        self._ready_at = 0.0
+        self._last_unit = None
+        self._burst = 0
+        self._acquired_at = 0.0
+        self._busy_times = deque()  # (released at, seconds held) within UTILIZATION_WINDOW
+        self._cond = threading.Condition()
+
+    def max_gap(self, max_registers):
+        """
+        Unrequested registers worth reading to save a request on this bus
+
+        A separate request costs a request frame, a response header, two
+        inter-frame gaps and the slave's turnaround; each register read
+        through a gap costs two bytes.
+        """
+        request_cost = ((REQUEST_FRAME_BYTES + RESPONSE_OVERHEAD_BYTES) * self.char_time
+                        + 2 * self.gap + self.turnaround)
+        return min(max_registers, int(request_cost / (2 * self.char_time)))
+
+    def acquire(self, unit, timeout=None):
+        """
+        Wait for the bus; returns False if it wasn't granted within timeout
+
+        The request's class is the calling thread's (see priority_classes).
+        """
+        name = current_class()
+        entry = (CLASS_RANK[name], next(self._seq), unit)
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        with self._cond:
+            self._waiting.append(entry)
+            granted = False
+            try:
+                while True:
+                    now = time.monotonic()
+                    if not self._busy and self._next() is entry and now >= self._ready_at:
+                        granted = True
+                        break
+                    if deadline is not None and now >= deadline:
+                        return False
+                    # Next in line sleeps out the inter-frame gap; the rest wait for a release
+                    wait = self._ready_at - now if not self._busy and self._next() is entry else None
+                    if deadline is not None:
+                        wait = deadline - now if wait is None else min(wait, deadline - now)
+                    self._cond.wait(wait)
+            finally:
+                self._waiting.remove(entry)
+                if not granted:
+                    # This entry may have been next in line
+                    self._cond.notify_all()
+            self._busy = True
+            if unit == self._last_unit:
+                self._burst += 1
+            else:
+                self._last_unit, self._burst = unit, 1
+            self._acquired_at = now
+        bus_wait_seconds.observe(now - started, self.gateway, name)
+        return True
+
+    def release(self):
+        """Free the bus for the next request after the inter-frame gap"""
+        now = time.monotonic()
+        with self._cond:
+            self._busy = False
+            self._ready_at = now + self.gap
+            self.frames += 1
+            self._busy_times.append((now, now - self._acquired_at))
+            self._trim(now)
+            self._cond.notify_all()
+
+    def utilization(self):
+        """Fraction of the last UTILIZATION_WINDOW seconds the bus was held"""
+        now = time.monotonic()
+        with self._cond:
+            self._trim(now)
+            busy = sum(held for _, held in self._busy_times)
+            if self._busy:
+                busy += now - self._acquired_at
+        return min(1.0, busy / UTILIZATION_WINDOW)
+
+    def stats(self):
+        """Settings, utilization and waiting requests by priority class"""
+        with self._cond:
+            waiting = dict.fromkeys(PRIORITY_CLASSES, 0)
+            for rank, _, _ in self._waiting:
+                waiting[PRIORITY_CLASSES[rank]] += 1
+            frames = self.frames
+        return {
+            "baud": self.baud,
+            "gap_ms": round(self.gap * 1000, 3),
+            "utilization": round(self.utilization(), 4),
+            "frames": frames,
+            "waiting": waiting
+        }
+
+    def _next(self):
+        """Waiting entry to grant the bus to next (caller holds the lock)"""
+        def rank(entry):
+            rank, seq, unit = entry
+            same_unit = unit == self._last_unit and self._burst < MAX_UNIT_BURST
+            return rank, not same_unit, seq
+        return min(self._waiting, key=rank) if self._waiting else None
+
+    def _trim(self, now):
+        while self._busy_times and self._busy_times[0][0] < now - UTILIZATION_WINDOW:
+            self._busy_times.popleft()
+
+
+class SerialBuses:
+    """Registry of the gateways known to front a serial bus, keyed by "host:port" """
+
+    def __init__(self):
+        self._buses = {}
+        self._lock = threading.Lock()
+
+    def add(self, host, port=502, baud=9600, gap=None, turnaround=DEFAULT_TURNAROUND):
+        """Arbitrate requests to a gateway as one serial bus (gap and turnaround in seconds)"""
+        if not isinstance(baud, int) or baud <= 0:
+            raise ValueError("Baud rate must be a positive integer")
+        gateway = f"{host}:{port}"
+        with self._lock:
+            self._buses[gateway] = SerialBus(gateway, baud, gap, turnaround)
+
+    def configure(self, spec):
+        """Add gateways from a "host:port=baud,host:port" list (baud defaults to 9600)"""
+        for entry in (spec or '').split(','):
+            if entry.strip():
+                address, _, baud = entry.strip().partition('=')
+                host, _, port = address.rpartition(':')
+                self.add(host, int(port), int(baud) if baud else 9600)
+
+    def get(self, device):
+        """SerialBus of a "host:port" device, or None if it isn't a serial gateway"""
+        return self._buses.get(device)
+
+    def max_gap(self, host, port, default, max_registers):
+        """Gap tolerance for read plans of a device: bus cost based for serial gateways, else default"""
+        bus = self._buses.get(f"{host}:{port}")
+        return default if bus is None else bus.max_gap(max_registers)
+
+    def stats(self):
+        with self._lock:
+            buses = list(self._buses.values())
+        return {bus.gateway: bus.stats() for bus in buses}
+
+
+# Shared registry, configured by create_app from MODBUS_SERIAL_GATEWAYS
+serial_buses = SerialBuses()
+
+metrics.callback('modbus_bus_utilization', 'Fraction of the last 10 seconds each serial gateway bus was busy',
+                 ('gateway',), lambda: {(gateway,): stats['utilization'] for gateway, stats in serial_buses.stats().items()})
+metrics.callback('modbus_bus_waiting_requests', 'Requests waiting for a serial gateway bus by priority class',
+                 ('gateway', 'class'),
+                 lambda: {(gateway, name): count for gateway, stats in serial_buses.stats().items()
+                          for name, count in stats['waiting'].items()})
@@ -0,0 +1,415 @@
+import bisect
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from modbus_controller import ModbusController, ModbusError
+from connection_pool import connection_pool
+from device_health import device_health
+from priority_classes import current_class, priority_class
+from value_cache import value_cache
+from tag_history import history_store
+from live_stream import stream_hub
+from webhook_delivery import webhook_dispatcher
+
+# Virtual nodes per shard on the hash ring; more spreads devices more evenly
+DEFAULT_REPLICAS = 256
+# Seconds a worker collects results before sending them to the API process
+EVENT_FLUSH_INTERVAL = 0.02
+# Seconds to wait for a worker to answer a command (on top of a device request's own timeout)
+CALL_TIMEOUT = 60.0
+# Commands a worker runs at once: API requests for its devices wait there for connections
+WORKER_THREADS = 64
+
+# Shared objects of the API process that workers feed, and the methods they call remotely
+FORWARDED = {
+    'value_cache': ('register', 'update', 'touch', 'remove'),
+    'history_store': ('register', 'record', 'remove'),
+    'stream_hub': ('publish',),
+    'webhook_dispatcher': ('register', 'submit')
+}
+_TARGETS = {
+    'value_cache': value_cache,
+    'history_store': history_store,
+    'stream_hub': stream_hub,
+    'webhook_dispatcher': webhook_dispatcher
+}
+
+log = logging.getLogger(__name__)
+
+class HashRing:
+    """Consistent hash ring mapping device keys ("host:port") to shard indexes"""
+
+    def __init__(self, shards, replicas=DEFAULT_REPLICAS):
+        points = sorted((self._hash(f"shard-{shard}#{replica}"), shard)
+                        for shard in range(shards) for replica in range(replicas))
+        self._points = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def owner(self, key):
+        """Shard index owning a key"""
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._shards[index]
+
+
+class _Shard:
+    """API-process end of one worker: its pipe, pending calls and the thread reading its messages"""
+
+    def __init__(self, index, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self._pending = {}  # request id -> Future
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._read_loop, name=f"modbus-shard-{index}-reader", daemon=True)
+        self._thread.start()
+
+    def submit(self, command, *args):
+        """Send a command; returns a Future of its result"""
+        future = Future()
+        with self._lock:
+            if self.conn is None:
+                future.set_exception(ModbusError(f"Shard {self.index} is not running"))
+                return future
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+            self.conn.send((request_id, command, args))
+        return future
+
+    def _read_loop(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == 'events':
+                _apply_events(message[1])
+                continue
+            _, request_id, error, result = message
+            with self._lock:
+                future = self._pending.pop(request_id, None)
+            if future is None:
+                continue
+            if error is None:
+                future.set_result(result)
+            elif error == 'ModbusError':
+                # Sent as is, so DeviceBusyError keeps its retry hint
+                future.set_exception(result)
+            else:
+                future.set_exception(ValueError(result) if error == 'ValueError' else ModbusError(result))
+
+        # The worker exited: nothing pending will be answered
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self.conn = None
+        log.error("Shard %s exited", self.index)
+        for future in pending.values():
+            future.set_exception(ModbusError(f"Shard {self.index} exited"))
+
+
+def _apply_events(events):
+    """Run the calls a worker forwarded on the API process's shared objects"""
+    for name, method, args, kwargs in events:
+        try:
+            getattr(_TARGETS[name], method)(*args, **kwargs)
+        except Exception as e:
+            log.error("Error applying %s.%s from a shard: %s", name, method, e)
+
+
+class RemoteController:
+    """
+    Stand-in for the controller of a device owned by a shard
+
+    Every request runs on the owner, on a connection from its pool and in
+    the calling thread's priority class, so the device's connections,
+    queue, circuit breaker and serial bus are managed by that process
+    alone. Decoding runs here.
+    """
+
+    decode_registers = ModbusController.decode_registers
+    decode_bits = ModbusController.decode_bits
+
+    def __init__(self, pool, shard, host, port, timeout):
+        self._pool = pool
+        self.shard = shard
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def connect(self):
+        """Make sure the owner has a connection to the device (raises ModbusError)"""
+        self._call(None)
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self._call(method, *args, **kwargs)
+
+    def _call(self, method, *args, **kwargs):
+        return self._pool.call(self.shard, 'device', self.host, self.port, self.timeout, current_class(),
+                               method, args, kwargs, timeout=self.timeout + CALL_TIMEOUT)
+
+
+class ShardPool:
+    """
+    Worker processes running continuous tasks, each owning the devices that hash to it
+
+    Every worker has its own scheduler and connection pool, so Modbus I/O,
+    decoding and deadband filtering of its devices run on another core. The
+    results are sent back in batches and applied to the latest-value cache,
+    history, live streams and webhook queues of the API process, so every
+    endpoint behaves as with in-process tasks.
+    """
+
+    def __init__(self):
+        self.shards = []
+        self.ring = None
+
+    @property
+    def enabled(self):
+        return bool(self.shards)
+
+    def start(self, count, pipelined=None, serial_gateways=None):
+        """
+        Start count worker processes
+
+        Args:
+            count (int): Number of shards
+            pipelined (str): Pipelined devices, as in MODBUS_PIPELINED_DEVICES
+            serial_gateways (str): Serial gateways, as in MODBUS_SERIAL_GATEWAYS
+        """
+        if self.shards:
+            return
+        # Spawned rather than forked: the API process already runs threads and holds sockets
+        context = multiprocessing.get_context('spawn')
+        for index in range(count):
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=_worker_main, args=(index, child_conn, pipelined, serial_gateways),
+                                      name=f"modbus-shard-{index}", daemon=True)
+            process.start()
+            child_conn.close()
+            self.shards.append(_Shard(index, process, conn))
+        self.ring = HashRing(count)
+        # From now on this process sends every Modbus request to the device's owner
+        connection_pool.remote = self.controller
+
+    def owner(self, devices):
+        """
+        Shard owning all of the (host, port) devices, or None if they hash to different shards
+
+        Tasks with an owner run there; the others run in the API process,
+        which sends each of their requests to the device's own shard.
+        """
+        owners = {self.ring.owner(f"{host}:{port}") for host, port in devices}
+        return owners.pop() if len(owners) == 1 else None
+
+    def controller(self, host, port, timeout):
+        """RemoteController of a device, or None when devices aren't sharded"""
+        if not self.shards:
+            return None
+        return RemoteController(self, self.ring.owner(f"{host}:{port}"), host, port, timeout)
+
+    def health(self, devices):
+        """Breaker state and timing of "host:port" devices, from the process that owns each"""
+        if not self.shards:
+            return {device: device_health.status(device) for device in devices}
+        groups = {}
+        for device in devices:
+            groups.setdefault(self.ring.owner(device), []).append(device)
+        futures = [(shard, self.submit(shard, 'health', shard_devices)) for shard, shard_devices in groups.items()]
+        health = {}
+        for shard, future in futures:
+            try:
+                health.update(future.result(5.0))
+            except Exception:
+                # The shard is gone: report what this process knows
+                health.update((device, device_health.status(device)) for device in groups[shard])
+        return health
+
+    def submit(self, shard, command, *args):
+        return self.shards[shard].submit(command, *args)
+
+    def call(self, shard, command, *args, timeout=CALL_TIMEOUT):
+        """Run a command on a shard and return its result (raises ValueError or ModbusError; timeout None waits forever)"""
+        try:
+            return self.submit(shard, command, *args).result(timeout)
+        except TimeoutError:
+            raise ModbusError(f"Shard {shard} did not answer {command} in time")
+
+    def call_all(self, command, *args, timeout=CALL_TIMEOUT):
+        """Run a command on every shard at once; returns {shard: result}, leaving out shards that failed"""
+        futures = [(shard.index, shard.submit(command, *args)) for shard in self.shards]
+        results = {}
+        for index, future in futures:
+            try:
+                results[index] = future.result(timeout)
+            except Exception:
+                continue
+        return results
+
+    def task_details(self):
+        """Scheduler, filter and device state of every task running on a shard"""
+        details = {}
+        for shard_details in self.call_all('details', timeout=5.0).values():
+            details.update(shard_details)
+        return details
+
+    def metric_families(self):
+        """(shard, metric families) of every shard, for merging into /metrics"""
+        if not self.enabled:
+            return []
+        return sorted(self.call_all('metrics', timeout=5.0).items())
+
+
+class _Outbox:
+    """Worker-side buffer of forwarded calls, sent to the API process in batches"""
+
+    def __init__(self, conn, send_lock):
+        self.conn = conn
+        self.send_lock = send_lock
+        self._events = []
+        self._lock = threading.Lock()
+        threading.Thread(target=self._flush_loop, name="modbus-shard-outbox", daemon=True).start()
+
+    def add(self, event):
+        with self._lock:
+            self._events.append(event)
+
+    def flush(self):
+        # Taking the batch under the send lock keeps batches in order
+        with self.send_lock:
+            with self._lock:
+                events, self._events = self._events, []
+            if events:
+                self.conn.send(('events', events))
+
+    def _flush_loop(self):
+        stop = threading.Event()
+        while not stop.wait(EVENT_FLUSH_INTERVAL):
+            self.flush()
+
+
+class _Forwarder:
+    """
+    Stand-in for a shared object of the API process inside a worker
+
+    Calls to the forwarded methods are queued for the API process; anything
+    else (e.g. history_store.plan) runs on the worker's own object.
+    """
+
+    def __init__(self, name, local, methods, outbox):
+        self._name = name
+        self._local = local
+        self._methods = methods
+        self._outbox = outbox
+
+    def __getattr__(self, attr):
+        if attr not in self._methods:
+            return getattr(self._local, attr)
+
+        def forward(*args, **kwargs):
+            self._outbox.add((self._name, attr, args, kwargs))
+        return forward
+
+
+def _worker_main(index, conn, pipelined, serial_gateways):
+    """Entry point of a shard process: run task commands from the API process until it goes away"""
+    import routes.continuous_routes as continuous
+    from metrics import metrics
+    from scheduler import scheduler
+    from serial_gateway import serial_buses
+
+    connection_pool.configure_pipelining(pipelined)
+    serial_buses.configure(serial_gateways)
+    send_lock = threading.Lock()
+    outbox = _Outbox(conn, send_lock)
+    for name, methods in FORWARDED.items():
+        setattr(continuous, name, _Forwarder(name, getattr(continuous, name), methods, outbox))
+
+    def create(kind, data, task_id, start_delay, connect):
+        return continuous._start_local_task(kind, data, task_id, start_delay, connect)
+
+    # Jobs of stopped tasks whose last poll outlived the stop
+    stopping = {}
+
+    def release(task_id):
+        continuous.value_cache.remove(task_id)
+        continuous.history_store.remove(task_id)
+        # Deliver the task's last results and the removal before the API process closes its streams
+        outbox.flush()
+
+    def stop(task_id):
+        stopped = scheduler.cancel(task_id, timeout=continuous.STOP_TIMEOUT)
+        with continuous.task_lock:
+            task = continuous.continuous_tasks.pop(task_id, None)
+        if stopped:
+            release(task_id)
+        else:
+            stopping[task_id] = task['job']
+        return stopped
+
+    def finish(task_id):
+        """Wait for the last poll of a task whose stop timed out, then release it"""
+        job = stopping.pop(task_id, None)
+        if job is not None:
+            job.idle.wait()
+            release(task_id)
+
+    def device(host, port, timeout, priority, method, args, kwargs):
+        """Run one request of the API process on a pooled connection (method None only connects)"""
+        with priority_class(priority), connection_pool.connection(host, port, timeout) as controller:
+            return getattr(controller, method)(*args, **kwargs) if method else None
+
+    def health(devices):
+        return {device: device_health.status(device) for device in devices}
+
+    def details():
+        with continuous.task_lock:
+            return {task_id: continuous.task_details(task) for task_id, task in continuous.continuous_tasks.items()}
+
+    commands = {
+        'create': create,
+        'stop': stop,
+        'finish': finish,
+        'details': details,
+        'device': device,
+        'health': health,
+        'warm': connection_pool.warm,
+        'metrics': metrics.families
+    }
+
+    def handle(request_id, command, args):
+        try:
+            reply = ('reply', request_id, None, commands[command](*args))
+        except ModbusError as e:
+            reply = ('reply', request_id, 'ModbusError', e)
+        except ValueError as e:
+            reply = ('reply', request_id, 'ValueError', str(e))
+        except Exception as e:
+            reply = ('reply', request_id, 'error', str(e))
+        with send_lock:
+            try:
+                conn.send(reply)
+            except Exception as e:
+                # The result couldn't be pickled; the caller must still get an answer
+                conn.send(('reply', request_id, 'error', f"Unexpected error: {str(e)}"))
+
+    # Commands run concurrently: a create may wait for a slow device to connect
+    executor = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix=f"modbus-shard-{index}")
+    while True:
+        try:
+            request_id, command, args = conn.recv()
+        except (EOFError, OSError):
+            return
+        executor.submit(handle, request_id, command, args)
+
+
+# Shared pool, started by create_app when MODBUS_SHARDS is set
+shard_pool = ShardPool()
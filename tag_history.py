@@ -0,0 +1,430 @@
+import math
+import threading
+import time
+from array import array
+
+# Rollup tiers after the raw samples: (name, bucket width in seconds)
+ROLLUP_TIERS = (('1s', 1.0), ('1m', 60.0))
+TIER_NAMES = ('raw',) + tuple(name for name, _ in ROLLUP_TIERS)
+
+# Seconds kept per tier unless a task asks for something else
+DEFAULT_RETENTION = {'raw': 300.0, '1s': 3600.0, '1m': 86400.0}
+
+# Automatic tier selection picks the finest tier returning at most this many points
+DEFAULT_MAX_POINTS = 1000
+
+# Largest history one tag may allocate, and the default for all tasks together
+MAX_TAG_BYTES = 16 * 1024 * 1024
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+class _Ring:
+    """
+    Fixed number of rows of doubles stored column-wise in typed arrays
+
+    Column 0 is the timestamp. When the ring is full the oldest row is
+    overwritten, so memory is allocated once and never grows.
+    """
+
+    def __init__(self, capacity, columns):
+        self.capacity = capacity
+        self.columns = [array('d', bytes(8 * capacity)) for _ in range(columns)]
+        self.start = 0  # physical index of the oldest row
+        self.size = 0
+
+    def append(self, row):
+        """Add a row, overwriting the oldest one when full"""
+        if self.size < self.capacity:
+            index = (self.start + self.size) % self.capacity
+            self.size += 1
+        else:
+            index = self.start
+            self.start = (self.start + 1) % self.capacity
+        for column, value in zip(self.columns, row):
+            column[index] = value
+
+    def full(self):
+        """True once rows are being overwritten"""
+        return self.size == self.capacity
+
+    def oldest(self):
+        """Timestamp of the oldest row, or None if empty"""
+        return self.columns[0][self.start] if self.size else None
+
+    def select(self, start, end):
+        """Return each column as a list, for rows with start <= timestamp <= end"""
+        first = self._bisect(start, False)
+        last = self._bisect(end, True)
+        if first >= last:
+            return [[] for _ in self.columns]
+        begin = (self.start + first) % self.capacity
+        stop = begin + (last - first)
+        if stop <= self.capacity:
+            return [column[begin:stop].tolist() for column in self.columns]
+        stop -= self.capacity
+        return [column[begin:].tolist() + column[:stop].tolist() for column in self.columns]
+
+    def nbytes(self):
+        """Bytes allocated for the ring"""
+        return sum(column.itemsize * len(column) for column in self.columns)
+
+    def _bisect(self, timestamp, right):
+        """Logical index of the first row after (right) or at/after (left) timestamp"""
+        timestamps = self.columns[0]
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = timestamps[(self.start + mid) % self.capacity]
+            if value < timestamp or (right and value == timestamp):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class _Rollup:
+    """One rollup tier: closed buckets in a ring plus the bucket being filled"""
+
+    def __init__(self, name, resolution, capacity, width):
+        self.name = name
+        self.resolution = resolution
+        self.width = width
+        # Columns: bucket start, sample count, then min, max and sum per element
+        self.ring = _Ring(capacity, 2 + 3 * width)
+        self.bucket = None  # [bucket start, count, mins, maxs, sums]
+
+    def add(self, timestamp, values):
+        """Fold a sample into its bucket, closing the previous bucket if it ended"""
+        bucket_start = math.floor(timestamp / self.resolution) * self.resolution
+        bucket = self.bucket
+        if bucket is not None and bucket[0] == bucket_start:
+            bucket[1] += 1
+            mins, maxs, sums = bucket[2], bucket[3], bucket[4]
+            for i, value in enumerate(values):
+                if value < mins[i]:
+                    mins[i] = value
+                if value > maxs[i]:
+                    maxs[i] = value
+                sums[i] += value
+            return
+        if bucket is not None:
+            self.ring.append(self._row(bucket))
+        self.bucket = [bucket_start, 1, list(values), list(values), list(values)]
+
+    def select(self, start, end):
+        """Return (bucket starts, counts, mins, maxs, avgs) for buckets starting in [start, end]"""
+        columns = self.ring.select(start, end)
+        timestamps, counts = columns[0], columns[1]
+        width = self.width
+        mins = [columns[2 + i] for i in range(width)]
+        maxs = [columns[2 + width + i] for i in range(width)]
+        avgs = [[total / count for total, count in zip(columns[2 + 2 * width + i], counts)] for i in range(width)]
+
+        bucket = self.bucket
+        if bucket is not None and start <= bucket[0] <= end:
+            timestamps.append(bucket[0])
+            counts.append(bucket[1])
+            for i in range(width):
+                mins[i].append(bucket[2][i])
+                maxs[i].append(bucket[3][i])
+                avgs[i].append(bucket[4][i] / bucket[1])
+        return timestamps, counts, mins, maxs, avgs
+
+    def covers(self, start):
+        """True if no bucket at or after start has been overwritten yet"""
+        if not self.ring.full():
+            return True
+        return self.ring.oldest() <= start
+
+    @staticmethod
+    def _row(bucket):
+        bucket_start, count, mins, maxs, sums = bucket
+        return [bucket_start, count] + mins + maxs + sums
+
+
+class TagSeries:
+    """Raw samples and rollups of one numeric tag, with capacity fixed at creation"""
+
+    def __init__(self, interval, retention, width, scalar):
+        """
+        Allocate the buffers for a tag
+
+        Args:
+            interval (float): Poll interval of the task, used to size the raw tier
+            retention (dict): Seconds kept per tier; 0 disables a tier
+            width (int): Number of values per sample (the operation's count)
+            scalar (bool): Whether samples are single values rather than lists
+        """
+        self.interval = interval
+        self.width = width
+        self.scalar = scalar
+        raw_capacity, capacities = self._capacities(interval, retention)
+        self.raw = _Ring(raw_capacity, 1 + width) if raw_capacity else None
+        self.rollups = [_Rollup(name, resolution, capacities[name], width)
+                        for name, resolution in ROLLUP_TIERS if capacities[name]]
+
+    @classmethod
+    def size(cls, interval, retention, width):
+        """Bytes a tag with width values per sample will allocate"""
+        raw_capacity, capacities = cls._capacities(interval, retention)
+        rows = raw_capacity * (1 + width) + sum(capacities.values()) * (2 + 3 * width)
+        return 8 * rows
+
+    @staticmethod
+    def _capacities(interval, retention):
+        """Rows of the raw tier and of each rollup tier"""
+        raw_capacity = math.ceil(retention['raw'] / interval) if retention['raw'] > 0 else 0
+        return raw_capacity, {name: math.ceil(retention[name] / resolution) if retention[name] > 0 else 0
+                              for name, resolution in ROLLUP_TIERS}
+
+    def append(self, timestamp, values):
+        """Store one sample in every tier"""
+        if self.raw is not None:
+            self.raw.append([timestamp] + values)
+        for rollup in self.rollups:
+            rollup.add(timestamp, values)
+
+    def select_tier(self, start, end, max_points=DEFAULT_MAX_POINTS):
+        """
+        Pick the tier that answers a range query
+
+        The finest tier is used whose point count for the span stays within
+        max_points and that still holds data back to start; if none does,
+        the coarsest tier is used.
+        """
+        tiers = []
+        if self.raw is not None:
+            tiers.append(('raw', self.interval, self.raw))
+        tiers.extend((rollup.name, rollup.resolution, rollup) for rollup in self.rollups)
+        if not tiers:
+            return None
+
+        span = max(0.0, end - start)
+        for name, resolution, tier in tiers:
+            if span / resolution > max_points:
+                continue
+            if name == 'raw':
+                covered = not tier.full() or tier.oldest() <= start
+            else:
+                covered = tier.covers(start)
+            if covered:
+                return name
+        return tiers[-1][0]
+
+    def query(self, tier, start, end):
+        """
+        Return the samples of one tier between start and end
+
+        Raw samples come back as timestamps and values; rollups as bucket
+        start timestamps with count, min, max and avg per bucket.
+        """
+        if tier == 'raw':
+            if self.raw is None:
+                return None
+            columns = self.raw.select(start, end)
+            return {"tier": "raw", "timestamps": columns[0], "values": self._merge(columns[1:])}
+
+        for rollup in self.rollups:
+            if rollup.name == tier:
+                timestamps, counts, mins, maxs, avgs = rollup.select(start, end)
+                return {
+                    "tier": tier,
+                    "timestamps": timestamps,
+                    "count": [int(count) for count in counts],
+                    "min": self._merge(mins),
+                    "max": self._merge(maxs),
+                    "avg": self._merge(avgs)
+                }
+        return None
+
+    def nbytes(self):
+        """Bytes allocated for all tiers"""
+        total = self.raw.nbytes() if self.raw is not None else 0
+        return total + sum(rollup.ring.nbytes() for rollup in self.rollups)
+
+    def _merge(self, columns):
+        """Turn per-element columns back into one value (or list) per sample"""
+        if self.scalar:
+            return columns[0] if columns else []
+        return [list(row) for row in zip(*columns)]
+
+
+class HistoryStore:
+    """
+    Time-series history of continuous read tasks, per (task, tag)
+
+    Tasks reserve the memory their tags will take when they are registered,
+    and are refused once the reservations would exceed max_bytes.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._tasks = {}  # task_id -> {"interval", "retention", "arrays", "bytes", "tags": {tag: TagSeries}}
+        self._reserved = 0
+        self._lock = threading.Lock()
+
+    def plan(self, setting, interval, widths):
+        """
+        Validate a task's history setting and check it fits in memory
+
+        Args:
+            setting: None for the default retention (single-value tags only),
+                     True for the default retention of every tag, False to
+                     keep no history, or a dict of seconds per tier ('raw',
+                     '1s', '1m') for every tag
+            interval (float): Poll interval of the task
+            widths (list): Values per sample of each numeric read of the task
+
+        Returns:
+            Plan to pass to register, or None if history is disabled
+
+        Raises:
+            ValueError: For an invalid setting, a tag over MAX_TAG_BYTES, or
+                        a task that would take the store over max_bytes
+        """
+        retention = self.parse_retention(setting)
+        if retention is None:
+            return None
+        arrays = setting is not None
+        total = 0
+        for width in widths:
+            if width > 1 and not arrays:
+                continue
+            size = TagSeries.size(interval, retention, width)
+            if size > MAX_TAG_BYTES:
+                raise ValueError(f"History of {width} values per sample would take {size / 2 ** 20:.1f} MB, "
+                                 f"over the {MAX_TAG_BYTES // 2 ** 20} MB limit per tag; "
+                                 f"shorten its retention or set history to false")
+            total += size
+        with self._lock:
+            available = self.max_bytes - self._reserved
+        if total > available:
+            raise ValueError(f"History would take {total / 2 ** 20:.1f} MB and only "
+                             f"{max(0, available) / 2 ** 20:.1f} MB of the history budget is left; "
+                             f"shorten its retention or set history to false")
+        return {"retention": retention, "arrays": arrays, "bytes": total}
+
+    @staticmethod
+    def parse_retention(retention):
+        """
+        Validate a task's retention setting
+
+        Args:
+            retention: None or True for the defaults, False to disable history,
+                       or a dict of seconds per tier ('raw', '1s', '1m')
+
+        Returns:
+            Dict of seconds per tier, or None if history is disabled
+
+        Raises:
+            ValueError: For unknown tiers or negative retention
+        """
+        if retention is False:
+            return None
+        merged = dict(DEFAULT_RETENTION)
+        if retention is None or retention is True:
+            return merged
+        if not isinstance(retention, dict):
+            raise ValueError("history must be false or an object of retention seconds per tier")
+        for tier, seconds in retention.items():
+            if tier not in DEFAULT_RETENTION:
+                raise ValueError(f"Unknown history tier: {tier}. Use one of {', '.join(TIER_NAMES)}")
+            if not isinstance(seconds, (int, float)) or isinstance(seconds, bool) or seconds < 0:
+                raise ValueError(f"History retention for {tier} must be a non-negative number of seconds")
+            merged[tier] = float(seconds)
+        return merged
+
+    def register(self, task_id, interval, plan=None):
+        """Start keeping history for a task, reserving its memory; plan comes from plan()"""
+        if plan is None:
+            return
+        with self._lock:
+            self._tasks[task_id] = {"interval": interval, "tags": {}, **plan}
+            self._reserved += plan["bytes"]
+
+    def remove(self, task_id):
+        """Drop all history of a task"""
+        with self._lock:
+            task = self._tasks.pop(task_id, None)
+            if task is not None:
+                self._reserved -= task["bytes"]
+
+    def record(self, task_id, tag, value, timestamp=None):
+        """
+        Append a polled value
+
+        Numbers and bools (or lists of them) are stored; other values such
+        as strings are ignored, and so are lists unless the task opted in.
+        The buffers for a tag are allocated on its first sample, sized for
+        the task's interval and retention.
+        """
+        values = self._numeric(value)
+        if values is None:
+            return
+        timestamp = timestamp if timestamp is not None else time.time()
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return
+            series = task["tags"].get(tag)
+            if series is None:
+                if len(values) > 1 and not task["arrays"]:
+                    return
+                if TagSeries.size(task["interval"], task["retention"], len(values)) > MAX_TAG_BYTES:
+                    return
+                series = task["tags"][tag] = TagSeries(task["interval"], task["retention"], len(values),
+                                                       not isinstance(value, list))
+            elif len(values) != series.width:
+                return
+            series.append(timestamp, values)
+
+    def query(self, task_id, tags=None, start=None, end=None, tier=None, max_points=DEFAULT_MAX_POINTS):
+        """
+        Return history between start and end (epoch seconds)
+
+        Args:
+            task_id: Task identifier
+            tags (list): Only return these tags (default: all)
+            start (float): Range start (default: 10 minutes before end)
+            end (float): Range end (default: now)
+            tier (str): 'raw', '1s' or '1m' (default: chosen per tag from the span)
+            max_points (int): Point budget for automatic tier selection
+
+        Returns:
+            Dict of tag -> samples, or None if the task keeps no history
+        """
+        end = end if end is not None else time.time()
+        start = start if start is not None else end - 600
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return None
+            names = task["tags"].keys() if tags is None else [tag for tag in tags if tag in task["tags"]]
+            results = {}
+            for name in names:
+                series = task["tags"][name]
+                selected = tier or series.select_tier(start, end, max_points)
+                results[name] = series.query(selected, start, end) if selected else None
+            return results
+
+    def memory_usage(self, task_id):
+        """Bytes allocated for a task's history, or None if it keeps none"""
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return None
+            return sum(series.nbytes() for series in task["tags"].values())
+
+    @staticmethod
+    def _numeric(value):
+        """Return the value as a list of floats, or None if it isn't numeric"""
+        items = value if isinstance(value, list) else [value]
+        if not items:
+            return None
+        for item in items:
+            if not isinstance(item, (int, float)):
+                return None
+        return [float(item) for item in items]
+
+
+# Shared history written by continuous tasks and read by the history endpoint
+history_store = HistoryStore()
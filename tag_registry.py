@@ -0,0 +1,325 @@
+import json
+import os
+import threading
+from modbus_controller import BIT_TYPES, MAX_READ_BITS, ModbusError
+from connection_pool import connection_pool
+from read_planner import ReadPlan
+from register_codec import CodecError, parse_data_type
+
+class TagDefinition:
+    """A named register range on a device, with its decode format and scaling"""
+
+    def __init__(self, device, name, config, device_config):
+        self.device = device
+        self.name = name
+        self.qualified_name = f"{device}.{name}"
+        self.slave_id = config.get('slave_id', device_config.get('slave_id', 1))
+        self.reg_type = config.get('reg_type', 'holding')
+        self.address = config.get('address')
+        self.count = config.get('count', 1)
+        # Coils and discrete inputs are always read as bools
+        self.data_type = config.get('data_type', 'bool' if self.reg_type in BIT_TYPES else 'int16')
+        self.scale = config.get('scale', None)
+        self.offset = config.get('offset', None)
+
+        if not isinstance(self.address, int) or self.address < 0:
+            raise ModbusError(f"Tag {self.qualified_name}: 'address' must be a non-negative integer")
+        if not isinstance(self.count, int) or self.count < 1:
+            raise ModbusError(f"Tag {self.qualified_name}: 'count' must be a positive integer")
+        if self.reg_type not in ('holding', 'input') + BIT_TYPES:
+            raise ModbusError(f"Tag {self.qualified_name}: invalid register type {self.reg_type}. "
+                              f"Use 'holding', 'input', 'coil' or 'discrete'")
+        if self.reg_type in BIT_TYPES and (self.data_type != 'bool' or self.count > MAX_READ_BITS):
+            raise ModbusError(f"Tag {self.qualified_name}: {self.reg_type} tags are 'bool' with at most "
+                              f"{MAX_READ_BITS} values")
+        try:
+            self.spec = parse_data_type(self.data_type)
+        except CodecError as e:
+            raise ModbusError(f"Tag {self.qualified_name}: {e}")
+        if (self.scale is not None or self.offset is not None) and self.spec.fmt is None:
+            raise ModbusError(f"Tag {self.qualified_name}: scaling is only supported for numeric data types")
+
+    def convert(self, raw):
+        """Apply scale and offset to a decoded value or list of values"""
+        if self.scale is None and self.offset is None:
+            return raw
+        scale = 1 if self.scale is None else self.scale
+        offset = 0 if self.offset is None else self.offset
+        if isinstance(raw, list):
+            return [value * scale + offset for value in raw]
+        return raw * scale + offset
+
+    def to_dict(self):
+        """Return the compiled tag as a JSON-friendly dict"""
+        return {
+            "name": self.qualified_name,
+            "device": self.device,
+            "slave_id": self.slave_id,
+            "reg_type": self.reg_type,
+            "address": self.address,
+            "count": self.count,
+            "data_type": self.data_type,
+            "registers": 0 if self.reg_type in BIT_TYPES else self.spec.words * self.count,
+            "scale": self.scale,
+            "offset": self.offset
+        }
+
+
+class CompiledDevice:
+    """A device with its tags compiled into coalesced read plans"""
+
+    def __init__(self, name, config):
+        if '.' in name:
+            raise ModbusError(f"Device {name}: names can't contain '.' (tags are addressed as 'device.tag')")
+        if not config.get('host'):
+            raise ModbusError(f"Device {name}: 'host' is required")
+        self.name = name
+        self.host = config['host']
+        self.port = config.get('port', 502)
+        self.timeout = config.get('timeout', 30)
+        self.pipeline_window = config.get('pipeline_window', None)
+        if self.pipeline_window is not None and (not isinstance(self.pipeline_window, int) or self.pipeline_window < 1):
+            raise ModbusError(f"Device {name}: 'pipeline_window' must be a positive integer")
+        self.tags = {tag_name: TagDefinition(name, tag_name, tag_config, config)
+                     for tag_name, tag_config in config.get('tags', {}).items()}
+
+        # One plan per (slave_id, reg_type); locations maps each tag to its
+        # plan, its position in the plan and the block that reads it
+        grouped = {}
+        for tag in self.tags.values():
+            grouped.setdefault((tag.slave_id, tag.reg_type), []).append(tag)
+
+        self.plans = []
+        self.locations = {}
+        max_gap = config.get('max_gap')
+        for (slave_id, reg_type), tags in grouped.items():
+            plan = ReadPlan(self.host, self.port, slave_id, reg_type,
+                            [(tag.address, tag.count, tag.data_type) for tag in tags], max_gap)
+            plan_index = len(self.plans)
+            self.plans.append((plan, tags))
+            for tag_index, tag in enumerate(tags):
+                self.locations[tag.name] = (plan_index, tag_index, plan.tag_blocks[tag_index])
+
+    def selection(self, tag_names):
+        """Map tag names to the plan blocks that need to run: {plan index: set of block indexes}"""
+        selected = {}
+        for tag_name in tag_names:
+            plan_index, _, block_index = self.locations[tag_name]
+            selected.setdefault(plan_index, set()).add(block_index)
+        return selected
+
+    def read(self, tag_names, selection=None):
+        """
+        Read tags from the device over one pooled connection
+
+        Returns:
+            Dict of qualified tag name -> converted value or ModbusError
+        """
+        if selection is None:
+            selection = self.selection(tag_names)
+
+        raw = {}
+        try:
+            with connection_pool.connection(self.host, self.port, self.timeout) as controller:
+                for plan_index, blocks in selection.items():
+                    plan, tags = self.plans[plan_index]
+                    values = plan.execute(controller, sorted(blocks))
+                    for tag, value in zip(tags, values):
+                        raw[tag.name] = value
+        except ModbusError as e:
+            raw = {tag_name: e for tag_name in tag_names}
+        except Exception as e:
+            raw = {tag_name: ModbusError(f"Unexpected error: {str(e)}") for tag_name in tag_names}
+
+        results = {}
+        for tag_name in tag_names:
+            value = raw.get(tag_name)
+            tag = self.tags[tag_name]
+            results[tag.qualified_name] = value if isinstance(value, Exception) else tag.convert(value)
+        return results
+
+
+class TagRegistry:
+    """
+    Devices, tags and groups loaded from a JSON or YAML file
+
+    Every change recompiles the affected read plans once, so reads by tag
+    name or group do no parsing or planning at request time.
+    """
+
+    def __init__(self):
+        self.path = None
+        self._config = {"devices": {}, "groups": {}}
+        self._devices = {}
+        self._groups = {}  # group -> {device: (tag names, selection)}
+        self._lock = threading.Lock()
+        self._edit_lock = threading.Lock()  # serialises read-modify-write edits
+
+    def load_file(self, path):
+        """Load the registry from a .json, .yaml or .yml file; later edits are saved back to it"""
+        with open(path) as f:
+            if path.endswith(('.yaml', '.yml')):
+                config = self._yaml().safe_load(f) or {}
+            else:
+                config = json.load(f)
+        self.load(config)
+        self.path = path
+
+    def load(self, config):
+        """Validate and compile a full configuration, replacing the current one"""
+        config = {
+            "devices": dict(config.get('devices', {})),
+            "groups": dict(config.get('groups', {}))
+        }
+        devices = {name: CompiledDevice(name, device_config)
+                   for name, device_config in config['devices'].items()}
+        groups = {name: self._compile_group(name, members, devices)
+                  for name, members in config['groups'].items()}
+
+        with self._lock:
+            self._config = config
+            self._devices = devices
+            self._groups = groups
+
+        # Devices that accept several outstanding requests share one pipelined connection
+        for device in devices.values():
+            if device.pipeline_window:
+                connection_pool.enable_pipelining(device.host, device.port, device.pipeline_window)
+
+    def to_dict(self):
+        """Return the current configuration"""
+        with self._lock:
+            return json.loads(json.dumps(self._config))
+
+    def replace(self, config):
+        """Replace the whole configuration and save it"""
+        with self._edit_lock:
+            self.load(config)
+            self.save()
+
+    def set_device(self, name, device_config):
+        """Add or replace a device"""
+        with self._edit_lock:
+            config = self.to_dict()
+            config['devices'][name] = device_config
+            self.load(config)
+            self.save()
+
+    def remove_device(self, name):
+        """Remove a device; groups referring to it must be updated first"""
+        with self._edit_lock:
+            config = self.to_dict()
+            if name not in config['devices']:
+                raise KeyError(name)
+            del config['devices'][name]
+            self.load(config)
+            self.save()
+
+    def set_group(self, name, members):
+        """Add or replace a group of qualified tag names"""
+        with self._edit_lock:
+            config = self.to_dict()
+            config['groups'][name] = list(members)
+            self.load(config)
+            self.save()
+
+    def remove_group(self, name):
+        """Remove a group"""
+        with self._edit_lock:
+            config = self.to_dict()
+            if name not in config['groups']:
+                raise KeyError(name)
+            del config['groups'][name]
+            self.load(config)
+            self.save()
+
+    def save(self):
+        """Write the configuration back to the file it was loaded from, if any"""
+        if not self.path:
+            return
+        config = self.to_dict()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            if self.path.endswith(('.yaml', '.yml')):
+                self._yaml().safe_dump(config, f, sort_keys=False)
+            else:
+                json.dump(config, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def list_tags(self):
+        """Return every compiled tag"""
+        with self._lock:
+            devices = list(self._devices.values())
+        return [tag.to_dict() for device in devices for tag in device.tags.values()]
+
+    def resolve(self, tags=None, groups=None):
+        """
+        Work out which devices and plan blocks are needed for the requested tags and groups
+
+        Returns:
+            List of (CompiledDevice, tag names, selection)
+
+        Raises:
+            ModbusError: For unknown tags or groups
+        """
+        with self._lock:
+            devices = self._devices
+            compiled_groups = self._groups
+
+        # A single group is the common case: reuse its precompiled selection
+        if groups and len(groups) == 1 and not tags:
+            if groups[0] not in compiled_groups:
+                raise ModbusError(f"Unknown group: {groups[0]}")
+            return [(devices[device_name], tag_names, selection)
+                    for device_name, (tag_names, selection) in compiled_groups[groups[0]].items()]
+
+        wanted = {}
+        for group in groups or []:
+            if group not in compiled_groups:
+                raise ModbusError(f"Unknown group: {group}")
+            for device_name, (tag_names, _) in compiled_groups[group].items():
+                wanted.setdefault(device_name, []).extend(tag_names)
+        for qualified_name in tags or []:
+            device_name, tag_name = self._split(qualified_name, devices)
+            wanted.setdefault(device_name, []).append(tag_name)
+
+        result = []
+        for device_name, tag_names in wanted.items():
+            device = devices[device_name]
+            tag_names = list(dict.fromkeys(tag_names))
+            result.append((device, tag_names, device.selection(tag_names)))
+        return result
+
+    @staticmethod
+    def _split(qualified_name, devices):
+        """Split 'device.tag' and check that it exists"""
+        device_name, _, tag_name = qualified_name.partition('.')
+        device = devices.get(device_name)
+        if device is None or tag_name not in device.tags:
+            raise ModbusError(f"Unknown tag: {qualified_name}")
+        return device_name, tag_name
+
+    def _compile_group(self, name, members, devices):
+        """Precompute the per-device selection of a group"""
+        per_device = {}
+        for qualified_name in members:
+            try:
+                device_name, tag_name = self._split(qualified_name, devices)
+            except ModbusError:
+                raise ModbusError(f"Group {name}: unknown tag {qualified_name}")
+            per_device.setdefault(device_name, []).append(tag_name)
+        return {device_name: (tag_names, devices[device_name].selection(tag_names))
+                for device_name, tag_names in per_device.items()}
+
+    @staticmethod
+    def _yaml():
+        """Import PyYAML on demand; it is only needed for YAML registry files"""
+        try:
+            import yaml
+        except ImportError:
+            raise ModbusError("PyYAML is required for YAML tag configuration files (pip install pyyaml)")
+        return yaml
+
+
+# Shared registry used by the tag routes
+tag_registry = TagRegistry()
@@ -0,0 +1,89 @@
+import json
+import sqlite3
+import threading
+import time
+
+class TaskStore:
+    """
+    Continuous task definitions saved in SQLite so they survive a restart
+
+    Each task is stored as the request body that created it, so restoring a
+    task goes through the same validation and setup as creating it over the
+    API. Nothing is stored until open() is called.
+    """
+
+    def __init__(self):
+        self.path = None
+        self._db = None
+        self._lock = threading.Lock()
+
+    def open(self, path):
+        """Open (or create) the database at path"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            # WAL with NORMAL sync: a commit is one append to the log, fsynced at checkpoints
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, "
+                             "definition TEXT NOT NULL, created_at REAL NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.path = path
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+            self._db = None
+            self.path = None
+
+    @property
+    def enabled(self):
+        return self._db is not None
+
+    def save(self, task_id, kind, definition):
+        """
+        Store a task definition
+
+        Args:
+            task_id (int): Task identifier
+            kind (str): 'device' or 'devices' (which endpoint created the task)
+            definition (dict): Request body the task was created from
+        """
+        with self._lock:
+            if self._db is None:
+                return
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.execute("INSERT OR REPLACE INTO tasks (id, kind, definition, created_at) VALUES (?, ?, ?, ?)",
+                                 (task_id, kind, json.dumps(definition, separators=(',', ':')), time.time()))
+                # Task ids are never reused, even after the newest task is deleted
+                self._db.execute("INSERT INTO meta (key, value) VALUES ('next_id', ?) ON CONFLICT(key) DO UPDATE "
+                                 "SET value = MAX(CAST(value AS INTEGER), CAST(excluded.value AS INTEGER))", (task_id + 1,))
+
+    def delete(self, task_id):
+        """Forget a stopped task"""
+        with self._lock:
+            if self._db is not None:
+                self._db.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+
+    def load(self):
+        """Return the saved (task_id, kind, definition) entries, oldest first"""
+        with self._lock:
+            if self._db is None:
+                return []
+            rows = self._db.execute("SELECT id, kind, definition FROM tasks ORDER BY id").fetchall()
+        return [(task_id, kind, json.loads(definition)) for task_id, kind, definition in rows]
+
+    def next_id(self):
+        """Lowest task id that was never handed out"""
+        with self._lock:
+            if self._db is None:
+                return 0
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+        return int(row[0]) if row else 0
+
+
+# Shared store, opened by create_app when MODBUS_TASK_DB is set
+task_store = TaskStore()
@@ -66,6 +66,173 @@ def test_multi_device():
     print("\nMulti-Device Test:")
     print(json.dumps(response.json(), indent=2))
 
+def test_merged_writes():
+    """Test adjacent batch writes merged by the write queue, then skipped when unchanged"""
+    url = "http://localhost:5000/api/modbus/devices"
+    payload = {
+        "operations": [
+            {"operation": "write", "address": 20 + i, "value": i, "skip_unchanged": True, "port": 5020}
+            for i in range(3)
+        ]
+    }
+    print("\nMerged Writes Test:")
+    for _ in range(2):
+        response = requests.post(url, json=payload)
+        print([result.get("result") for result in response.json()["results"]])
+
+def test_continuous_task_data():
+    """Test reading cached values of a continuous task"""
+    url = "http://localhost:5000/api/modbus/device/continuous"
+    payload = {
+        "operation": "read",
+        "reg_type": "holding",
+        "address": 0,
+        "count": 3,
+        "data_type": "int16",
+        "interval": 0.5,
+        "tag": "test_tag",
+        "history": True,
+        "port": 5020
+    }
+    response = requests.post(url, json=payload)
+    task_id = response.json()["task_id"]
+    time.sleep(1)
+    
+    response = requests.get(f"http://localhost:5000/api/modbus/tasks/{task_id}/data")
+    print("\nContinuous Task Data Test:")
+    print(json.dumps(response.json(), indent=2))
+    
+    response = requests.post("http://localhost:5000/api/modbus/tasks/data", json={"task_ids": [task_id]})
+    print("\nBulk Task Data Test:")
+    print(json.dumps(response.json(), indent=2))
+    
+    response = requests.get(f"http://localhost:5000/api/modbus/tasks/{task_id}/history", params={"tier": "raw"})
+    print("\nTask History Test:")
+    print(json.dumps(response.json(), indent=2))
+    
+    # First events of the live stream: the cached snapshot, then a new sample
+    response = requests.get(f"http://localhost:5000/api/modbus/tasks/{task_id}/stream", stream=True)
+    print("\nTask Stream Test:")
+    lines = response.iter_lines(decode_unicode=True)
+    print("\n".join(next(lines) for _ in range(6)))
+    response.close()
+    
+    requests.delete(f"{url}/{task_id}")
+
+def test_spooled_callback():
+    """Test spooling webhook samples to disk while the callback URL is down"""
+    url = "http://localhost:5000/api/modbus/device/continuous"
+    payload = {
+        "operation": "read",
+        "reg_type": "holding",
+        "address": 0,
+        "count": 3,
+        "data_type": "int16",
+        "interval": 0.2,
+        "port": 5020,
+        "callback_url": "http://localhost:5999/unreachable",
+        "callback_spool": True,
+        "callback_batch_interval": 0.1
+    }
+    response = requests.post(url, json=payload)
+    task_id = response.json()["task_id"]
+    time.sleep(1.5)
+    
+    tasks = requests.get("http://localhost:5000/api/modbus/tasks").json()["tasks"]
+    delivery = next(task["delivery"] for task in tasks if task["id"] == task_id)
+    print("\nSpooled Callback Test:")
+    print(json.dumps({key: delivery[key] for key in ("destination_queue_depth", "delivered", "dropped", "spool")}, indent=2))
+    
+    requests.delete(f"{url}/{task_id}")
+
+def test_task_store():
+    """Test saving and reloading continuous task definitions"""
+    import os
+    import tempfile
+    from task_store import TaskStore
+    path = os.path.join(tempfile.mkdtemp(), "tasks.db")
+    store = TaskStore()
+    store.open(path)
+    store.save(0, "device", {"port": 5020, "interval": 0.5})
+    store.save(1, "devices", {"devices": [{"port": 5020}]})
+    store.delete(1)
+    store.close()
+    
+    store.open(path)
+    print("\nTask Store Test:")
+    print(store.load(), "next id:", store.next_id())
+    store.close()
+
+def test_hash_ring():
+    """Test how devices are spread over polling shards"""
+    from collections import Counter
+    from shard_pool import HashRing
+    devices = [f"10.0.{i // 250}.{i % 250}:502" for i in range(1000)]
+    three, four = HashRing(3), HashRing(4)
+    print("\nHash Ring Test:")
+    print(sorted(Counter(four.owner(device) for device in devices).items()),
+          "moved:", sum(three.owner(device) != four.owner(device) for device in devices))
+
+def test_serial_bus():
+    """Test arbitrating requests to a serial gateway and planning reads by bus cost"""
+    from read_planner import ReadPlan
+    from serial_gateway import serial_buses
+    serial_buses.add("127.0.0.1", 5020, baud=9600)
+    url = "http://localhost:5000/api/modbus/device"
+    for slave_id in (1, 2, 1):
+        requests.post(url, json={"operation": "read", "address": 0, "count": 2, "slave_id": slave_id, "port": 5020})
+    tags = [(0, 2, "int16"), (12, 2, "int16")]
+    print("\nSerial Bus Test:")
+    print(json.dumps(serial_buses.stats(), indent=2))
+    print("blocks:", ReadPlan("127.0.0.1", 5020, 1, "holding", tags).blocks,
+          "vs TCP:", ReadPlan("127.0.0.1", 5021, 1, "holding", tags).blocks)
+
+def test_priority_classes():
+    """Test weighted fair queuing between priority classes and turning away requests to a busy device"""
+    from connection_pool import ConnectionPool
+    from modbus_controller import DeviceBusyError
+    from priority_classes import FairQueue
+    queue = FairQueue()
+    for name in ["bulk"] * 4 + ["interactive"] * 4:
+        queue.push(name)
+    order = []
+    while queue.head():
+        entry = queue.head()
+        queue.pop(entry)
+        order.append(entry[2])
+    print("\nPriority Classes Test:")
+    print(order)
+    
+    pool = ConnectionPool(max_per_device=1, max_queue=0)
+    with pool.connection("127.0.0.1", 5020):
+        try:
+            pool.acquire("127.0.0.1", 5020)
+        except DeviceBusyError as e:
+            print(str(e), "retry after:", e.retry_after)
+    pool.close_all()
+
+def test_metrics():
+    """Test the Prometheus metrics endpoint"""
+    response = requests.get("http://localhost:5000/metrics")
+    print("\nMetrics Test:")
+    print("\n".join(line for line in response.text.splitlines()
+                    if line.startswith(("modbus_request_duration_seconds_count", "modbus_errors_total"))))
+
+def test_typed_array_read():
+    """Test reading a single device as raw little-endian typed arrays"""
+    url = "http://localhost:5000/api/modbus/device"
+    payload = {
+        "operation": "read",
+        "reg_type": "holding",
+        "address": 0,
+        "count": 5,
+        "data_type": "int16",
+        "port": 5020
+    }
+    response = requests.post(url, json=payload, headers={"Accept": "application/vnd.modbus.typed-arrays"})
+    print("\nTyped Array Read Test:")
+    print(response.headers.get("Content-Type"), response.content.hex())
+
 def run_tests():
     """Run all API tests"""
     print("Starting API tests...")
@@ -74,6 +241,15 @@ def run_tests():
     test_single_device_read()
     test_single_device_write()
     test_multi_device()
+    test_merged_writes()
+    test_continuous_task_data()
+    test_spooled_callback()
+    test_task_store()
+    test_hash_ring()
+    test_serial_bus()
+    test_priority_classes()
+    test_metrics()
+    test_typed_array_read()
 
 if __name__ == "__main__":
     # Start Modbus server in a separate thread with higher port
@@ -0,0 +1,106 @@
+import threading
+import time
+
+# A tag is reported stale when it hasn't been updated for this many poll intervals
+STALE_INTERVALS = 3
+
+class LatestValueCache:
+    """In-memory store of the latest polled value per (task, tag)"""
+
+    def __init__(self):
+        self._tasks = {}  # task_id -> {"interval": float, "tags": {tag: [value, timestamp, error, error_timestamp]}}
+        self._lock = threading.Lock()
+
+    def register(self, task_id, interval):
+        """Create an empty entry for a task polled every interval seconds"""
+        with self._lock:
+            self._tasks[task_id] = {"interval": interval, "tags": {}}
+
+    def remove(self, task_id):
+        """Forget all values of a task"""
+        with self._lock:
+            self._tasks.pop(task_id, None)
+
+    def update(self, task_id, tag, value=None, error=None, timestamp=None):
+        """
+        Record a poll result
+
+        A failed poll keeps the last good value and marks it bad until the
+        next successful poll.
+        """
+        timestamp = timestamp if timestamp is not None else time.time()
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return
+            entry = task["tags"].get(tag)
+            if error is None:
+                task["tags"][tag] = [value, timestamp, None, None]
+            elif entry is None:
+                task["tags"][tag] = [None, None, error, timestamp]
+            else:
+                entry[2] = error
+                entry[3] = timestamp
+
+    def touch(self, task_id, tag, timestamp=None):
+        """
+        Confirm that a tag's cached value is still current
+
+        Used when report-by-exception drops an unchanged value: the value
+        stays as it is, but its timestamp moves on and any error is cleared,
+        so the tag is not reported stale.
+        """
+        timestamp = timestamp if timestamp is not None else time.time()
+        with self._lock:
+            task = self._tasks.get(task_id)
+            entry = task["tags"].get(tag) if task is not None else None
+            if entry is not None and entry[1] is not None:
+                entry[1] = timestamp
+                entry[2] = None
+                entry[3] = None
+
+    def get(self, task_id, tags=None):
+        """
+        Return the latest values of a task
+
+        Args:
+            task_id: Task identifier
+            tags (list): Only return these tags (default: all)
+
+        Returns:
+            Dict of tag -> {value, timestamp, quality[, error]}, or None if the task is unknown
+        """
+        now = time.time()
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return None
+            stale_before = now - task["interval"] * STALE_INTERVALS
+            names = task["tags"].keys() if tags is None else [tag for tag in tags if tag in task["tags"]]
+            return {tag: self._entry_dict(task["tags"][tag], stale_before) for tag in names}
+
+    def task_ids(self):
+        """Return the ids of all tasks in the cache"""
+        with self._lock:
+            return list(self._tasks)
+
+    @staticmethod
+    def _entry_dict(entry, stale_before):
+        """Build the response entry and quality flag for one tag"""
+        value, timestamp, error, error_timestamp = entry
+        if error is not None:
+            quality = "bad"
+        elif timestamp < stale_before:
+            quality = "stale"
+        else:
+            quality = "good"
+
+        result = {"value": value, "timestamp": timestamp, "quality": quality}
+        if error is not None:
+            result["error"] = error
+            result["error_timestamp"] = error_timestamp
+        return result
+
+
+# Shared cache written by continuous tasks and read by the task data endpoints
+value_cache = LatestValueCache()
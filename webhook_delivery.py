@@ -0,0 +1,416 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import metrics
+from response_encoding import dumps_json
+from segment_log import DEFAULT_MAX_BYTES, DEFAULT_SEGMENT_SIZE, SegmentLog
+
+# Backpressure policies applied when a destination queue is full
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+COALESCE = 'coalesce'
+POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE)
+
+# Samples per second replayed from a spool once its callback URL is back
+DEFAULT_REPLAY_RATE = 500
+
+class DeliveryQueue:
+    """Bounded queue of samples for one callback URL, drained in batches by its own sender thread"""
+
+    # Clock of enqueue times and delivery latency
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, url, session, max_size=1000, batch_size=50, batch_interval=1.0,
+                 policy=DROP_OLDEST, max_retries=3, backoff=0.5, max_backoff=10.0, request_timeout=5.0):
+        """
+        Create a delivery queue and start its sender thread
+
+        Args:
+            url (str): Callback URL samples are POSTed to
+            session (requests.Session): Pooled HTTP session shared by all queues
+            max_size (int): Samples held before the backpressure policy applies
+            batch_size (int): Samples per POST
+            batch_interval (float): Seconds to wait for a batch to fill before sending
+            policy (str): 'drop_oldest', 'drop_newest' or 'coalesce' (keep only the newest sample per key)
+            max_retries (int): Retries of a failed POST before the batch is dropped
+            backoff (float): First retry delay in seconds, doubled per retry up to max_backoff
+            request_timeout (float): HTTP timeout in seconds
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Invalid callback policy: {policy}. Use one of {', '.join(POLICIES)}")
+
+        self.url = url
+        self.session = session
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.policy = policy
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.request_timeout = request_timeout
+
+        self._items = deque()  # [task_id, key, enqueued_at, sample]
+        self._task_stats = {}
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=f"webhook-{url}", daemon=True)
+        self._thread.start()
+
+    def add_task(self, task_id):
+        """Start tracking delivery statistics for a task"""
+        with self._cond:
+            self._task_stats.setdefault(task_id, {
+                "queued": 0,
+                "delivered": 0,
+                "dropped": 0,
+                "coalesced": 0,
+                "failed": 0,
+                "latency_total": 0.0,
+                "latency_last": 0.0,
+                "latency_max": 0.0
+            })
+
+    def remove_task(self, task_id):
+        """Stop tracking a task; returns True when no tasks use this queue any more"""
+        with self._cond:
+            self._task_stats.pop(task_id, None)
+            return not self._task_stats
+
+    def put(self, task_id, sample, key=None):
+        """
+        Queue a sample without blocking
+
+        Returns:
+            False if the sample was dropped because the queue is full
+        """
+        with self._cond:
+            if self._closed:
+                return False
+            stats = self._task_stats.get(task_id)
+            if stats is None:
+                return False
+
+            if len(self._items) >= self.max_size:
+                if self.policy == DROP_NEWEST:
+                    stats["dropped"] += 1
+                    return False
+                if self.policy == COALESCE and key is not None:
+                    for item in reversed(self._items):
+                        if item[0] == task_id and item[1] == key:
+                            item[3] = sample
+                            stats["coalesced"] += 1
+                            return True
+                # Make room by dropping the oldest sample
+                oldest = self._items.popleft()
+                oldest_stats = self._task_stats.get(oldest[0])
+                if oldest_stats is not None:
+                    oldest_stats["queued"] -= 1
+                    oldest_stats["dropped"] += 1
+
+            self._items.append([task_id, key, self.clock(), sample])
+            stats["queued"] += 1
+            self._cond.notify_all()
+            return True
+
+    def close(self):
+        """Stop accepting samples; the sender exits once the queue is drained"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def stats(self, task_id):
+        """Return queue depth and delivery statistics for a task"""
+        with self._cond:
+            stats = self._task_stats.get(task_id)
+            if stats is None:
+                return None
+            return {
+                "url": self.url,
+                "queue_depth": stats["queued"],
+                "destination_queue_depth": len(self._items),
+                "delivered": stats["delivered"],
+                "dropped": stats["dropped"],
+                "coalesced": stats["coalesced"],
+                "failed": stats["failed"],
+                "latency_ms": {
+                    "last": round(stats["latency_last"] * 1000, 3),
+                    "max": round(stats["latency_max"] * 1000, 3),
+                    "avg": round(stats["latency_total"] / stats["delivered"] * 1000, 3) if stats["delivered"] else 0.0
+                }
+            }
+
+    def depth(self):
+        """Number of samples waiting to be sent"""
+        with self._cond:
+            return len(self._items)
+
+    def _take_batch(self):
+        """Wait for batch_size samples or batch_interval seconds, whichever comes first"""
+        with self._cond:
+            while not self._items:
+                if self._closed:
+                    return None
+                self._cond.wait()
+
+            deadline = time.monotonic() + self.batch_interval
+            while len(self._items) < self.batch_size and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch = [self._items.popleft() for _ in range(min(self.batch_size, len(self._items)))]
+            for task_id, _, _, _ in batch:
+                stats = self._task_stats.get(task_id)
+                if stats is not None:
+                    stats["queued"] -= 1
+            return batch
+
+    def _run(self):
+        """Sender thread: POST batches until the queue is closed and empty"""
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            delivered = self._send(batch)
+            self._record(batch, delivered)
+
+    def _send(self, batch):
+        """POST one batch, retrying with exponential backoff"""
+        body = {"samples": [item[3] for item in batch]}
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(self.url, json=body, timeout=self.request_timeout)
+                if response.status_code < 300:
+                    return True
+            except requests.RequestException:
+                pass
+            if attempt < self.max_retries:
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+        return False
+
+    def _record(self, batch, delivered):
+        """Update per-task statistics after a batch was sent or given up on"""
+        now = self.clock()
+        with self._cond:
+            for task_id, _, enqueued_at, _ in batch:
+                stats = self._task_stats.get(task_id)
+                if stats is None:
+                    continue
+                if not delivered:
+                    stats["failed"] += 1
+                    continue
+                latency = now - enqueued_at
+                stats["delivered"] += 1
+                stats["latency_total"] += latency
+                stats["latency_last"] = latency
+                stats["latency_max"] = max(stats["latency_max"], latency)
+
+
+class SpooledDeliveryQueue(DeliveryQueue):
+    """
+    Delivery queue that keeps its samples in an on-disk segment log
+
+    Samples are only removed from the log once the callback URL accepted
+    them, so they survive outages of the destination and restarts of the
+    server; a failed batch is retried (every max_backoff seconds) instead of
+    dropped. The backlog is sent at no more than replay_rate samples per
+    second so a recovering destination isn't flooded. Only the log's disk
+    budget limits what is kept: beyond it the oldest segments are dropped.
+    """
+
+    # Enqueue times are stored in the log, so they must survive a restart
+    clock = staticmethod(time.time)
+
+    def __init__(self, url, session, log, replay_rate=DEFAULT_REPLAY_RATE, **options):
+        """
+        Args:
+            log (SegmentLog): Spool of this callback URL
+            replay_rate (float): Maximum samples sent per second
+            options: As for DeliveryQueue (max_size and policy don't apply)
+        """
+        if replay_rate <= 0:
+            raise ValueError("callback_replay_rate must be positive")
+        self.log = log
+        self.replay_rate = replay_rate
+        super().__init__(url, session, **options)
+
+    def put(self, task_id, sample, key=None):
+        """Append a sample to the spool; only fails for a closed queue or an oversized sample"""
+        with self._cond:
+            stats = self._task_stats.get(task_id)
+            if self._closed or stats is None:
+                return False
+            stats["queued"] += 1
+        try:
+            self.log.append(dumps_json([task_id, self.clock(), sample]))
+        except ValueError:
+            with self._cond:
+                stats["queued"] -= 1
+                stats["dropped"] += 1
+            return False
+        return True
+
+    def close(self):
+        """Stop sending; undelivered samples stay in the spool for the next queue of this URL"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self.log.wake()
+
+    def stats(self, task_id):
+        stats = super().stats(task_id)
+        if stats is not None:
+            stats["destination_queue_depth"] = self.log.pending()
+            stats["spool"] = {
+                "backlog_bytes": self.log.backlog_bytes(),
+                "dropped_bytes": self.log.dropped_bytes,
+                "replay_rate": self.replay_rate
+            }
+        return stats
+
+    def depth(self):
+        return self.log.pending()
+
+    def _is_closed(self):
+        return self._closed
+
+    def _take_batch(self):
+        """Read up to batch_size samples from the spool, waiting at most batch_interval for a full batch"""
+        self.log.wait(1, stop=self._is_closed)
+        if not self._closed:
+            self.log.wait(self.batch_size, self.batch_interval, stop=self._is_closed)
+        if self._closed:
+            return None
+
+        batch = []
+        for offset, payload in self.log.read(self.batch_size):
+            task_id, enqueued_at, sample = json.loads(payload)
+            batch.append([task_id, offset, enqueued_at, sample])
+        with self._cond:
+            for task_id, _, _, _ in batch:
+                stats = self._task_stats.get(task_id)
+                # Samples spooled before a restart may belong to a task that no longer exists
+                if stats is not None and stats["queued"] > 0:
+                    stats["queued"] -= 1
+        return batch
+
+    def _run(self):
+        """Sender thread: POST batches from the spool, committing each once it is accepted"""
+        while True:
+            with self.log.consumer_lock:
+                batch = self._take_batch()
+                if batch is None:
+                    return
+                started = time.monotonic()
+                while not self._send(batch):
+                    self._record(batch, False)
+                    with self._cond:
+                        if self._cond.wait_for(self._is_closed, self.max_backoff):
+                            return
+                self.log.commit(batch[-1][1], len(batch))
+                self._record(batch, True)
+
+            # Pace the replay to replay_rate samples per second
+            pause = len(batch) / self.replay_rate - (time.monotonic() - started)
+            if pause > 0:
+                with self._cond:
+                    if self._cond.wait_for(self._is_closed, pause):
+                        return
+
+
+class WebhookDispatcher:
+    """Routes continuous task samples to per-destination delivery queues over one pooled HTTP session"""
+
+    def __init__(self, pool_size=16, spool_dir='spool'):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.spool_dir = spool_dir
+        self._queues = {}
+        self._spools = {}  # url -> SegmentLog, kept open across the queues of a URL
+        self._lock = threading.Lock()
+
+    def register(self, task_id, url, **options):
+        """
+        Attach a task to the queue for url, creating it with options if needed
+
+        Options (see DeliveryQueue) only apply when the queue is created; tasks
+        sharing a callback URL share its queue and settings. With spool=True
+        the queue is a SpooledDeliveryQueue, taking replay_rate, spool_max_bytes
+        and spool_segment_size options.
+        """
+        spool = options.pop('spool', False)
+        replay_rate = options.pop('replay_rate', DEFAULT_REPLAY_RATE)
+        max_bytes = options.pop('spool_max_bytes', DEFAULT_MAX_BYTES)
+        segment_size = options.pop('spool_segment_size', DEFAULT_SEGMENT_SIZE)
+        with self._lock:
+            queue = self._queues.get(url)
+            if queue is None:
+                if spool:
+                    log = self._spools.get(url)
+                    if log is None:
+                        log = self._spools[url] = SegmentLog(self._spool_path(url), segment_size, max_bytes)
+                    queue = SpooledDeliveryQueue(url, self.session, log, replay_rate, **options)
+                else:
+                    queue = DeliveryQueue(url, self.session, **options)
+                self._queues[url] = queue
+            queue.add_task(task_id)
+
+    def unregister(self, task_id, url):
+        """Detach a task; the queue is closed (after draining) when its last task goes"""
+        with self._lock:
+            queue = self._queues.get(url)
+            if queue is not None and queue.remove_task(task_id):
+                queue.close()
+                del self._queues[url]
+
+    def submit(self, task_id, url, sample, key=None):
+        """Queue a sample for delivery; never blocks the caller"""
+        queue = self._queues.get(url)
+        if queue is None:
+            return False
+        return queue.put(task_id, sample, key)
+
+    def stats(self, task_id, url):
+        """Return delivery statistics of a task, or None"""
+        queue = self._queues.get(url)
+        return queue.stats(task_id) if queue is not None else None
+
+    def queue_depths(self):
+        """Return the number of queued samples per callback URL"""
+        with self._lock:
+            queues = list(self._queues.items())
+        return {url: queue.depth() for url, queue in queues}
+
+    def spool_backlogs(self):
+        """Return the undelivered bytes in each open spool, by callback URL"""
+        with self._lock:
+            spools = list(self._spools.items())
+        return {url: log.backlog_bytes() for url, log in spools}
+
+    def _spool_path(self, url):
+        # One directory per callback URL; the URL itself is written next to it for operators
+        path = os.path.join(self.spool_dir, hashlib.sha1(url.encode('utf-8')).hexdigest()[:16])
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'url'), 'w') as f:
+            f.write(url)
+        return path
+
+
+# Shared dispatcher used by continuous tasks
+webhook_dispatcher = WebhookDispatcher()
+
+metrics.callback('modbus_webhook_queue_depth', 'Samples waiting for delivery per callback URL', ('url',),
+                 lambda: {(url,): depth for url, depth in webhook_dispatcher.queue_depths().items()})
+metrics.callback('modbus_spool_backlog_bytes', 'Undelivered bytes in the on-disk spool per callback URL', ('url',),
+                 lambda: {(url,): size for url, size in webhook_dispatcher.spool_backlogs().items()})
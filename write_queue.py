@@ -0,0 +1,333 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from modbus_controller import MAX_WRITE_BITS, MAX_WRITE_REGISTERS, ModbusError
+from connection_pool import connection_pool
+from register_codec import CodecError, encode_values
+from metrics import metrics, queued_writes_total, write_requests_total
+from priority_classes import CONTROL_WRITE, priority_class
+
+# Results of a queued write
+WRITTEN = 'written'
+UNCHANGED = 'unchanged'
+
+# A confirmed value older than this is written again even if unchanged, in
+# case the device was changed by something else (an HMI, another master)
+RESEND_AFTER = 60.0
+
+def _keys(slave_id, reg_type, start, values):
+    """(slave_id, reg_type, address) of each register or coil of a write"""
+    return [(slave_id, reg_type, start + offset) for offset in range(len(values))]
+
+def _runs(writes, limit):
+    """
+    Group {start: [values]} writes into runs of adjacent writes, at most limit long
+
+    Runs are only split between writes, never inside one, so a multi-register
+    value always goes out in a single request. Returns (start, [values],
+    [start of each write]) per run.
+    """
+    runs = []
+    for start in sorted(writes):
+        values = writes[start]
+        if runs and start == runs[-1][0] + len(runs[-1][1]) and len(runs[-1][1]) + len(values) <= limit:
+            runs[-1][1].extend(values)
+            runs[-1][2].append(start)
+        else:
+            runs.append((start, list(values), [start]))
+    return runs
+
+
+class _Batch:
+    """Writes sent together by one flush, and the futures waiting for them"""
+
+    def __init__(self):
+        self.writes = {}   # (slave_id, reg_type) -> {start address: [registers or coil states]}
+        self.waiters = []  # [future, keys, timeout]
+
+    def accepts(self, slave_id, reg_type, address, count):
+        """
+        Whether a write can join the batch
+
+        A write of the same range as a pending one replaces it (last value
+        wins), but one that partly overlaps a pending write, e.g. an int16
+        into the middle of a float32, must not be merged with it: the device
+        would get half of each value.
+        """
+        for start, values in self.writes.get((slave_id, reg_type), {}).items():
+            if start < address + count and address < start + len(values) and (start, len(values)) != (address, count):
+                return False
+        return True
+
+    def add(self, future, slave_id, reg_type, address, values, timeout):
+        self.writes.setdefault((slave_id, reg_type), {})[address] = values
+        self.waiters.append([future, _keys(slave_id, reg_type, address, values), timeout])
+
+    def covers(self, key):
+        slave_id, reg_type, address = key
+        return any(start <= address < start + len(values)
+                   for start, values in self.writes.get((slave_id, reg_type), {}).items())
+
+    def keys(self):
+        return {key for (slave_id, reg_type), writes in self.writes.items()
+                for start, values in writes.items() for key in _keys(slave_id, reg_type, start, values)}
+
+
+class DeviceWriteQueue:
+    """
+    Pending writes of one device, sent by one flush at a time
+
+    A newer write of the same range replaces the pending one, and adjacent
+    writes go out as a single write multiple request. Writes submitted while
+    a flush is in flight are collected and sent together by the next flush.
+    A write that partly overlaps a pending one starts a new batch, sent after
+    the pending writes, so overlapping writes of different widths are never
+    mixed into one request.
+    """
+
+    def __init__(self, host, port, executor, resend_after=RESEND_AFTER):
+        self.host = host
+        self.port = port
+        self.executor = executor
+        self.resend_after = resend_after
+        self._pending = []    # batches, in the order they are sent
+        self._sending = []    # the same, for the flush in flight
+        self._confirmed = {}  # (slave_id, reg_type, address) -> (value, time written)
+        self._flushing = False
+        self._lock = threading.Lock()
+
+    def submit(self, writes):
+        """
+        Queue writes and start a flush if none is running
+
+        Args:
+            writes (list): (future, slave_id, reg_type, address, values, timeout, skip_unchanged)
+                entries, values being the encoded registers or coil states
+        """
+        unchanged = []
+        with self._lock:
+            now = time.monotonic()
+            for future, slave_id, reg_type, address, values, timeout, skip_unchanged in writes:
+                keys = _keys(slave_id, reg_type, address, values)
+                if skip_unchanged and all(self._is_confirmed(key, value, now) and not self._is_queued(key)
+                                          for key, value in zip(keys, values)):
+                    unchanged.append(future)
+                    continue
+                if not self._pending or not self._pending[-1].accepts(slave_id, reg_type, address, len(values)):
+                    self._pending.append(_Batch())
+                self._pending[-1].add(future, slave_id, reg_type, address, values, timeout)
+            start = bool(self._pending) and not self._flushing
+            if start:
+                self._flushing = True
+
+        for future in unchanged:
+            queued_writes_total.inc(UNCHANGED)
+            future.set_result(UNCHANGED)
+        if start:
+            self.executor.submit(self._flush)
+
+    def pending_count(self):
+        """Registers and coils waiting to be written"""
+        with self._lock:
+            return sum(len(values) for batch in self._pending for writes in batch.writes.values()
+                       for values in writes.values())
+
+    def _is_confirmed(self, key, value, now):
+        confirmed = self._confirmed.get(key)
+        return confirmed is not None and confirmed[0] == value and now - confirmed[1] < self.resend_after
+
+    def _is_queued(self, key):
+        return any(batch.covers(key) for batch in self._pending + self._sending)
+
+    def _flush(self):
+        """Send pending writes until the queue is empty"""
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._flushing = False
+                    self._sending = []
+                    return
+                batches = self._sending = self._pending
+                self._pending = []
+            timeout = max(timeout for batch in batches for _, _, timeout in batch.waiters)
+            try:
+                # Setpoints go ahead of reads queued for a busy device
+                with priority_class(CONTROL_WRITE):
+                    failures = self._send(batches, timeout)
+            except Exception as e:
+                failures = [dict.fromkeys(batch.keys(), e) for batch in batches]
+
+            for batch, failed in zip(batches, failures):
+                for future, keys, _ in batch.waiters:
+                    error = next((failed[key] for key in keys if key in failed), None)
+                    if error is None:
+                        queued_writes_total.inc(WRITTEN)
+                        future.set_result(WRITTEN)
+                    else:
+                        queued_writes_total.inc('failed')
+                        future.set_exception(error)
+
+    def _send(self, batches, timeout):
+        """Write the batches in order; return, per batch, the error of each address that wasn't written"""
+        failures = [{} for _ in batches]
+        unsent = [batch.keys() for batch in batches]
+        try:
+            with connection_pool.connection(self.host, self.port, timeout) as controller:
+                for batch, failed, remaining in zip(batches, failures, unsent):
+                    for (slave_id, reg_type), writes in batch.writes.items():
+                        limit = MAX_WRITE_BITS if reg_type == 'coil' else MAX_WRITE_REGISTERS
+                        for start, run, starts in _runs(writes, limit):
+                            try:
+                                self._write(controller, slave_id, reg_type, start, run)
+                            except ModbusError as e:
+                                if len(starts) == 1:
+                                    failed.update(dict.fromkeys(_keys(slave_id, reg_type, start, run), e))
+                                else:
+                                    # One bad write fails the merged request: retry them one by one,
+                                    # so each gets the result it would have had on its own
+                                    failed.update(self._write_each(controller, slave_id, reg_type, writes, starts))
+                            remaining.difference_update(_keys(slave_id, reg_type, start, run))
+        except Exception as e:
+            # The connection failed or broke: whatever wasn't sent yet failed with it
+            error = e if isinstance(e, ModbusError) else ModbusError(f"Unexpected error: {str(e)}")
+            for failed, remaining in zip(failures, unsent):
+                failed.update(dict.fromkeys(remaining, error))
+                self._forget(remaining)
+        return failures
+
+    def _write_each(self, controller, slave_id, reg_type, writes, starts):
+        """Send writes one request each; return the error of each address that wasn't written"""
+        failed = {}
+        for start in starts:
+            try:
+                self._write(controller, slave_id, reg_type, start, writes[start])
+            except ModbusError as e:
+                failed.update(dict.fromkeys(_keys(slave_id, reg_type, start, writes[start]), e))
+        return failed
+
+    def _write(self, controller, slave_id, reg_type, start, values):
+        """Send one write request and record the values the device now has"""
+        keys = _keys(slave_id, reg_type, start, values)
+        write_requests_total.inc()
+        try:
+            if reg_type == 'coil':
+                controller.write_bits(start, values, slave_id)
+            else:
+                controller.write_data(start, values, slave_id, 'uint16')
+        except ModbusError:
+            self._forget(keys)
+            raise
+        self._confirm(keys, values)
+
+    def _confirm(self, keys, values):
+        now = time.monotonic()
+        with self._lock:
+            for key, value in zip(keys, values):
+                self._confirmed[key] = (value, now)
+
+    def _forget(self, keys):
+        # After a failed write the device's value is unknown
+        with self._lock:
+            for key in keys:
+                self._confirmed.pop(key, None)
+
+
+class WriteQueue:
+    """Per-device write queues shared by the API and continuous tasks, keyed by host and port"""
+
+    def __init__(self, max_workers=32, resend_after=RESEND_AFTER):
+        self.resend_after = resend_after
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='modbus-write')
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def submit_many(self, ops, skip_unchanged=False):
+        """
+        Queue several writes; writes to the same device are merged where possible
+
+        Args:
+            ops (list): Write operations as sent to the API (host, port, address,
+                value, slave_id, data_type, reg_type and timeout)
+            skip_unchanged (bool): Don't resend values the device last confirmed
+                (an operation's own skip_unchanged field takes precedence)
+
+        Returns:
+            One Future per operation, resolving to 'written' or 'unchanged' or
+            raising ModbusError
+        """
+        futures = []
+        devices = {}
+        for op in ops:
+            future = Future()
+            futures.append(future)
+            try:
+                slave_id, reg_type, address, values = self._encode(op)
+            except ModbusError as e:
+                future.set_exception(e)
+                continue
+            device = (op.get('host', '127.0.0.1'), op.get('port', 502))
+            devices.setdefault(device, []).append(
+                (future, slave_id, reg_type, address, values, op.get('timeout', 30),
+                 op.get('skip_unchanged', skip_unchanged)))
+
+        for (host, port), writes in devices.items():
+            self._queue(host, port).submit(writes)
+        return futures
+
+    def write(self, host, port, address, value, slave_id=1, data_type='int16', reg_type='holding',
+              timeout=30, skip_unchanged=False):
+        """Queue one write and wait for it; returns 'written' or 'unchanged'"""
+        future, = self.submit_many([{
+            "host": host, "port": port, "address": address, "value": value, "slave_id": slave_id,
+            "data_type": data_type, "reg_type": reg_type, "timeout": timeout
+        }], skip_unchanged)
+        return self.result(future, timeout)
+
+    @staticmethod
+    def result(future, timeout=30):
+        """Wait for a queued write; it may first wait for the flush ahead of it"""
+        try:
+            return future.result(timeout * 2 + 1)
+        except TimeoutError:
+            raise ModbusError("Timed out waiting for the queued write")
+
+    def pending_counts(self):
+        """Pending registers and coils per device"""
+        with self._lock:
+            queues = list(self._queues.values())
+        return {f"{queue.host}:{queue.port}": queue.pending_count() for queue in queues}
+
+    def _queue(self, host, port):
+        queue = self._queues.get((host, port))
+        if queue is None:
+            with self._lock:
+                queue = self._queues.setdefault((host, port),
+                                                DeviceWriteQueue(host, port, self.executor, self.resend_after))
+        return queue
+
+    @staticmethod
+    def _encode(op):
+        """Return (slave_id, reg_type, address, registers or coil states) of a write operation"""
+        reg_type = op.get('reg_type', 'holding')
+        value = op.get('value', None)
+        if value is None:
+            raise ModbusError("Value is required for write operations")
+        if reg_type == 'coil':
+            values = [bool(v) for v in value] if isinstance(value, (list, tuple)) else [bool(value)]
+            if not 1 <= len(values) <= MAX_WRITE_BITS:
+                raise ModbusError(f"Coil count must be between 1 and {MAX_WRITE_BITS}")
+        elif reg_type == 'holding':
+            try:
+                values = encode_values(value, op.get('data_type', 'int16'))
+            except CodecError as e:
+                raise ModbusError(str(e))
+        else:
+            raise ModbusError(f"Cannot write to {reg_type}: only 'holding' and 'coil' are writable")
+        return op.get('slave_id', 1), reg_type, op.get('address', 0), values
+
+
+# Shared queues used by the write endpoints and continuous write tasks
+write_queue = WriteQueue()
+
+metrics.callback('modbus_write_queue_pending', 'Registers and coils waiting in the write queues', ('device',),
+                 lambda: {(device,): count for device, count in write_queue.pending_counts().items()})